@@ -0,0 +1,310 @@
+import array
+import logging
+import os
+import re
+
+from nuoca_plugin import NuocaMPInputPlugin
+from nuoca_util import nuoca_log, nuoca_monotonic
+
+# HostMetrics plugin
+#
+# Collects host metrics from /proc and statvfs(), without a Zabbix agent
+# or any other external process:
+#
+#   cpu.<field>                       CPU utilisation in percent: user,
+#                                     nice, system, idle, iowait, irq,
+#                                     softirq and steal
+#   cpu.intr, cpu.switches            Interrupts and context switches per
+#                                     second
+#   system.boottime, system.uptime    Seconds
+#   memory.<field>                    Bytes: total, free, available,
+#                                     buffers, cached, used
+#   swap.<field>                      Bytes: total, free
+#   disk.<device>.<field>             Per second: read_ops, read_bytes,
+#                                     write_ops, write_bytes; util in
+#                                     percent
+#   net.<interface>.<field>           Per second: in_bytes, in_packets,
+#                                     in_errors, out_bytes, out_packets,
+#                                     out_errors
+#   fs.<mount>.<field>                Bytes: total, used, free; pused in
+#                                     percent
+#
+# Rates and utilisation are computed from the previous sample, so they
+# are collected from the second collection on.  Disk devices and network
+# interfaces are discovered in every collection.  Mounts of /dev devices
+# are discovered again every 'discoveryInterval' seconds (default 60).
+# Disk devices whose names match 'diskExcludeRegex' (default loop and ram
+# devices) are not collected.
+#
+# Example HostMetrics plugin configuration:
+#
+# - HostMetrics:
+#    description : Collect host metrics from /proc
+#    discoveryInterval: 60
+#    diskExcludeRegex: ^(loop|ram)
+
+
+_CPU_FIELDS = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq',
+               'steal']
+_MEMINFO_FIELDS = {'MemTotal': 'memory.total', 'MemFree': 'memory.free',
+                   'MemAvailable': 'memory.available',
+                   'Buffers': 'memory.buffers', 'Cached': 'memory.cached',
+                   'SwapTotal': 'swap.total', 'SwapFree': 'swap.free'}
+# /proc/diskstats columns after the device name: reads, sectors read,
+# writes, sectors written and milliseconds doing I/O.
+_DISK_COLUMNS = [0, 2, 4, 6, 9]
+# /proc/net/dev columns: received bytes, packets and errors, then
+# transmitted bytes, packets and errors.
+_NET_COLUMNS = [0, 1, 2, 8, 9, 10]
+_NET_FIELDS = ['in_bytes', 'in_packets', 'in_errors', 'out_bytes',
+               'out_packets', 'out_errors']
+_SECTOR_BYTES = 512
+
+
+class CounterSamples(object):
+  """
+  The previous sample of a family of counters, such as the counters of
+  each disk device, in one flat array.  Names can come and go from one
+  sample to the next; the previous values of the other names are kept.
+  """
+  def __init__(self, width):
+    """
+    :param width: Number of counters of each name.
+    :type width: ``int``
+    """
+    self._width = width
+    self._names = []
+    self._positions = {}
+    self._values = array.array('d')
+    self._time = None
+
+  @property
+  def names(self):
+    return self._names
+
+  def update(self, counters, now):
+    """
+    Store a new sample.
+
+    :param counters: Counters by name.
+    :type counters: ``dict`` of ``list``
+
+    :param now: Monotonic time of the sample.
+    :type now: ``float``
+
+    :return: (elapsed seconds, counter deltas by name).  Names that were
+      not in the previous sample, or whose counters went backwards, have
+      no deltas.
+    """
+    deltas = {}
+    elapsed = None
+    if self._time is not None:
+      elapsed = now - self._time
+      width = self._width
+      for name, values in counters.iteritems():
+        position = self._positions.get(name)
+        if position is None:
+          continue
+        previous = self._values[position * width:(position + 1) * width]
+        delta = [x - y for x, y in zip(values, previous)]
+        if min(delta) >= 0:
+          deltas[name] = delta
+    if sorted(counters) != self._names:
+      self._names = sorted(counters)
+      self._positions = dict([(x, i) for i, x in enumerate(self._names)])
+      self._values = array.array('d', [0.0]) * \
+          (len(self._names) * self._width)
+    for name, values in counters.iteritems():
+      position = self._positions[name] * self._width
+      self._values[position:position + self._width] = \
+          array.array('d', values)
+    self._time = now
+    return elapsed, deltas
+
+
+class HostMetricsPlugin(NuocaMPInputPlugin):
+  DEFAULT_DISCOVERY_INTERVAL = 60
+  DEFAULT_DISK_EXCLUDE_REGEX = '^(loop|ram)'
+
+  def __init__(self, parent_pipe):
+    super(HostMetricsPlugin, self).__init__(parent_pipe, 'HostMetrics')
+    self._config = None
+    self._proc_dir = '/proc'
+    self._discovery_interval = self.DEFAULT_DISCOVERY_INTERVAL
+    self._disk_exclude = None
+    self._mounts = []
+    self._discovery_time = None
+    self._cpu_samples = CounterSamples(len(_CPU_FIELDS) + 2)
+    self._disk_samples = CounterSamples(len(_DISK_COLUMNS))
+    self._net_samples = CounterSamples(len(_NET_COLUMNS))
+
+  def startup(self, config=None):
+    try:
+      self._config = config or {}
+      self._proc_dir = self._config.get('procDir', '/proc')
+      self._discovery_interval = float(self._config.get(
+          'discoveryInterval', self.DEFAULT_DISCOVERY_INTERVAL))
+      self._disk_exclude = re.compile(self._config.get(
+          'diskExcludeRegex', self.DEFAULT_DISK_EXCLUDE_REGEX))
+      if not os.path.exists(os.path.join(self._proc_dir, 'stat')):
+        nuoca_log(logging.ERROR, "HostMetrics plugin: no %s/stat"
+                  % self._proc_dir)
+        return False
+      # The first sample for the rates.
+      self._collect_cpu({})
+      self._collect_disks({})
+      self._collect_net({})
+      return True
+    except Exception as e:
+      nuoca_log(logging.ERROR, str(e))
+      return False
+
+  def shutdown(self):
+    pass
+
+  def _read_proc_lines(self, name):
+    with open(os.path.join(self._proc_dir, name)) as proc_file:
+      return proc_file.readlines()
+
+  @staticmethod
+  def _log_discovery(kind, old_names, new_names):
+    added = sorted(set(new_names) - set(old_names))
+    removed = sorted(set(old_names) - set(new_names))
+    if added:
+      nuoca_log(logging.INFO, "HostMetrics plugin discovered %s: %s"
+                % (kind, ', '.join(added)))
+    if removed:
+      nuoca_log(logging.INFO, "HostMetrics plugin removed %s: %s"
+                % (kind, ', '.join(removed)))
+
+  def _collect_cpu(self, values):
+    counters = [0.0] * len(_CPU_FIELDS)
+    intr = 0.0
+    ctxt = 0.0
+    for line in self._read_proc_lines('stat'):
+      fields = line.split()
+      if not fields:
+        continue
+      if fields[0] == 'cpu':
+        counters = [float(x) for x in fields[1:len(_CPU_FIELDS) + 1]]
+        counters += [0.0] * (len(_CPU_FIELDS) - len(counters))
+      elif fields[0] == 'intr':
+        intr = float(fields[1])
+      elif fields[0] == 'ctxt':
+        ctxt = float(fields[1])
+      elif fields[0] == 'btime':
+        values['system.boottime'] = int(fields[1])
+    elapsed, deltas = self._cpu_samples.update(
+        {'cpu': counters + [intr, ctxt]}, nuoca_monotonic())
+    delta = deltas.get('cpu')
+    if delta and elapsed > 0:
+      total = sum(delta[:len(_CPU_FIELDS)])
+      if total > 0:
+        for field, field_delta in zip(_CPU_FIELDS, delta):
+          values['cpu.%s' % field] = round(100.0 * field_delta / total, 2)
+      values['cpu.intr'] = round(delta[-2] / elapsed, 2)
+      values['cpu.switches'] = round(delta[-1] / elapsed, 2)
+    values['system.uptime'] = int(float(
+        self._read_proc_lines('uptime')[0].split()[0]))
+
+  def _collect_memory(self, values):
+    for line in self._read_proc_lines('meminfo'):
+      fields = line.split()
+      name = _MEMINFO_FIELDS.get(fields[0].rstrip(':'))
+      if name:
+        values[name] = int(fields[1]) * 1024
+    if 'memory.total' in values and 'memory.available' in values:
+      values['memory.used'] = values['memory.total'] - \
+          values['memory.available']
+
+  def _collect_disks(self, values):
+    counters = {}
+    for line in self._read_proc_lines('diskstats'):
+      fields = line.split()
+      if len(fields) < 14 or self._disk_exclude.search(fields[2]):
+        continue
+      counters[fields[2]] = [float(fields[3 + x]) for x in _DISK_COLUMNS]
+    old_names = self._disk_samples.names
+    elapsed, deltas = self._disk_samples.update(counters, nuoca_monotonic())
+    self._log_discovery('disks', old_names, self._disk_samples.names)
+    if not elapsed or elapsed <= 0:
+      return
+    for device, delta in deltas.iteritems():
+      prefix = 'disk.%s.' % device
+      values[prefix + 'read_ops'] = round(delta[0] / elapsed, 2)
+      values[prefix + 'read_bytes'] = \
+          round(delta[1] * _SECTOR_BYTES / elapsed, 2)
+      values[prefix + 'write_ops'] = round(delta[2] / elapsed, 2)
+      values[prefix + 'write_bytes'] = \
+          round(delta[3] * _SECTOR_BYTES / elapsed, 2)
+      values[prefix + 'util'] = round(min(100.0, delta[4] / elapsed / 10.0),
+                                      2)
+
+  def _collect_net(self, values):
+    counters = {}
+    for line in self._read_proc_lines('net/dev'):
+      if ':' not in line:
+        continue
+      interface, data = line.split(':', 1)
+      fields = data.split()
+      counters[interface.strip()] = [float(fields[x]) for x in _NET_COLUMNS]
+    old_names = self._net_samples.names
+    elapsed, deltas = self._net_samples.update(counters, nuoca_monotonic())
+    self._log_discovery('interfaces', old_names, self._net_samples.names)
+    if not elapsed or elapsed <= 0:
+      return
+    for interface, delta in deltas.iteritems():
+      for field, field_delta in zip(_NET_FIELDS, delta):
+        values['net.%s.%s' % (interface, field)] = \
+            round(field_delta / elapsed, 2)
+
+  def _discover_mounts(self):
+    mounts = []
+    for line in self._read_proc_lines('mounts'):
+      fields = line.split()
+      if len(fields) < 2 or not fields[0].startswith('/dev'):
+        continue
+      # /proc/mounts escapes spaces in mount points as \040.
+      mount = fields[1].replace('\\040', ' ')
+      if mount not in mounts:
+        mounts.append(mount)
+    self._log_discovery('mounts', self._mounts, mounts)
+    self._mounts = mounts
+
+  def _collect_filesystems(self, values):
+    now = nuoca_monotonic()
+    if self._discovery_time is None or \
+        now - self._discovery_time >= self._discovery_interval:
+      self._discover_mounts()
+      self._discovery_time = now
+    for mount in self._mounts:
+      try:
+        stat = os.statvfs(mount)
+      except OSError as e:
+        nuoca_log(logging.WARNING, "HostMetrics plugin: statvfs(%s): %s"
+                  % (mount, str(e)))
+        continue
+      total = stat.f_blocks * stat.f_frsize
+      free = stat.f_bavail * stat.f_frsize
+      used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+      prefix = 'fs.%s.' % mount
+      values[prefix + 'total'] = total
+      values[prefix + 'used'] = used
+      values[prefix + 'free'] = free
+      if used + free:
+        values[prefix + 'pused'] = round(100.0 * used / (used + free), 2)
+
+  def collect(self, collection_interval):
+    rval = None
+    try:
+      collected_values = super(HostMetricsPlugin, self).collect(
+          collection_interval)
+      self._collect_cpu(collected_values)
+      self._collect_memory(collected_values)
+      self._collect_disks(collected_values)
+      self._collect_net(collected_values)
+      self._collect_filesystems(collected_values)
+      rval = [collected_values]
+    except Exception as e:
+      nuoca_log(logging.ERROR, "HostMetrics plugin: %s" % str(e))
+    return rval
@@ -1,15 +1,12 @@
-import hashlib
-import json
 import logging
 import os
-import re
-import socket
 import subprocess
 import threading
 
-from calendar import timegm
-from dateutil.parser import parse as date_parse
-from nuoca_plugin import NuocaMPInputPlugin
+# The module, not its classes: Yapsy would load the first plugin class
+# that it finds here.
+import nuoca_logstash
+from nuoca_logstash import JsonLinesReader
 from nuoca_util import nuoca_log
 
 # Logstash plugin
@@ -37,32 +34,34 @@ from nuoca_util import nuoca_log
 #      If this is set, then a shell environment variable LOGSTASH_SINCEDB_PATH
 #      is set to this value.  In this way, you can parameterize the
 #      file.sincedb_path in a logstash config file.
+#    collectQueueMaxDepth: maximum events kept between collections.
+#      (optional, default 100000)
+#    collectQueueOverflowPolicy: drop_oldest, drop_newest or block, when
+#      the maximum is reached. (optional, default drop_oldest)
+#    logstashReadBlockSize: bytes read from the logstash stdout at once.
+#      (optional, default 1048576)
 #
+# The logstash config must write events to stdout with the json_lines
+# codec.  Other stdout lines are logstash messages: they are written to
+# the NuoCA log, at most 10 a minute.  The reader counters
+# logstash_lines_per_second, logstash_parse_failures and logstash_messages
+# are plugin metrics, emitted by the built-in NuoCA input.
 
 
-class LogstashPlugin(NuocaMPInputPlugin):
-  def __init__(self, parent_pipe):
-    super(LogstashPlugin, self).__init__(parent_pipe, 'Logstash')
-    self._config = None
+class LogstashPlugin(nuoca_logstash.LogstashInputPlugin):
+  DEFAULT_READ_BLOCK_SIZE = 1048576
+
+  def __init__(self, parent_pipe, plugin_name='Logstash'):
+    super(LogstashPlugin, self).__init__(parent_pipe, plugin_name)
     self._enabled = False
     self._logstash_bin = None
     self._logstash_config = None
-    self._nuocaCollectionName = None
     self._logstash_thread = None
     self._process_thread = None
     self._logstash_subprocess = None
-    self._logstash_sincedb_path = None
     self._logstash_options = None
-    self._line_counter = 0
     self._lines_processed = 0
-    self._local_hostname = socket.gethostname()
-    self._host_uuid_shortname = False
-    self._host_shortid = None
-    self._logstash_collect_queue = []
-
-  @property
-  def logstash_collect_queue(self):
-    return self._logstash_collect_queue
+    self._logstash_read_block_size = self.DEFAULT_READ_BLOCK_SIZE
 
   def _run_logstash_thread(self):
     self._logstash_subprocess = None
@@ -87,20 +86,18 @@ class LogstashPlugin(NuocaMPInputPlugin):
       return
 
     try:
+      self._logstash_reader = JsonLinesReader(
+          self._logstash_subprocess.stdout.fileno(),
+          self._logstash_read_block_size)
       while self._enabled:
-        json_object = None
-        line = self._logstash_subprocess.stdout.readline()
-        if line:
-          self._line_counter += 1
-          try:
-            json_object = json.loads(line)
-          except ValueError:
-            # These messages are typical log messages about logstash itself
-            # which are written to stdout.  Just write them to the nuoca.log
-            msg = "logstash message: %s" % line
-            nuoca_log(logging.INFO, msg)
+        json_objects = self._logstash_reader.read()
+        if json_objects is None:
+          nuoca_log(logging.WARNING, "logstash closed its stdout")
+          break
+        for json_object in json_objects:
           if json_object:
-            self._logstash_collect_queue.append(json_object)
+            self._logstash_collect_queue.put(json_object)
+        self._line_counter = self._logstash_reader.total_lines
       nuoca_log(logging.INFO,
         "Logstash plugin run_logstash_thread "
         "completed %s lines" % str(self._line_counter))
@@ -117,8 +114,6 @@ class LogstashPlugin(NuocaMPInputPlugin):
       nuoca_log(logging.ERROR, msg)
 
   def startup(self, config=None):
-    uuid_hostname_regex = \
-      '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-'
     try:
       self._config = config
 
@@ -144,36 +139,14 @@ class LogstashPlugin(NuocaMPInputPlugin):
         nuoca_log(logging.ERROR, msg)
         return False
 
-      if 'logstashSincedbPath' in config:
-        self._logstash_sincedb_path = \
-          os.path.expandvars(config['logstashSincedbPath'])
-      else:
-        if 'logstashInputFilePath' in config:
-          nuoca_log(logging.INFO, "Logstash Plugin Input File Path: %s" %
-                    str(config['logstashInputFilePath']))
-          hexdigest = hashlib.md5(config['logstashInputFilePath']).hexdigest()
-          self._logstash_sincedb_path = \
-            "%s/.sincedb_%s" % (os.environ['HOME'], hexdigest)
-
-      nuoca_log(logging.INFO, "Logstash Plugin sincedb_path: %s" %
-                str(self._logstash_sincedb_path))
-
       if 'logstashOptions' in config:
         logstash_options = os.path.expandvars(config['logstashOptions'])
         self._logstash_options = logstash_options.split(' ')
 
-      if 'nuocaCollectionName' in config:
-        self._nuocaCollectionName = config['nuocaCollectionName']
-
-      # For Coach hostnames in the format: uuid-shortId
-      if 'host_uuid_shortname' in config:
-        self._host_uuid_shortname = config['host_uuid_shortname']
-
-      if self._host_uuid_shortname:
-        m2 = re.search(uuid_hostname_regex, self._local_hostname)
-        if m2:
-          self._host_shortid = self._local_hostname[37:]
+      self._logstash_read_block_size = int(config.get(
+          'logstashReadBlockSize', self.DEFAULT_READ_BLOCK_SIZE))
 
+      self._configure_input(config)
       self._enabled = True
       self._logstash_thread = \
         threading.Thread(target=self._run_logstash_thread)
@@ -193,33 +166,3 @@ class LogstashPlugin(NuocaMPInputPlugin):
       self._logstash_subprocess = None
     if self._process_thread:
       self._process_thread.join()
-
-  def collect(self, collection_interval):
-    rval = None
-    try:
-      nuoca_log(logging.DEBUG,
-                "Called collect() in Logstash Plugin process")
-      base_values = super(LogstashPlugin, self).\
-        collect(collection_interval)
-      base_values['Hostname'] = self._local_hostname
-      if self._host_shortid:
-        base_values['HostShortID'] = self._host_shortid
-      if self._nuocaCollectionName:
-        base_values['nuocaCollectionName'] = self._nuocaCollectionName
-      rval = []
-      collection_count = len(self._logstash_collect_queue)
-      if not collection_count:
-        return rval
-
-      for i in range(collection_count):
-        collected_dict = self._logstash_collect_queue.pop(0)
-        collected_dict.update(base_values)
-        if 'timestamp' in collected_dict:
-          dt = date_parse(collected_dict['timestamp'])
-          epoch_seconds = timegm(dt.timetuple())
-          epoch_millis = epoch_seconds * 1000 + dt.microsecond / 1000
-          collected_dict['TimeStamp'] = epoch_millis
-        rval.append(collected_dict)
-    except Exception as e:
-      nuoca_log(logging.ERROR, str(e))
-    return rval
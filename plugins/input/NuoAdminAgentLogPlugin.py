@@ -0,0 +1,339 @@
+import datetime
+import logging
+import os
+import re
+import threading
+
+from nuoca_grok import GrokFilter, GrokLibrary, add_tag
+from nuoca_logtail import LogTailer, MultilineCodec
+from nuoca_util import nuoca_log, get_nuoca_topdir
+# The module, not its classes: Yapsy would load the first plugin class
+# that it finds here.
+import nuoca_logstash
+
+# NuoAdminAgentLog plugin
+#
+# Collects the events of a NuoDB Admin agent.log, without Logstash.  The
+# log file is followed, its multiline records are joined, and each record
+# is parsed into an event with the same fields as the Logstash config
+# etc/logstash/nuoadminagentlog.conf: message, timestamp, loglevel,
+# logger, thread, and the fields of each kind of agent message, such as
+# entity, action and node_state.
+#
+# NuoAdminAgentLog plugin configuration:
+#
+# - NuoAdminAgentLog:
+#    description : Collection from NuoDB Admin Agent logfile
+#    nuocaCollectionName: NuoAdminAgentLog
+#    logstashInputFilePath: full path to the agent.log.
+#      (optional, default /var/log/nuodb/agent.log)
+#    logstashSincedbPath: full path to the sincedb file, where the read
+#      position is kept between runs.  It has the Logstash format, so
+#      the position of an earlier Logstash based collection is kept.
+#      (optional, default: as in the Logstash plugin)
+#    startPosition: beginning or end: where to start reading a file that
+#      has no position in the sincedb. (optional, default beginning)
+#    pollInterval: seconds between checks for new lines.
+#      (optional, default 1)
+#    autoFlushInterval: seconds after which the last record of the file
+#      is complete. (optional, default 5)
+#    patternsDir: directory of the NuoDB grok pattern files.
+#      (optional, default etc/logstash/nuodb_patterns)
+#    host_uuid_shortname, collectQueueMaxDepth, collectQueueOverflowPolicy:
+#      as in the Logstash plugin.
+#
+# logstashBin, logstashConfig and logstashOptions are ignored.
+
+
+def _truthy(value):
+  # Logstash conditionals: only missing, null and false fields are false.
+  return value is not None and value is not False
+
+
+_SPRINTF_FIELD = re.compile(r'%\{([^}]+)\}')
+
+
+def _sprintf(event, template):
+  def field_value(match):
+    value = event.get(match.group(1))
+    if value is None:
+      return match.group()
+    return unicode(value)
+  return _SPRINTF_FIELD.sub(field_value, template)
+
+
+def _add_field(event, field, value):
+  # A field that is already set, even to null, becomes a list.
+  if field in event:
+    current = event[field]
+    if current is None:
+      current = []
+    elif not isinstance(current, list):
+      current = [current]
+    current.append(_sprintf(event, value))
+    event[field] = current
+  else:
+    event[field] = _sprintf(event, value)
+
+
+def _add_fields(event, fields):
+  for field, value in fields:
+    _add_field(event, field, value)
+
+
+class AgentLogParser(object):
+  """
+  The filters of etc/logstash/nuoadminagentlog.conf.
+  """
+  MESSAGE_PATTERNS = [
+      "%{TIMESTAMP_ISO8601:timestamp} %{LOGLEVEL:loglevel} "
+      "%{NOTSPACE:logger} %{NOTSPACE:thread} +%{GREEDYDATA:message}",
+      r"%{TIMESTAMP_ISO8601:timestamp} \[%{POSINT:engine_pid}\] "
+      "+%{GREEDYDATA:message}",
+      "%{TIMESTAMP_ISO8601:timestamp} %{LOGLEVEL:loglevel} "
+      "+%{GREEDYDATA:message}"]
+
+  LOGGER_PATTERNS = {
+      'Environment.logEnv': [
+          "NuoDB %{WORD:directory} directory: %{GREEDYDATA:value}",
+          "NuoAgent version: %{GREEDYDATA:version}",
+          "Java: %{GREEDYDATA:java_version}",
+          "Java VM: %{GREEDYDATA:java_vm}",
+          "Java Runtime: %{GREEDYDATA:java_runtime}",
+          "Java Home directory: %{GREEDYDATA:java_home}"],
+      'LocalServer.logNewRole': [
+          r"\[.*\] Converting to (?<action>LEADER) "
+          r"\(term=[0-9]+, index=[0-9]+\)( %{GREEDYDATA:comment})?",
+          r"\[.*\] Converting to (?<action>FOLLOWER) "
+          r"\(term=[0-9]+, index=[0-9]+\)( %{GREEDYDATA:comment})?",
+          r"\[.*\] Converting to (?<action>CANDIDATE) "
+          r"\(term=[0-9]+, index=[0-9]+\)"],
+      'PropertiesContainerImpl.logProps': [
+          "Property %{NOTSPACE:property}=%{GREEDYDATA:value}"],
+      'URLPropertiesProvider.<init>': [
+          ".*properties file: %{GREEDYDATA:propertyfile}"],
+      'PeerContainerImpl$LocalPeer.initStableId': [
+          "Initializing local peer.* uuid:%{UUID:stableid}"],
+      'PeerContainerImpl$LocalPeer.<init>': [
+          "local bind address=%{IPORHOST:bindhost}?/%{IPORHOST:bindaddr}?:"
+          "%{POSINT:bindport}, hostname=%{IPORHOST:bhostname}"],
+      'PeerService$EntryListener.handleMessage': [
+          r"Peering reply from \[%{IPORHOST:peerhost}?/"
+          r"%{IPORHOST:peeraddr}?:%{POSINT:peerport}, uuid:%{UUID:stableid}\] "
+          r"\(%{NUODB_AGENTTYPE:peertype}\)",
+          "License Allowed Hosts: %{POSINT}"],
+      'TagServer$DomainJoinedRunnable.run': [
+          "Region is: %{GREEDYDATA:region}"],
+      'EventManager.notifyPeerEvent': [
+          "%{NUODB_ENTITY:entity} %{NUODB_ACTIONS:action}: "
+          r"\[%{NUODB_PEER:peer_description}\]"],
+      'EventManager.notifyDomainEvent': [
+          "%{NUODB_ACTIONS:action} %{NUODB_ENTITY:entity}"],
+      'EventManager.notifyNodeEvent': [
+          "%{NUODB_ENTITY:entity} %{NUODB_ACTIONS:action}"
+          "%{GREEDYDATA:comment}?: %{NUODB_NODE:node_description}"],
+      'EventManager.notifyNodeIdSet': [
+          "%{NUODB_ENTITY:entity} %{NUODB_ACTIONS:action}="
+          "%{POSINT:newnodeid} %{NUODB_NODE:node_description}"],
+      'EventManager.notifyNodeStateChange': [
+          "%{NUODB_ENTITY:entity} %{NUODB_ACTIONS:action} changed to "
+          "%{WORD:node_state} %{NUODB_NODE:node_description}"],
+      'EventManager.notifyNodeFailure': [
+          "%{NUODB_ENTITY:entity} %{NUODB_ACTIONS:action} "
+          r"peer=\[%{NUODB_PEER}\] startId=\[%{NUMBER:startId}\]:"
+          "%{NUODB_GREEDYDATA:comment}",
+          "%{NUODB_ENTITY:entity} %{NUODB_ACTIONS:action} "
+          "%{NUODB_NODE:node_description}: %{NUODB_GREEDYDATA:comment}"],
+      'ProcessService$ProcessReaper.reapConnected': [
+          "%{WORD:action} process with pid %{NUODB_PID:node_pid} "
+          "and exit code %{NUMBER:exitcode}"],
+      'ProcessService.nodeLeft': [
+          "%{WORD:action} up pid.%{NUMBER:node_pid} "
+          "with exit code.%{NUMBER:exitcode}",
+          "Marking process with %{NUODB_ENTITY:entity} object "
+          "%{NUODB_NODE:node_description} for %{NUODB_ACTIONS:action}"],
+      'NuoAgent.logReady': [
+          "%{GREEDYDATA:comment}; agent is ready"],
+      'NuoAgent.shutdown': [
+          "%{GREEDYDATA:comment}"]}
+
+  PROCESS_LOGGERS = ('ProcessService$ProcessReaper.reapConnected',
+                     'ProcessService.nodeLeft')
+
+  NODE_ACTION_STATES = {'setId': 'STARTED', 'joined': 'STARTING',
+                        'left': 'EXITTED', 'failed': 'FAILED'}
+
+  def __init__(self, patterns_dir):
+    """
+    :param patterns_dir: Directory of the NuoDB grok pattern files.
+    :type patterns_dir: ``str``
+    """
+    library = GrokLibrary()
+    library.add_patterns_from_dir(patterns_dir)
+    self._record_start = library.compile("%{TIMESTAMP_ISO8601} ").regex
+    self._message_grok = GrokFilter(library, self.MESSAGE_PATTERNS,
+                                    overwrite=['message'])
+    self._logger_groks = dict(
+        [(logger, GrokFilter(library, patterns, keep_empty_captures=True))
+         for logger, patterns in self.LOGGER_PATTERNS.iteritems()])
+
+  @property
+  def record_start(self):
+    """
+    :return: Regular expression that the first line of a record contains.
+    """
+    return self._record_start
+
+  def parse(self, event):
+    """
+    :param event: Event with the record in its 'message'.  It is updated
+      with the fields of the record.
+    :type event: ``dict``
+    """
+    self._message_grok.apply(event)
+    message = event.get('message')
+    if isinstance(message, basestring):
+      event['message'] = message.strip()
+    if not _truthy(event.get('logger')):
+      event['logger'] = None
+    logger = event['logger']
+
+    logger_grok = self._logger_groks.get(logger)
+    if logger_grok:
+      logger_grok.apply(event)
+
+    if logger == 'Environment.logEnv' and _truthy(event.get('version')):
+      _add_fields(event, [('entity', 'Peer'), ('action', 'Joined'),
+                          ('node_state', 'STARTING'),
+                          ('comment', '%{version}')])
+
+    elif logger == 'PeerService$EntryListener.handleMessage' and \
+        _truthy(event.get('stableid')):
+      _add_fields(event, [('iporaddr', '%{peeraddr}'),
+                          ('port', '%{peerport}')])
+
+    elif logger in self.PROCESS_LOGGERS:
+      if _truthy(event.get('action')) and _truthy(event.get('exitcode')):
+        _add_field(event, 'comment', 'exit code %{exitcode}')
+      if _truthy(event.get('action')):
+        event['entity'] = 'Node'
+        event['node_state'] = 'FINISHED'
+        if isinstance(event.get('node_pid'), basestring):
+          event['node_pid'] = event['node_pid'].replace(',', '')
+
+    elif logger == 'NuoAgent.logReady':
+      _add_fields(event, [('entity', 'Peer'), ('action', 'State'),
+                          ('node_state', 'STARTED')])
+
+    elif logger == 'NuoAgent.shutdown':
+      _add_fields(event, [('entity', 'Peer'), ('action', 'Left'),
+                          ('node_state', 'EXITTED')])
+
+    if event.get('entity') == 'Node':
+      action = event.get('action')
+      if isinstance(action, basestring) and \
+          action in self.NODE_ACTION_STATES:
+        _add_field(event, 'node_state', self.NODE_ACTION_STATES[action])
+      if _truthy(event.get('observed')) and 'action' in event:
+        event['action'] = _sprintf(event, '%{action}/%{observed}')
+    return event
+
+
+class NuoAdminAgentLogPlugin(nuoca_logstash.LogstashInputPlugin):
+  DEFAULT_INPUT_FILE_PATH = '/var/log/nuodb/agent.log'
+  DEFAULT_POLL_INTERVAL = 1.0
+  DEFAULT_AUTO_FLUSH_INTERVAL = 5.0
+
+  def __init__(self, parent_pipe):
+    super(NuoAdminAgentLogPlugin, self).__init__(parent_pipe,
+                                                 'NuoAdminAgentLog')
+    self._input_file_path = self.DEFAULT_INPUT_FILE_PATH
+    self._poll_interval = self.DEFAULT_POLL_INTERVAL
+    self._parser = None
+    self._tailer = None
+    self._codec = None
+    self._stop_tailing = threading.Event()
+    self._tail_thread = None
+
+  def new_event(self, message, tags):
+    """
+    :return: The event of one record, before parsing, with the fields
+      that the Logstash file input sets.
+    :type: ``dict``
+    """
+    now = datetime.datetime.utcnow()
+    event = {'message': message.decode('utf-8', 'replace'),
+             '@version': '1',
+             '@timestamp': now.strftime('%Y-%m-%dT%H:%M:%S.') +
+             '%03dZ' % (now.microsecond / 1000),
+             'path': self._input_file_path,
+             'host': self._local_hostname}
+    for tag in tags:
+      add_tag(event, tag)
+    return event
+
+  def _queue_records(self, records):
+    for message, tags in records:
+      self._line_counter += 1
+      event = self.new_event(message, tags)
+      try:
+        self._parser.parse(event)
+      except Exception as e:
+        nuoca_log(logging.ERROR, "NuoAdminAgentLog plugin: %s: %s"
+                  % (str(e), message))
+        continue
+      self._logstash_collect_queue.put(event)
+
+  def _run_tail_thread(self):
+    try:
+      while not self._stop_tailing.is_set():
+        self._queue_records(self._codec.decode(self._tailer.read_lines()))
+        self._stop_tailing.wait(self._poll_interval)
+      self._queue_records(self._codec.decode(self._tailer.read_lines()))
+      self._queue_records(self._codec.flush())
+    except Exception as e:
+      nuoca_log(logging.ERROR, "NuoAdminAgentLog plugin tail thread: %s"
+                % str(e))
+    nuoca_log(logging.INFO, "NuoAdminAgentLog plugin tail thread "
+              "completed %d records" % self._line_counter)
+
+  def startup(self, config=None):
+    try:
+      self._config = config or {}
+      nuoca_log(logging.INFO, "NuoAdminAgentLog plugin config: %s" %
+                str(self._config))
+      self._input_file_path = os.path.expandvars(self._config.get(
+          'logstashInputFilePath', self.DEFAULT_INPUT_FILE_PATH))
+      self._poll_interval = float(self._config.get(
+          'pollInterval', self.DEFAULT_POLL_INTERVAL))
+      self._configure_input(self._config)
+
+      patterns_dir = os.path.expandvars(self._config.get(
+          'patternsDir', os.path.join(get_nuoca_topdir(),
+                                      'etc/logstash/nuodb_patterns')))
+      self._parser = AgentLogParser(patterns_dir)
+      self._codec = MultilineCodec(
+          self._parser.record_start,
+          float(self._config.get('autoFlushInterval',
+                                 self.DEFAULT_AUTO_FLUSH_INTERVAL)))
+      self._tailer = LogTailer(
+          self._input_file_path, self._logstash_sincedb_path,
+          self._config.get('startPosition', 'beginning'))
+
+      self._stop_tailing.clear()
+      self._tail_thread = threading.Thread(target=self._run_tail_thread)
+      self._tail_thread.daemon = True
+      self._tail_thread.start()
+      return True
+    except Exception as e:
+      nuoca_log(logging.ERROR, "NuoAdminAgentLog plugin: %s" % str(e))
+      return False
+
+  def shutdown(self):
+    self._stop_tailing.set()
+    if self._tail_thread:
+      self._tail_thread.join()
+      self._tail_thread = None
+    if self._tailer:
+      self._tailer.close()
+      self._tailer = None
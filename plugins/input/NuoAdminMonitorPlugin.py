@@ -19,6 +19,8 @@ from requests.auth import HTTPBasicAuth
 #    domain_password: bird
 #    admin_collect_interval: 10
 #    admin_collect_timeout: 1
+#    collectQueueMaxDepth: 100000
+#    collectQueueOverflowPolicy: drop_oldest
 
 class NuoAdminMonitorPlugin(NuocaMPInputPlugin):
   def __init__(self, parent_pipe):
@@ -42,7 +44,7 @@ class NuoAdminMonitorPlugin(NuocaMPInputPlugin):
     self._admin_collect_interval = 10
     self._admin_collect_timeout = 1
     self._admin_collect_sync = None
-    self._monitor_collect_queue = []
+    self._monitor_collect_queue = self.new_collect_queue()
 
   @property
   def monitor_collect_queue(self):
@@ -101,14 +103,14 @@ class NuoAdminMonitorPlugin(NuocaMPInputPlugin):
       results = {"TimeStamp": collect_timestamp}
       results['nuoca_collection_error'] = \
         enforcer_result['nuoca_collection_error']
-      self._monitor_collect_queue.append(results)
+      self._monitor_collect_queue.put(results)
     regions_result = self.get_regions()
     #print "Result from Rest API %s: %s" % (self._regions_url, regions_result)
     if 'nuoca_collection_error' in regions_result:
       results = {"TimeStamp": collect_timestamp}
       results['nuoca_collection_error'] = \
         regions_result['nuoca_collection_error']
-      self._monitor_collect_queue.append(results)
+      self._monitor_collect_queue.put(results)
     else:
       region_count = 0
       for region in regions_result:
@@ -128,14 +130,14 @@ class NuoAdminMonitorPlugin(NuocaMPInputPlugin):
               process_results["process.%s" % process_field] \
                 = process[process_field]
             process_results.update(results)
-            self._monitor_collect_queue.append(process_results)
+            self._monitor_collect_queue.put(process_results)
         for database in region['databases']:
           database_results = {}
           for database_field in databases_desired_fields:
             database_results["database.%s" % database_field] = \
               str(database[database_field])
           database_results.update(results)
-          self._monitor_collect_queue.append(database_results)
+          self._monitor_collect_queue.put(database_results)
         region_count += 1
 
   def _timer_thread(self):
@@ -190,6 +192,7 @@ class NuoAdminMonitorPlugin(NuocaMPInputPlugin):
       self._admin_collect_sync = IntervalSync(self._admin_collect_interval,
                                               seed_ts=nuoca_start_ts)
 
+      self._monitor_collect_queue = self.new_collect_queue(config)
       self._enabled = True
       self._timer_thrd = threading.Thread(target=self._timer_thread)
       self._timer_thrd.daemon = True
@@ -208,14 +211,12 @@ class NuoAdminMonitorPlugin(NuocaMPInputPlugin):
     try:
       nuoca_log(logging.DEBUG, "Called collect() in NuoAdminMonitor Plugin process")
       base_values = super(NuoAdminMonitorPlugin, self).collect(collection_interval)
-      collection_count = len(self.monitor_collect_queue)
-      if not collection_count:
+      collected_dicts = self.monitor_collect_queue.drain()
+      self.record_collect_queue_metrics(self.monitor_collect_queue)
+      if not collected_dicts:
         return rval
 
-      rval = []
-      for i in range(collection_count):
-        collected_dict = self.monitor_collect_queue.pop(0)
-        rval.append(collected_dict)
+      rval = collected_dicts
     except Exception as e:
       nuoca_log(logging.ERROR, str(e))
     return rval
@@ -2,7 +2,6 @@ import logging
 import os
 import re
 import threading
-import time
 
 from copy import deepcopy
 from nuoca_plugin import NuocaMPInputPlugin
@@ -20,6 +19,8 @@ from nuomon.nuomon_broadcast import MetricsConsumer, MetricsProducer
 #    broker: 172.19.0.16
 #    domain_username: domain
 #    domain_password: bird
+#    collectQueueMaxDepth: 100000
+#    collectQueueOverflowPolicy: drop_oldest
 
 
 class NuoMonHandler(MetricsConsumer):
@@ -36,7 +37,7 @@ class NuoMonHandler(MetricsConsumer):
     pass
 
   def onValues(self, values):
-    self.nuo_monitor_obj.nuomonitor_collect_queue.append(deepcopy(values))
+    self.nuo_monitor_obj.nuomonitor_collect_queue.put(deepcopy(values))
     pass
 
 
@@ -46,14 +47,14 @@ class NuoMonitorPlugin(NuocaMPInputPlugin):
     self._config = None
     self._broker = None
     self._enabled = False
-    self._numon_handler_ready = False
+    self._numon_handler_ready = threading.Event()
     self._domain_username = 'domain'
     self._domain_password = 'bird'
     self._domain_metrics = None
     self._database_regex_pattern = '.*'
     self._host_uuid_shortname = False
     self._thread = None
-    self._nuomonitor_collect_queue = []
+    self._nuomonitor_collect_queue = self.new_collect_queue()
 
   @property
   def nuomonitor_collect_queue(self):
@@ -62,7 +63,7 @@ class NuoMonitorPlugin(NuocaMPInputPlugin):
   def _nuomon_handler_thread(self):
     obj = NuoMonHandler(self)
     obj.start()
-    self._numon_handler_ready = True
+    self._numon_handler_ready.set()
     self._domain_metrics.wait_forever()
 
   def startup(self, config=None):
@@ -88,6 +89,7 @@ class NuoMonitorPlugin(NuocaMPInputPlugin):
         self._database_regex_pattern = config['database_regex_pattern']
       if 'host_uuid_shortname' in config:
         self._host_uuid_shortname = config['host_uuid_shortname']
+      self._nuomonitor_collect_queue = self.new_collect_queue(config)
       self._enabled = True
       self._domain_metrics = \
         get_nuodb_metrics(
@@ -98,11 +100,8 @@ class NuoMonitorPlugin(NuocaMPInputPlugin):
       self._thread = threading.Thread(target=self._nuomon_handler_thread)
       self._thread.daemon = True
       self._thread.start()
-      try_count = 0
-      while not self._numon_handler_ready and try_count < 5:
-        try_count += 1
-        time.sleep(1)
-      return self._numon_handler_ready
+      # Return as soon as the handler is ready, waiting at most 5 seconds.
+      return self._numon_handler_ready.wait(5)
     except Exception as e:
       nuoca_log(logging.ERROR, "NuoMon Plugin: %s" % str(e))
       return False
@@ -118,13 +117,13 @@ class NuoMonitorPlugin(NuocaMPInputPlugin):
     try:
       nuoca_log(logging.DEBUG, "Called collect() in NuoMonitor Plugin process")
       base_values = super(NuoMonitorPlugin, self).collect(collection_interval)
-      collection_count = len(self._nuomonitor_collect_queue)
-      if not collection_count:
+      collected_dicts = self._nuomonitor_collect_queue.drain()
+      self.record_collect_queue_metrics(self._nuomonitor_collect_queue)
+      if not collected_dicts:
         return rval
 
       rval = []
-      for i in range(collection_count):
-        collected_dict = self._nuomonitor_collect_queue.pop(0)
+      for collected_dict in collected_dicts:
         m = re.search(self._database_regex_pattern, collected_dict['Database'])
         if m:
           if self._host_uuid_shortname:
@@ -39,7 +39,7 @@ class OLTPBenchPlugin(NuocaMPInputPlugin):
 printf $(grep 'Throughput: ' {} | tail -1 | sed 's/.*Throughput: //; s/ Tps//')\\\"; \
 printf ' latency_average=\"'; \
 printf $(grep 'Latency Average: ' {} | tail -1 | sed 's/.*Latency Average: //; s/ ms//')\\\";".format(full_logpath, full_logpath)
-    nuoca_log(logging.DEBUG, "Running command: %s" % (format(cmd)))
+    nuoca_log(logging.DEBUG, "Running command: %s", cmd)
     try:
         output = subprocess.check_output(
             cmd, stderr=subprocess.STDOUT, shell=True)
@@ -47,7 +47,7 @@ printf $(grep 'Latency Average: ' {} | tail -1 | sed 's/.*Latency Average: //; s
         nuoca_log(logging.ERROR, "run_parser ERROR: RC: %d, ERR: %s" %
                   (e.returncode, e.output))
         return None
-    nuoca_log(logging.DEBUG, "Parser output: %s" % (format(output)))
+    nuoca_log(logging.DEBUG, "Parser output: %s", output)
     self._metrics_dict = dict(re.findall(r'(\w+)="([^"]+)"', output))
     if self._metrics_dict["tps"] == self._last_tps:
       self._metrics_dict["tps"] = None
@@ -1,21 +1,35 @@
 import logging
 import re
+import threading
 
 from nuoca_plugin import NuocaMPInputPlugin
-from nuoca_util import nuoca_log, search_running_processes, \
-    execute_command, coerce_numeric
+from nuoca_util import nuoca_log, nuoca_monotonic, execute_command, \
+    coerce_numeric
+from nuoca_zabbix import ZBX_NOTSUPPORTED, ZabbixAgentClient, \
+    ZabbixKeyCache
 
 # Zabbix plugin
 #
-# This plugin expects that a zabbix agent is running on the localhost and
-# zabbix_get is installed on the localhost.  The 'ZBX' section of the NuoCA
-# config is used to control this Zabbix plugin.  The system metrics collected
-# by zabbix is controlled by the 'keys' section.  The key names are in the
+# This plugin expects that a zabbix agent is running on the 'server' host
+# and accepts passive checks from NuoCA on 'port' (default 10050).  The
+# values are fetched with the Zabbix agent protocol; zabbix_get is not
+# needed.  The 'ZBX' section of the NuoCA config is used to control this
+# Zabbix plugin.  The system metrics collected by zabbix is controlled by
+# the 'keys' section.  The key names are in the
 # Zabbix key name format.  The 'autoDiscoverMonitors' boolean is used to
 # automatically include file system mounts, devices, and network interfaces in
-# the collected 'keys'.  The loading of 'autoDiscoverMonitors' only happens
-# when this plugin is initialized.  Dynamic changes to file system mounts,
-# devices, or network interfaces will require reloading this plugin.
+# the collected 'keys'.  They are discovered when this plugin is
+# initialized, and again every 'discoveryInterval' seconds (default 3600).
+# Auto discovery looks at the NuoCA host, so use it with a local agent.
+# The keys are fetched concurrently, on up to 'maxConnections' (default 16)
+# connections.  The optional 'keyTimeout' is the maximum seconds to wait
+# for each key (default 3).
+#
+# A key that the agent does not support, or that fails, is suspended for
+# 'suspendInterval' seconds (default 600), and then probed again in the
+# background.  Keys whose values rarely change, such as system.uname, are
+# fetched once and then every 'staticRefreshInterval' seconds (default
+# 3600).  'staticKeys' adds keys to ZabbixKeyCache.DEFAULT_STATIC_KEYS.
 #
 # This was developed and tested using Zabbix 2.2.11-1 on Ubuntu.
 #
@@ -24,7 +38,12 @@ from nuoca_util import nuoca_log, search_running_processes, \
 # - ZBX:
 #    description : Collect machine stats from Zabbix
 #    server: localhost
+#    port: 10050
 #    autoDiscoverMonitors: true
+#    keyTimeout: 3
+#    suspendInterval: 600
+#    staticRefreshInterval: 3600
+#    discoveryInterval: 3600
 #    keys:
 #    - system.uptime
 #    - system.cpu.intr
@@ -51,13 +70,45 @@ from nuoca_util import nuoca_log, search_running_processes, \
 
 
 class ZabbixPlugin(NuocaMPInputPlugin):
+  DEFAULT_PORT = 10050
+  DEFAULT_MAX_CONNECTIONS = 16
+  DEFAULT_KEY_TIMEOUT = 3
+  DEFAULT_SUSPEND_INTERVAL = 600
+  DEFAULT_STATIC_REFRESH_INTERVAL = 3600
+  DEFAULT_DISCOVERY_INTERVAL = 3600
+
   def __init__(self, parent_pipe):
     super(ZabbixPlugin, self).__init__(parent_pipe, 'ZBX')
     self._config = None
-
-  def _append_config_key(self, key):
-    nuoca_log(logging.INFO, "ZBX plugin appending config key: %s" % key)
-    self._config['keys'].append(key)
+    self._client = None
+    self._key_cache = None
+    self._discovered_keys = []
+    self._discovery_interval = self.DEFAULT_DISCOVERY_INTERVAL
+    self._discovery_time = None
+    self._probe_thread = None
+
+  def _new_client(self):
+    config = self._config
+    return ZabbixAgentClient(
+        config['server'], int(config.get('port', self.DEFAULT_PORT)),
+        int(config.get('maxConnections', self.DEFAULT_MAX_CONNECTIONS)),
+        float(config.get('keyTimeout', self.DEFAULT_KEY_TIMEOUT)))
+
+  def _get_keys(self):
+    return self._config['keys'] + [x for x in self._discovered_keys
+                                   if x not in self._config['keys']]
+
+  def _rediscover_monitors(self):
+    """
+    Discover the device, mount and interface keys, and log the changes.
+    """
+    keys = self._auto_discover_monitors()
+    for key in sorted(set(keys) - set(self._discovered_keys)):
+      nuoca_log(logging.INFO, "ZBX plugin discovered key: %s" % key)
+    for key in sorted(set(self._discovered_keys) - set(keys)):
+      nuoca_log(logging.INFO, "ZBX plugin removed key: %s" % key)
+    self._discovered_keys = keys
+    self._discovery_time = nuoca_monotonic()
 
   def _auto_discover_monitors(self):
     devices = []
@@ -65,52 +116,61 @@ class ZabbixPlugin(NuocaMPInputPlugin):
     interfaces = []
 
     # discover file system mounts & devices
-    for line in execute_command("mount")[1].split("\n"):
+    mount_output = execute_command("mount")[1]
+    for line in mount_output.split("\n"):
       fields = line.strip().split()
       if len(fields) > 0 and fields[0].startswith("/dev"):
         devices.append(fields[0].strip())
         mounts.append(fields[2].strip())
 
     # discover network interfaces
-    for line in execute_command("ip a")[1].split("\n"):
+    ip_output = execute_command("ip a")[1]
+    for line in ip_output.split("\n"):
       if re.match("^[0-9]+:", line):
         fields = line.strip().split()
         interfaces.append(fields[1][0:-1])
 
+    keys = []
     for device in devices:
       for op in ["read", "write"]:
-        self._append_config_key("vfs.dev.%s[%s]" % (op, device))
+        keys.append("vfs.dev.%s[%s]" % (op, device))
     for mount in mounts:
       for op in ["used", "free"]:
-        self._append_config_key("vfs.fs.size[%s,%s]" % (mount, op))
+        keys.append("vfs.fs.size[%s,%s]" % (mount, op))
     for interface in interfaces:
       for op in ["in", "out"]:
-        self._append_config_key("net.if.%s[%s]" % (op, interface))
+        keys.append("net.if.%s[%s]" % (op, interface))
+    return keys
 
   def startup(self, config=None):
     try:
       self._config = config
 
-      # Make sure that zabbix agent is running.
-      zabbix_agentd = search_running_processes('zabbix_agentd')
-      if not zabbix_agentd:
-        nuoca_log(logging.ERROR, "Zabbix agent daemon is not running.")
-        return False
-
-      # Make sure that zabbix_get is installed.
-      command = "which zabbix_get"
-      (exit_code, stdout, stderr) = execute_command(command)
-      if exit_code != 0 or 'zabbix_get' not in stdout:
-        nuoca_log(logging.ERROR, "Cannot locate zabbix_get command.")
-        return False
-
       # Validate the configuration.
       required_config_items = ['autoDiscoverMonitors', 'server', 'keys']
       if not self.has_required_config_items(config, required_config_items):
         return False
 
+      self._client = self._new_client()
+      self._key_cache = ZabbixKeyCache(
+          float(config.get('suspendInterval',
+                           self.DEFAULT_SUSPEND_INTERVAL)),
+          ZabbixKeyCache.DEFAULT_STATIC_KEYS +
+          tuple(config.get('staticKeys', [])),
+          float(config.get('staticRefreshInterval',
+                           self.DEFAULT_STATIC_REFRESH_INTERVAL)))
+      self._discovery_interval = float(config.get(
+          'discoveryInterval', self.DEFAULT_DISCOVERY_INTERVAL))
+
+      # Make sure that zabbix agent is running.
+      (value, error) = self._client.get_value('agent.ping')
+      if value != '1':
+        nuoca_log(logging.ERROR, "Zabbix agent on %s:%d is not available: "
+                  "%s" % (self._client.host, self._client.port, error))
+        return False
+
       if config['autoDiscoverMonitors']:
-        self._auto_discover_monitors()
+        self._rediscover_monitors()
 
       nuoca_log(logging.INFO, "ZBX plugin config: %s" %
                 str(self._config))
@@ -121,22 +181,57 @@ class ZabbixPlugin(NuocaMPInputPlugin):
       return False
 
   def shutdown(self):
-    pass
+    if self._probe_thread:
+      self._probe_thread.join()
+      self._probe_thread = None
+
+  def _probe_keys(self, keys):
+    """
+    Probe suspended keys, in the background.
+    """
+    try:
+      (values, errors) = self._new_client().get_values(keys)
+      self._key_cache.update(keys, values, errors, probe=True)
+    except Exception as e:
+      nuoca_log(logging.ERROR, "ZBX plugin probe failed: %s" % str(e))
+      self._key_cache.update(keys, {}, {})
+
+  def _start_probe(self, keys):
+    if self._probe_thread and self._probe_thread.is_alive():
+      return
+    probe_keys = self._key_cache.keys_to_probe(keys)
+    if not probe_keys:
+      return
+    self._probe_thread = threading.Thread(target=self._probe_keys,
+                                          args=(probe_keys,),
+                                          name='ZabbixKeyProbe')
+    self._probe_thread.daemon = True
+    self._probe_thread.start()
 
   def collect(self, collection_interval):
     rval = []
     collected_values = super(ZabbixPlugin, self).collect(collection_interval)
     try:
-      for key in self._config['keys']:
-        command = "zabbix_get -s localhost -k %s" % key
-        (exit_code, stdout, stderr) = execute_command(command)
-        if exit_code != 0:
-          nuoca_log(logging.ERROR, "Problem with zabbix_get command.")
-          return False
-        if stdout.strip() is 'ZBX_NOTSUPPORTED':
-          nuoca_log(logging.WARNING,
-                    "zabbix_get on key '%s' returned ZBX_NOTSUPPORTED" % key)
-        collected_values[key] = coerce_numeric(stdout.strip())
+      if self._config['autoDiscoverMonitors'] and \
+          nuoca_monotonic() - self._discovery_time >= \
+          self._discovery_interval:
+        self._rediscover_monitors()
+      keys = self._get_keys()
+      fetch_keys = self._key_cache.keys_to_fetch(keys)
+      (values, errors) = self._client.get_values(fetch_keys)
+      self._key_cache.update(fetch_keys, values, errors)
+      values.update(self._key_cache.get_static_values(keys))
+      for key in keys:
+        if key not in values:
+          if key in fetch_keys and not self._key_cache.is_suspended(key):
+            nuoca_log(logging.ERROR, "ZBX plugin cannot get key '%s': %s"
+                      % (key, errors.get(key)))
+          continue
+        value = values[key].strip()
+        if value == ZBX_NOTSUPPORTED:
+          continue
+        collected_values[key] = coerce_numeric(value)
+      self._start_probe(keys)
       rval.append(collected_values)
     except Exception as e:
       nuoca_log(logging.ERROR, str(e))
@@ -1,10 +1,15 @@
+import itertools
 import logging
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 from nuoca_plugin import NuocaMPOutputPlugin
+from nuoca_spool import PartialStoreError
 from nuoca_util import nuoca_log
 
 
 class ElasticSearchPlugin(NuocaMPOutputPlugin):
+  # Bulk statuses of documents that may be indexed when they are sent again.
+  RETRY_STATUSES = (429, 502, 503, 504)
+
   def __init__(self, parent_pipe, config=None):
     super(ElasticSearchPlugin, self).__init__(parent_pipe, 'ElasticSearch')
     self._config = config
@@ -37,7 +42,51 @@ class ElasticSearchPlugin(NuocaMPOutputPlugin):
       rval = super(ElasticSearchPlugin, self).store(ts_values)
       req_resp = self.es_obj.index(index=self._config['INDEX'],
                                    doc_type='nuoca', body=ts_values)
-      nuoca_log(logging.DEBUG, "ElasticSearch response: %s" % str(req_resp))
+      nuoca_log(logging.DEBUG, "ElasticSearch response: %s", req_resp)
+    except Exception as e:
+      nuoca_log(logging.ERROR, str(e))
+      # A configured spool keeps the values.
+      if self.spooling:
+        raise
+    return rval
+
+  def store_batch(self, ts_values):
+    rval = None
+    nuoca_log(logging.DEBUG,
+              "Called store_batch() in MPElasticSearch process")
+    actions = [{'_index': self._config['INDEX'],
+                '_type': 'nuoca',
+                '_source': ts_value} for ts_value in ts_values]
+    unstored = []
+    indexed_count = 0
+    handled_count = 0
+    try:
+      # The results are in the order of the actions.
+      for ts_value, (ok, item) in itertools.izip(
+          ts_values, helpers.streaming_bulk(self.es_obj, actions,
+                                            raise_on_error=False)):
+        handled_count += 1
+        if ok:
+          indexed_count += 1
+          continue
+        result = item.values()[0]
+        if result.get('status') in self.RETRY_STATUSES:
+          unstored.append(ts_value)
+        else:
+          nuoca_log(logging.ERROR, "ElasticSearch bulk error: %s" %
+                    str(result.get('error')))
     except Exception as e:
       nuoca_log(logging.ERROR, str(e))
+      # A configured spool keeps the values that were not indexed.
+      if self.spooling:
+        raise PartialStoreError(str(e),
+                                unstored + ts_values[handled_count:])
+      return rval
+    nuoca_log(logging.DEBUG, "ElasticSearch bulk indexed: %d",
+              indexed_count)
+    if unstored:
+      msg = "ElasticSearch did not index %d documents" % len(unstored)
+      if self.spooling:
+        raise PartialStoreError(msg, unstored)
+      nuoca_log(logging.ERROR, msg)
     return rval
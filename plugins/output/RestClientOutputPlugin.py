@@ -30,7 +30,12 @@ class RestClientOutputPlugin(NuocaMPOutputPlugin):
       nuoca_log(logging.DEBUG,
                 "Called store() in MPClientOutputPlugin process")
       rval = super(RestClientOutputPlugin, self).store(ts_values)
-      requests.post(self._config["url"], json=json.dumps(ts_values))
+      response = requests.post(self._config["url"],
+                               json=json.dumps(ts_values))
+      response.raise_for_status()
     except Exception as e:
       nuoca_log(logging.ERROR, str(e))
+      # A configured spool keeps the values.
+      if self.spooling:
+        raise
     return rval
@@ -1,20 +1,30 @@
 import click
+import threading
 import traceback
 from nuoca_util import *
-from yapsy.MultiprocessPluginManager import MultiprocessPluginManager
 from nuoca_plugin import NuocaMPInputPlugin, NuocaMPOutputPlugin, \
     NuocaMPTransformPlugin
+from nuoca_batch import BatchEncoder, PrefixingBatchDecoder
 from nuoca_config import NuocaConfig
+from nuoca_dispatcher import OutputDispatcher
+from nuoca_metrics import LatencyTracker, NuocaMetrics
+from nuoca_supervisor import PluginSupervisor
+from nuoca_plugin_manager import NuocaPluginManager, PLUGIN_HOSTS, \
+    PLUGIN_TRANSPORTS
+from nuoca_transform import NuocaTransform, BUILTIN_TRANSFORMS
 
 
 class NuoCA(object):
   """
   NuoDB Collection Agent
   """
+  # Name of the built-in input that emits NuoCA's own metrics.
+  METRICS_INPUT_NAME = 'NuoCA'
+
   def __init__(self, config_file=None, collection_interval=30,
                plugin_dir=None, starttime=None, verbose=False,
                self_test=False, log_level=logging.INFO,
-               output_values=None):
+               output_values=None, max_speed=False):
     """
     :param config_file: Path to NuoCA configuration file.
     :type config_file: ``str``
@@ -39,7 +49,16 @@ class NuoCA(object):
 
     :param output_values: list of strings parsable by utils.parse_keyval_list()
     :type output_values: `list` of `str`
+
+    :param max_speed: Run the collection intervals back to back on a
+      VirtualClock, to measure the maximum collection cycle rate.  The
+      output queue policy is then block, so that the rate includes the
+      output plugins and no collection cycle is dropped.
+    :type max_speed: ``bool``
     """
+    self._max_speed = max_speed
+    if max_speed:
+      set_nuoca_clock(VirtualClock())
 
     self._starttime = starttime
     if self._starttime:
@@ -52,11 +71,15 @@ class NuoCA(object):
 
     self._config = NuocaConfig(config_file)
 
-    initialize_logger(self._config.NUOCA_LOGFILE)
+    initialize_logger(self._config.NUOCA_LOGFILE,
+                      self._config.LOG_FLUSH_INTERVAL,
+                      self._config.LOG_FLUSH_RECORDS)
 
     nuoca_set_log_level(log_level)
     nuoca_log(logging.INFO, "nuoca server init.")
     self._collection_interval = collection_interval
+    # Input plugins with their own 'nuocaCollectionInterval'
+    self._input_intervals = self._get_input_intervals()
     if not starttime:
       self._starttime = None
     else:
@@ -77,6 +100,64 @@ class NuoCA(object):
     self._input_plugins = {}
     self._output_plugins = {}
     self._transform_plugins = {}
+    self.manager = None
+
+    # Input plugins send their collected values as CollectedBatch objects,
+    # with one decoder per input plugin.  Each output plugin has its own
+    # encoder, which is replaced when the plugin (re)starts.
+    self._input_decoders = {}
+    self._output_encoders = {}
+
+    # The pipes of the output and transform plugins are used on the
+    # dispatcher thread, so those plugins are restarted there too.  The
+    # collection thread queues their names here.
+    self._dispatcher_restarts = set()
+    self._dispatcher_restarts_lock = threading.Lock()
+
+    # NuoCA's own metrics.  They are emitted as time-series values when
+    # the built-in 'NuoCA' input is configured.
+    self._metrics = NuocaMetrics()
+    self._emit_metrics = False
+
+    # Quarantines plugins that hang, exit or fail to start, and tells
+    # the collection loop when to restart them.
+    self._supervisor = PluginSupervisor(
+        self._config.PLUGIN_MAX_FAILURES,
+        self._config.PLUGIN_RESTART_BACKOFF,
+        self._config.PLUGIN_RESTART_MAX_BACKOFF)
+
+    # Learned response timeouts by plugin and action.
+    self._latency_tracker = None
+    if self._config.PLUGIN_ADAPTIVE_TIMEOUT:
+      max_timeout = self._config.PLUGIN_MAX_TIMEOUT
+      if max_timeout is None:
+        max_timeout = self._config.PLUGIN_PIPE_TIMEOUT
+      self._latency_tracker = LatencyTracker(
+          self._config.PLUGIN_MIN_TIMEOUT, max_timeout)
+
+    # Transforms in the order they are applied.  Each is either a built-in
+    # NuocaTransform or a Yapsy transform plugin.
+    self._transform_chain = []
+
+    if self._config.SCHEDULE_OVERRUN_POLICY not in \
+        IntervalScheduler.OVERRUN_POLICIES:
+      raise AttributeError("Unknown SCHEDULE_OVERRUN_POLICY: %s"
+                           % self._config.SCHEDULE_OVERRUN_POLICY)
+
+    # Collection cycles are delivered to the output plugins on a separate
+    # thread, so that slow output plugins cannot delay collection.
+    output_queue_policy = self._config.OUTPUT_QUEUE_POLICY
+    if max_speed and output_queue_policy != OutputDispatcher.BLOCK:
+      nuoca_log(logging.INFO, "max speed: OUTPUT_QUEUE_POLICY %s is "
+                "replaced by block" % output_queue_policy)
+      output_queue_policy = OutputDispatcher.BLOCK
+    spill_dir = None
+    if output_queue_policy == OutputDispatcher.SPILL:
+      spill_dir = os.path.join(self._config.NUOCA_TMPDIR, 'spill')
+    self._dispatcher = OutputDispatcher(self._transform_and_store,
+                                        self._config.OUTPUT_QUEUE_SIZE,
+                                        output_queue_policy,
+                                        spill_dir)
 
     if not self._plugin_topdir:
       self._plugin_topdir = os.path.join(get_nuoca_topdir(),
@@ -93,27 +174,178 @@ class NuoCA(object):
   def config(self):
     return self._config
 
-  def _collection_cycle(self, collection_time):
+  @property
+  def dispatcher(self):
+    return self._dispatcher
+
+  @property
+  def metrics(self):
+    return self._metrics
+
+  @property
+  def supervisor(self):
+    return self._supervisor
+
+  def _get_input_intervals(self):
+    """
+    Get the 'nuocaCollectionInterval' of each input plugin that sets one.
+    :return: Collection interval in seconds by plugin name.
+    :type: ``dict``
+    """
+    input_intervals = {}
+    for input_plugin in self.config.INPUT_PLUGINS:
+      input_plugin_name = input_plugin.keys()[0]
+      input_plugin_config = input_plugin.values()[0]
+      if not input_plugin_config or \
+          'nuocaCollectionInterval' not in input_plugin_config:
+        continue
+      interval = input_plugin_config['nuocaCollectionInterval']
+      if type(interval) is not int or interval <= 0:
+        msg = "nuocaCollectionInterval must be a positive number of " \
+              "seconds for plugin: %s" % input_plugin_name
+        nuoca_log(logging.ERROR, msg)
+        raise AttributeError(msg)
+      input_intervals[input_plugin_name] = interval
+    return input_intervals
+
+  def _get_plugin_interval(self, plugin_name):
+    """
+    :return: The collection interval of an input plugin in seconds.
+    :type: ``int``
+    """
+    return self._input_intervals.get(plugin_name, self._collection_interval)
+
+  def _collection_cycle(self, collection_time, due_intervals=None):
     """
     _collection_cycle is called at the end of each Collection
     Interval.
+    :param collection_time: Timestamp of the interval in milliseconds.
+    :type collection_time: ``int``
+    :param due_intervals: Collection intervals that end now.  Only the
+      input plugins with these intervals are collected.  None means all.
+    :type due_intervals: ``list`` of ``int``
     """
     nuoca_log(logging.INFO, "Starting collection interval: %s" %
               collection_time)
-    collected_inputs = self._collect_inputs()
+    if due_intervals is None:
+      due_intervals = [self._collection_interval]
+      due_intervals.extend(self._input_intervals.values())
+    self._supervise_plugins()
+    collect_start = nuoca_monotonic()
+    collected_inputs = self._collect_inputs(due_intervals)
+    collect_time = nuoca_monotonic() - collect_start
+    self._metrics.observe('collect_time', collect_time)
+    self._metrics.increment('rows', len(collected_inputs))
+    if collect_time > min(due_intervals):
+      self._metrics.increment('cycle_overruns')
+    if self._emit_metrics and self._collection_interval in due_intervals:
+      collected_inputs.append(self._get_metrics_values())
     for list_item in collected_inputs:
-      list_item['collection_interval'] = self._collection_interval
+      if 'collection_interval' not in list_item:
+        list_item['collection_interval'] = self._collection_interval
       if 'timestamp' not in list_item:
         list_item['timestamp'] = collection_time
-    # TODO Transformations
-      self._store_outputs(list_item)
+    self._dispatcher.put(collected_inputs)
+
+  def _transform_and_store(self, collected_inputs):
+    """
+    Apply the transforms and store the results in the output plugins.
+    Called on the dispatcher thread for each collection cycle.
+    :param collected_inputs: time-series values
+    :type collected_inputs: ``list`` of ``dict``
+    """
+    self._restart_dispatcher_plugins()
+    transform_start = nuoca_monotonic()
+    transformed_values = self._transform_values(collected_inputs)
+    store_start = nuoca_monotonic()
+    self._store_outputs(transformed_values)
+    self._metrics.observe('transform_time', store_start - transform_start)
+    self._metrics.observe('store_time', nuoca_monotonic() - store_start)
+
+  def _get_metrics_values(self):
+    """
+    Get NuoCA's own metrics for the built-in 'NuoCA' input, and reset them.
+    :return: time-series values
+    :type: ``dict``
+    """
+    for stat_name, stat_value in self._dispatcher.get_stats().iteritems():
+      self._metrics.set_gauge('output.' + stat_name, stat_value)
+    if self._latency_tracker:
+      for (name, action), timeout in \
+          self._latency_tracker.get_timeouts().iteritems():
+        self._metrics.set_gauge('plugin.%s.%s_timeout' % (name, action),
+                                timeout)
+    new_values = self._metrics.get_values(self.METRICS_INPUT_NAME)
+    new_values[self.METRICS_INPUT_NAME + '.nuoca_plugin'] = \
+        self.METRICS_INPUT_NAME
+    if self._output_values:
+      new_values.update(self._output_values)
+    return new_values
+
+  def _transform_values(self, ts_values):
+    """
+    Pass the time-series values from a collection cycle through each
+    transform in configuration order.  A transform that fails passes its
+    input through unchanged.
+    :param ts_values: time-series values
+    :type ts_values: ``list`` of ``dict``
+    :return: transformed time-series values
+    :type: ``list`` of ``dict``
+    """
+    for a_transform in self._transform_chain:
+      if not ts_values:
+        break
+      if isinstance(a_transform, NuocaTransform):
+        # noinspection PyBroadException
+        try:
+          ts_values = a_transform.transform(ts_values)
+        except Exception as e:
+          nuoca_log(logging.ERROR,
+                    "NuoCA._transform_values: Error in transform: %s\n%s"
+                    % (a_transform.transform_name, str(e)))
+      elif a_transform.is_activated and \
+          not self._supervisor.is_quarantined(a_transform.name):
+        ts_values = self._transform_with_plugin(a_transform, ts_values)
+    return ts_values
+
+  def _transform_with_plugin(self, a_plugin, ts_values):
+    """
+    Send the time-series values to a transform plugin.
+    :param a_plugin: The plugin
+    :param ts_values: time-series values
+    :type ts_values: ``list`` of ``dict``
+    :return: transformed time-series values
+    :type: ``list`` of ``dict``
+    """
+    plugin_msg = {'action': 'transform', 'ts_values': ts_values}
+    # noinspection PyBroadException
+    try:
+      self._discard_stale_responses(a_plugin)
+      a_plugin.plugin_object.child_pipe.send(plugin_msg)
+    except Exception as e:
+      nuoca_log(logging.ERROR,
+                "Unable to send 'Transform' message to plugin: %s\n%s"
+                % (a_plugin.name, str(e)))
+      return ts_values
+    response = self._get_plugin_respose(a_plugin, action='transform')
+    if not response:
+      return ts_values
+    if response['status_code'] != 0 or 'resp_values' not in response or \
+        'ts_values' not in response['resp_values']:
+      nuoca_log(logging.ERROR,
+                "NuoCA._transform_with_plugin: "
+                "Error response from plugin: %s\n%s"
+                % (a_plugin.name, response.get('error_msg')))
+      return ts_values
+    return response['resp_values']['ts_values']
 
   def _get_activated_input_plugins(self):
     """
     Get a list of "activated" input plugins
     """
     input_list = self.manager.getPluginsOfCategory('Input')
-    activated_list = [x for x in input_list if x.is_activated]
+    activated_list = [x for x in input_list if x.is_activated and
+                      not self._supervisor.is_quarantined(x.name)]
     return activated_list
 
   def _get_activated_output_plugins(self):
@@ -121,28 +353,83 @@ class NuoCA(object):
     Get a list of "activated" output plugins
     """
     output_list = self.manager.getPluginsOfCategory('Output')
-    activated_list = [x for x in output_list if x.is_activated]
+    activated_list = [x for x in output_list if x.is_activated and
+                      not self._supervisor.is_quarantined(x.name)]
     return activated_list
 
-  def _get_plugin_respose(self, a_plugin):
+  def _plugin_timeout(self, a_plugin, action=None):
+    """
+    Get the maximum number of seconds to wait for a response from the
+    plugin.  A plugin can override the global PLUGIN_PIPE_TIMEOUT with
+    'nuocaPluginTimeout' in its configuration.  Otherwise, with
+    PLUGIN_ADAPTIVE_TIMEOUT, the timeout of an action is learned from the
+    plugin's response latencies, up to PLUGIN_MAX_TIMEOUT.
+    :param a_plugin: The plugin
+    :param action: The request action, e.g. 'collect', or None for
+    requests that always use PLUGIN_PIPE_TIMEOUT, such as startup.
+    :type action: ``str``
+    :return: Timeout in seconds
+    :type: ``float``
+    """
+    plugin_config = None
+    for configured_plugins in [self._input_plugins, self._output_plugins,
+                               self._transform_plugins]:
+      if a_plugin.name in configured_plugins:
+        plugin_config = configured_plugins[a_plugin.name][1]
+        break
+    if plugin_config and 'nuocaPluginTimeout' in plugin_config:
+      return float(plugin_config['nuocaPluginTimeout'])
+    if action and self._latency_tracker:
+      return self._latency_tracker.get_timeout(a_plugin.name, action)
+    return self.config.PLUGIN_PIPE_TIMEOUT
+
+  def _get_plugin_respose(self, a_plugin, timeout=None, action=None):
     """
     Get the response message from the plugin
+    :param a_plugin: The plugin
+    :param timeout: Seconds to wait for the response.  Defaults to
+    the plugin's timeout.
+    :type timeout: ``float``
+    :param action: The request action, see _plugin_timeout.
+    :type action: ``str``
     :return: Response dictionary if successful, otherwise None.
     """
+    if timeout is None:
+      timeout = self._plugin_timeout(a_plugin, action)
     plugin_obj = a_plugin.plugin_object
+    start_time = nuoca_monotonic()
     # noinspection PyBroadException
     try:
-      if plugin_obj.child_pipe.poll(self.config.PLUGIN_PIPE_TIMEOUT):
-        response = plugin_obj.child_pipe.recv()
-        if self._verbose:
-          print("%s:%s" % (a_plugin.name, response))
-      else:
+      if not plugin_obj.child_pipe.poll(timeout):
+        self._plugin_timed_out(a_plugin, action)
         nuoca_log(logging.ERROR,
                   "NuoCA._get_plugin_respose: "
                   "Timeout collecting response values from plugin: %s"
                   % a_plugin.name)
         return None
+    except Exception as e:
+      nuoca_log(logging.ERROR,
+                "NuoCA._get_plugin_respose: "
+                "Unable to collect response from plugin: %s\n%s"
+                % (a_plugin.name, str(e)))
+      return None
+    self._plugin_responded(a_plugin, action, nuoca_monotonic() - start_time)
+    return self._read_plugin_response(a_plugin)
 
+  def _read_plugin_response(self, a_plugin):
+    """
+    Read and validate a response message that is ready on the plugin pipe.
+    :param a_plugin: The plugin
+    :return: Response dictionary if successful, otherwise None.
+    """
+    plugin_obj = a_plugin.plugin_object
+    # noinspection PyBroadException
+    try:
+      response, response_size = recv_with_size(plugin_obj.child_pipe)
+      self._metrics.increment('plugin.%s.recv_bytes' % a_plugin.name,
+                              response_size)
+      if self._verbose:
+        print("%s:%s" % (a_plugin.name, response))
     except Exception as e:
       nuoca_log(logging.ERROR,
                 "NuoCA._get_plugin_respose: "
@@ -174,35 +461,271 @@ class NuoCA(object):
 
     return response
 
-  def _startup_plugin(self, a_plugin, config=None):
+  def _get_plugin_responses(self, plugins, deadline=None, action=None):
     """
-    Send start message to plugin.
+    Wait on the pipes of all plugins at once and gather their responses in
+    arrival order.  Each plugin is given its own response budget (see
+    _plugin_timeout), and no plugin is waited on past the deadline.
+    :param plugins: Plugins that were sent a request message.
+    :type plugins: ``list``
+    :param deadline: Optional nuoca_monotonic() deadline for all responses.
+    :type deadline: ``float``
+    :param action: The request action, see _plugin_timeout.
+    :type action: ``str``
+    :return: ``list`` of (plugin, response dictionary) tuples.
+    """
+    rval = []
+    start_time = nuoca_monotonic()
+    pending = {}
+    for a_plugin in plugins:
+      plugin_deadline = start_time + self._plugin_timeout(a_plugin, action)
+      if deadline is not None:
+        plugin_deadline = min(plugin_deadline, deadline)
+      pending[a_plugin.plugin_object.child_pipe] = (a_plugin, plugin_deadline)
+
+    while pending:
+      now = nuoca_monotonic()
+      for pipe in pending.keys():
+        a_plugin, plugin_deadline = pending[pipe]
+        if plugin_deadline <= now:
+          self._plugin_timed_out(a_plugin, action)
+          nuoca_log(logging.ERROR,
+                    "NuoCA._get_plugin_responses: "
+                    "Timeout collecting response values from plugin: %s"
+                    % a_plugin.name)
+          del pending[pipe]
+      if not pending:
+        break
+      wait_time = min([x[1] for x in pending.values()]) - now
+      try:
+        ready_pipes = wait_for_pipes(pending.keys(), wait_time)
+      except Exception as e:
+        nuoca_log(logging.ERROR,
+                  "NuoCA._get_plugin_responses: "
+                  "Unable to wait for plugin responses: %s" % str(e))
+        break
+      now = nuoca_monotonic()
+      for pipe in ready_pipes:
+        a_plugin = pending.pop(pipe)[0]
+        self._plugin_responded(a_plugin, action, now - start_time)
+        response = self._read_plugin_response(a_plugin)
+        if response:
+          rval.append((a_plugin, response))
+    return rval
+
+  def _plugin_responded(self, a_plugin, action, latency):
+    """
+    Record the latency of a response from the plugin.
     :param a_plugin: The plugin
-    :param config: NuoCA Configuration
+    :param action: The request action
+    :type action: ``str``
+    :param latency: Seconds from the request to the response.
+    :type latency: ``float``
+    """
+    self._metrics.observe('plugin.%s.response_time' % a_plugin.name, latency)
+    if action and self._latency_tracker:
+      self._latency_tracker.observe(a_plugin.name, action, latency)
+    self._supervisor.record_success(a_plugin.name)
+
+  def _plugin_timed_out(self, a_plugin, action=None):
+    """
+    Count a response timeout, which may quarantine the plugin.  The
+    plugin's learned timeout is forgotten, so the next request waits up
+    to PLUGIN_MAX_TIMEOUT.
+    :param a_plugin: The plugin
+    :param action: The request action
+    :type action: ``str``
+    """
+    self._metrics.increment('plugin.%s.timeouts' % a_plugin.name)
+    if action and self._latency_tracker:
+      self._latency_tracker.reset(a_plugin.name, action)
+    if self._supervisor.record_failure(a_plugin.name, 'response timeout'):
+      self._metrics.increment('plugin.%s.quarantines' % a_plugin.name)
+
+  def _get_configured_plugins(self):
+    """
+    :return: (plugin, configuration) tuples by plugin name.
+    :type: ``dict``
+    """
+    configured_plugins = {}
+    for plugin_dict in [self._input_plugins, self._output_plugins,
+                        self._transform_plugins]:
+      configured_plugins.update(plugin_dict)
+    return configured_plugins
+
+  def _supervise_plugins(self):
+    """
+    Quarantine plugins whose process or thread has exited, and restart the
+    quarantined input plugins that are due for a restart.  Output and
+    transform plugins are queued for a restart on the dispatcher thread.
+    """
+    if not self.manager:
+      return
+    configured_plugins = self._get_configured_plugins()
+    for name, (a_plugin, _) in configured_plugins.iteritems():
+      if a_plugin.is_activated and \
+          not self._supervisor.is_quarantined(name) and \
+          not a_plugin.plugin_object.proc.is_alive():
+        self._metrics.increment('plugin.%s.quarantines' % name)
+        self._supervisor.quarantine(
+            name, "exited with code %s" % a_plugin.plugin_object.proc.exitcode)
+    for name in self._supervisor.get_plugins_to_restart():
+      if name not in configured_plugins:
+        continue
+      if name in self._input_plugins:
+        self._restart_plugin(*configured_plugins[name])
+      else:
+        with self._dispatcher_restarts_lock:
+          self._dispatcher_restarts.add(name)
+
+  def _restart_dispatcher_plugins(self):
+    """
+    Restart the output and transform plugins that the collection thread
+    queued for a restart.  Called on the dispatcher thread before each
+    collection cycle is delivered, so that no pipe of a plugin is closed
+    while the dispatcher waits on it.
+    """
+    with self._dispatcher_restarts_lock:
+      names = self._dispatcher_restarts
+      self._dispatcher_restarts = set()
+    if not names:
+      return
+    configured_plugins = self._get_configured_plugins()
+    for name in names:
+      if self._supervisor.is_quarantined(name):
+        self._restart_plugin(*configured_plugins[name])
+
+  def _restart_plugin(self, a_plugin, config):
+    """
+    Respawn a quarantined plugin and send it its original configuration.
+    :param a_plugin: The plugin
+    :param config: The plugin's configuration
     :type config: ``dict``
     """
-    response = None
-    nuoca_log(logging.INFO, "Called to start plugin: %s" % a_plugin.name)
-    plugin_msg = {'action': 'startup', 'config': config}
+    nuoca_log(logging.WARNING, "Restarting plugin: %s" % a_plugin.name)
+    self._metrics.increment('plugin.%s.restarts' % a_plugin.name)
     try:
-      a_plugin.plugin_object.child_pipe.send(plugin_msg)
+      self.manager.respawn_plugin(a_plugin)
+      self.manager.activatePluginByName(a_plugin.name, a_plugin.category)
     except Exception as e:
-      nuoca_log(logging.ERROR,
-                "Unable to send %s message to plugin: %s\n%s"
-                % (plugin_msg, a_plugin.name, str(e)))
+      self._supervisor.quarantine(a_plugin.name,
+                                  "unable to respawn: %s" % str(e))
+      return
+    # A failed startup quarantines the plugin again, with a longer backoff.
+    if self._startup_plugin(a_plugin, config):
+      self._supervisor.restart_succeeded(a_plugin.name)
+
+  def _discard_stale_responses(self, a_plugin):
+    """
+    Discard responses that arrived after an earlier request timed out, so
+    that they are not mistaken for the response to the next request.  The
+    batch schemas in a late collect response are still learned.
+    :param a_plugin: The plugin
+    """
+    pipe = a_plugin.plugin_object.child_pipe
+    while pipe.poll(0):
+      response = pipe.recv()
+      self._metrics.increment('plugin.%s.late_responses' % a_plugin.name)
+      if a_plugin.category == 'Input':
+        self._update_input_schemas(a_plugin, response)
+        self._record_plugin_metrics(a_plugin, response.get('resp_values'))
+      nuoca_log(logging.WARNING,
+                "Discarded late response from plugin: %s" % a_plugin.name)
+
+  def _get_input_decoder(self, a_plugin):
+    """
+    :param a_plugin: An input plugin
+    :return: The decoder of the plugin's collected batches.
+    :type: ``PrefixingBatchDecoder``
+    """
+    decoder = self._input_decoders.get(a_plugin.name)
+    if not decoder:
+      decoder = PrefixingBatchDecoder(a_plugin.name)
+      self._input_decoders[a_plugin.name] = decoder
+    return decoder
 
+  def _update_input_schemas(self, a_plugin, response):
+    """
+    Learn the new schemas in a late collect response.  The plugin's
+    encoder counts them as sent, so later batches refer to them.
+    :param a_plugin: An input plugin
+    :param response: The discarded response
+    """
     try:
-      response = self._get_plugin_respose(a_plugin)
-    except Exception as e:
-      nuoca_log(logging.ERROR,
-                "Problem with response on %s message to plugin: %s\n%s"
-                % (plugin_msg, a_plugin.name, str(e)))
-    if not response or response['status_code'] != 0:
-      nuoca_log(logging.ERROR,
-                "Disabling plugin that failed to startup: %s"
-                % a_plugin.name)
-      self.manager.deactivatePluginByName(a_plugin.name, a_plugin.category)
-      self._shutdown_plugin(a_plugin)
+      batch = response['resp_values']['collected_batch']
+    except (KeyError, TypeError):
+      return
+    self._get_input_decoder(a_plugin).update_schemas(batch)
+
+  def _record_plugin_metrics(self, a_plugin, resp_values):
+    """
+    Add the metrics of the plugin's own work, sent beside its collected
+    values, to NuoCA's metrics.
+    :param a_plugin: An input plugin
+    :param resp_values: The 'resp_values' of a collect response
+    """
+    try:
+      plugin_metrics = resp_values['plugin_metrics']
+    except (KeyError, TypeError):
+      return
+    prefix = 'plugin.%s.' % a_plugin.name
+    for name, value in plugin_metrics.get('counters', {}).iteritems():
+      self._metrics.increment(prefix + name, value)
+    for name, value in plugin_metrics.get('gauges', {}).iteritems():
+      self._metrics.set_gauge(prefix + name, value)
+
+  def _startup_plugin(self, a_plugin, config=None):
+    """
+    Send start message to plugin.
+    :param a_plugin: The plugin
+    :param config: NuoCA Configuration
+    :type config: ``dict``
+    :return: True if the plugin started.
+    """
+    return bool(self._startup_plugins([(a_plugin, config)]))
+
+  def _startup_plugins(self, plugins_and_configs):
+    """
+    Start plugins concurrently.  The startup message is sent to every
+    plugin first, then the responses are gathered together.  Plugins that
+    fail to start are deactivated.
+    :param plugins_and_configs: (plugin, configuration) tuples
+    :type plugins_and_configs: ``list`` of ``tuple``
+    :return: Names of the plugins that started.
+    :type: ``set``
+    """
+    start_time = nuoca_monotonic()
+    requested_plugins = []
+    for a_plugin, config in plugins_and_configs:
+      nuoca_log(logging.INFO, "Called to start plugin: %s" % a_plugin.name)
+      # A (re)started plugin has not seen any batch schemas.
+      self._input_decoders.pop(a_plugin.name, None)
+      self._output_encoders.pop(a_plugin.name, None)
+      plugin_msg = {'action': 'startup', 'config': config}
+      try:
+        a_plugin.plugin_object.child_pipe.send(plugin_msg)
+        requested_plugins.append(a_plugin)
+      except Exception as e:
+        nuoca_log(logging.ERROR,
+                  "Unable to send %s message to plugin: %s\n%s"
+                  % (plugin_msg, a_plugin.name, str(e)))
+
+    started_plugins = set()
+    for a_plugin, response in self._get_plugin_responses(requested_plugins):
+      if response['status_code'] == 0:
+        started_plugins.add(a_plugin.name)
+    for a_plugin, _ in plugins_and_configs:
+      if a_plugin.name not in started_plugins:
+        nuoca_log(logging.ERROR,
+                  "Disabling plugin that failed to startup: %s"
+                  % a_plugin.name)
+        self.manager.deactivatePluginByName(a_plugin.name, a_plugin.category)
+        self._shutdown_plugin(a_plugin)
+        self._supervisor.quarantine(a_plugin.name, "startup failed")
+    nuoca_log(logging.INFO, "Started %d of %d plugins in %.3f seconds"
+              % (len(started_plugins), len(plugins_and_configs),
+                 nuoca_monotonic() - start_time))
+    return started_plugins
 
   @staticmethod
   def _exit_plugin(a_plugin):
@@ -236,34 +759,86 @@ class NuoCA(object):
                 "Unable to send %s message to plugin: %s\n%s"
                 % (plugin_msg, a_plugin.name, str(e)))
 
-  def _collect_inputs(self):
+  def _collect_inputs(self, due_intervals=None):
     """
-    Collect time-series data from each activated plugin.
+    Collect time-series data from each activated plugin.  The collect
+    message is sent to every plugin first, then the responses are
+    gathered concurrently so that a slow plugin does not delay the others.
+    :param due_intervals: Only collect from the input plugins with these
+      collection intervals.  None means all.
+    :type due_intervals: ``list`` of ``int``
     :return: ``dict`` of time-series data
     """
-    # TODO - Use Threads so that we can do concurrent collection.
-    plugin_msg = {'action': 'collect',
-                  'collection_interval': self._collection_interval}
     rval = []
     activated_plugins = self._get_activated_input_plugins()
+    if due_intervals is not None:
+      activated_plugins = [
+          x for x in activated_plugins
+          if self._get_plugin_interval(x.name) in due_intervals]
+    if not activated_plugins:
+      return rval
+    cycle_timeout = self.config.COLLECTION_CYCLE_TIMEOUT
+    if cycle_timeout is None:
+      cycle_timeout = min([self._get_plugin_interval(x.name)
+                           for x in activated_plugins])
+    deadline = nuoca_monotonic() + cycle_timeout
+    requested_plugins = []
     for a_plugin in activated_plugins:
+      plugin_msg = {'action': 'collect',
+                    'collection_interval':
+                      self._get_plugin_interval(a_plugin.name),
+                    'batch': True}
+      if self._max_speed:
+        # The plugin's copy of the VirtualClock does not advance by itself.
+        plugin_msg['virtual_time'] = get_nuoca_clock().time()
+      if self._get_input_decoder(a_plugin).pop_schemas_missing():
+        plugin_msg['reset_schemas'] = True
       # noinspection PyBroadException
       try:
+        self._discard_stale_responses(a_plugin)
         a_plugin.plugin_object.child_pipe.send(plugin_msg)
+        requested_plugins.append(a_plugin)
       except Exception as e:
         nuoca_log(logging.ERROR,
                   "NuoCA._collect_inputs: "
                   "Unable to send %s message to plugin: %s\n%s"
                   % (plugin_msg, a_plugin.name, str(e)))
 
-    for a_plugin in activated_plugins:
-      response = self._get_plugin_respose(a_plugin)
-      if not response:
+    responses = self._get_plugin_responses(requested_plugins, deadline,
+                                           action='collect')
+    for a_plugin, response in responses:
+      if 'resp_values' not in response:
+        self._metrics.increment('plugin.%s.errors' % a_plugin.name)
+        nuoca_log(logging.ERROR,
+                  "NuoCA._collect_inputs: "
+                  "Error response from plugin: %s\n%s"
+                  % (a_plugin.name, response.get('error_msg')))
         continue
       resp_values = response['resp_values']
+      self._record_plugin_metrics(a_plugin, resp_values)
 
       # noinspection PyBroadException
       try:
+        if 'collected_batch' in resp_values:
+          new_rows = self._get_input_decoder(a_plugin).decode(
+              resp_values['collected_batch'])
+          if not new_rows:
+            nuoca_log(logging.DEBUG,
+                      "No time-series values were collected from plugin: %s",
+                      a_plugin.name)
+            continue
+          self._metrics.increment('plugin.%s.rows' % a_plugin.name,
+                                  len(new_rows))
+          plugin_interval = self._get_plugin_interval(a_plugin.name)
+          for new_values in new_rows:
+            new_values['collection_interval'] = plugin_interval
+            if self._output_values:
+              new_values.update(self._output_values)
+          rval.extend(new_rows)
+          continue
+
+        # Plugins that do not use NuocaMPInputPlugin.run() may send the
+        # collected values as a list of dicts.
         if 'collected_values' not in resp_values:
           nuoca_log(logging.ERROR,
                     "NuoCA._collect_inputs: "
@@ -272,8 +847,8 @@ class NuoCA(object):
           continue
         if not resp_values['collected_values']:
           nuoca_log(logging.DEBUG,
-                    "No time-series values were collected from plugin: %s"
-                    % a_plugin.name)
+                    "No time-series values were collected from plugin: %s",
+                    a_plugin.name)
           continue
         if type(resp_values['collected_values']) is not list:
           nuoca_log(logging.ERROR,
@@ -284,18 +859,25 @@ class NuoCA(object):
           continue
 
         list_count = len(resp_values['collected_values'])
+        self._metrics.increment('plugin.%s.rows' % a_plugin.name,
+                                list_count)
         for list_index in range(list_count):
           new_values = {}
           key_prefix = a_plugin.name
           collected_dict = resp_values['collected_values'][list_index]
+          # collected_dict is not modified, because a thread hosted
+          # plugin passes its values by reference.
           if 'nuocaCollectionName' in collected_dict:
             key_prefix = collected_dict['nuocaCollectionName']
-            del collected_dict['nuocaCollectionName']
           for collected_item in collected_dict:
+            if collected_item == 'nuocaCollectionName':
+              continue
             key_name = key_prefix + '.' + collected_item
             new_values[key_name] = collected_dict[collected_item]
             if collected_item == 'TimeStamp':
               new_values['timestamp'] = int(collected_dict[collected_item])
+          new_values['collection_interval'] = \
+            self._get_plugin_interval(a_plugin.name)
           if self._output_values:
             new_values.update(self._output_values)
           rval.append(new_values)
@@ -308,29 +890,89 @@ class NuoCA(object):
     return rval
 
   def _store_outputs(self, collected_inputs):
+    """
+    Send the time-series values from a collection cycle to each activated
+    output plugin as a single 'store_batch' message.
+    :param collected_inputs: time-series values
+    :type collected_inputs: ``list`` of ``dict``
+    """
     if not collected_inputs:
       return
     rval = {}
-    plugin_msg = {'action': 'store', 'ts_values': collected_inputs}
     activated_plugins = self._get_activated_output_plugins()
+    requested_plugins = []
     for a_plugin in activated_plugins:
+      encoder = self._output_encoders.get(a_plugin.name)
+      if not encoder:
+        encoder = BatchEncoder()
+        self._output_encoders[a_plugin.name] = encoder
+      plugin_msg = {'action': 'store_batch',
+                    'ts_batch': encoder.encode(collected_inputs)}
       # noinspection PyBroadException
       try:
+        self._discard_stale_responses(a_plugin)
         a_plugin.plugin_object.child_pipe.send(plugin_msg)
+        requested_plugins.append(a_plugin)
       except Exception as e:
+        # The plugin may have missed new schemas, so send them all again.
+        encoder.reset()
         nuoca_log(logging.ERROR,
                   "Unable to send 'Store' message to plugin: %s\n%s"
                   % (a_plugin.name, str(e)))
 
-    for a_plugin in activated_plugins:
-      resp_values = self._get_plugin_respose(a_plugin)
-      if not resp_values:
-        continue
+    responses = self._get_plugin_responses(requested_plugins,
+                                           action='store')
+    for a_plugin, response in responses:
+      if response['status_code'] != 0:
+        self._metrics.increment('plugin.%s.errors' % a_plugin.name)
+        nuoca_log(logging.ERROR,
+                  "NuoCA._store_outputs: "
+                  "Error response from plugin: %s\n%s"
+                  % (a_plugin.name, response.get('error_msg')))
+      resp_values = response.get('resp_values')
+      if resp_values and resp_values.get('reset_schemas'):
+        # The plugin is missing some schemas, so send them all again.
+        self._output_encoders.pop(a_plugin.name, None)
+      rval[a_plugin.name] = response
 
     return rval
 
+  def _get_plugin_options(self, option_name, allowed_values):
+    """
+    Get a NuoCA option, such as 'nuocaPluginHost', from the configuration
+    of each plugin.
+    :param option_name: Name of the option in the plugin configuration.
+    :type option_name: ``str``
+    :param allowed_values: Valid values of the option.
+    :type allowed_values: ``tuple``
+    :return: Option value by plugin name, for the plugins that set it.
+    :type: ``dict``
+    """
+    plugin_options = {}
+    for plugin_list in (self.config.INPUT_PLUGINS,
+                        self.config.OUTPUT_PLUGINS,
+                        self.config.TRANSFORM_PLUGINS):
+      for plugin_entry in plugin_list:
+        plugin_name = plugin_entry.keys()[0]
+        plugin_config = plugin_entry.values()[0]
+        if not plugin_config or option_name not in plugin_config:
+          continue
+        option_value = plugin_config[option_name]
+        if option_value not in allowed_values:
+          msg = "Unknown %s '%s' for plugin: %s" % \
+                (option_name, option_value, plugin_name)
+          nuoca_log(logging.ERROR, msg)
+          raise AttributeError(msg)
+        plugin_options[plugin_name] = option_value
+    return plugin_options
+
   def _create_plugin_manager(self):
-    self.manager = MultiprocessPluginManager(
+    self.manager = NuocaPluginManager(
+        plugin_hosts=self._get_plugin_options('nuocaPluginHost',
+                                              PLUGIN_HOSTS),
+        plugin_transports=self._get_plugin_options('nuocaTransport',
+                                                   PLUGIN_TRANSPORTS),
+        shm_ring_size=self.config.SHM_RING_SIZE,
         directories_list=self._plugin_directories,
         plugin_info_ext="multiprocess-plugin")
     self.manager.setCategoriesFilter({
@@ -341,8 +983,13 @@ class NuoCA(object):
 
   # Activate plugins and call the plugin's startup() method.
   def _activate_and_startup_plugins(self):
+    # The Yapsy plugins are started together once they are all activated.
+    plugins_to_start = []
     for input_plugin in self.config.INPUT_PLUGINS:
       input_plugin_name = input_plugin.keys()[0]
+      if input_plugin_name == self.METRICS_INPUT_NAME:
+        self._emit_metrics = True
+        continue
       if not self.manager.activatePluginByName(input_plugin_name, 'Input'):
         err_msg = "Cannot activate input plugin: '%s', Skipping." % \
                   input_plugin_name
@@ -355,8 +1002,8 @@ class NuoCA(object):
             input_plugin_config = {}
           input_plugin_config['nuoca_start_ts'] = self._starttime
           input_plugin_config['nuoca_collection_interval'] = \
-            self._collection_interval
-          self._startup_plugin(a_plugin, input_plugin_config)
+            self._get_plugin_interval(input_plugin_name)
+          plugins_to_start.append((a_plugin, input_plugin_config))
           self._input_plugins[input_plugin_name] = (a_plugin,
                                                     input_plugin_config)
 
@@ -375,10 +1022,45 @@ class NuoCA(object):
           output_plugin_config['nuoca_start_ts'] = self._starttime
           output_plugin_config['nuoca_collection_interval'] = \
             self._collection_interval
-          self._startup_plugin(a_plugin, output_plugin_config)
+          output_plugin_config['nuoca_spool_dir'] = os.path.join(
+              self._config.NUOCA_TMPDIR, 'spool', output_plugin_name)
+          plugins_to_start.append((a_plugin, output_plugin_config))
           self._output_plugins[output_plugin_name] = (a_plugin,
                                                       output_plugin_config)
-    # TODO Transform Plugins
+
+    for transform_plugin in self.config.TRANSFORM_PLUGINS:
+      transform_plugin_name = transform_plugin.keys()[0]
+      transform_plugin_config = transform_plugin.values()[0]
+      if not transform_plugin_config:
+        transform_plugin_config = {}
+      transform_plugin_config['nuoca_start_ts'] = self._starttime
+      transform_plugin_config['nuoca_collection_interval'] = \
+        self._collection_interval
+      transform_plugin_config['nuoca_max_collection_interval'] = \
+        max([self._collection_interval] + self._input_intervals.values())
+      if transform_plugin_name in BUILTIN_TRANSFORMS:
+        a_transform = BUILTIN_TRANSFORMS[transform_plugin_name]()
+        if a_transform.startup(transform_plugin_config):
+          self._transform_chain.append(a_transform)
+        else:
+          nuoca_log(logging.ERROR,
+                    "Disabling transform that failed to startup: %s"
+                    % transform_plugin_name)
+      elif not self.manager.activatePluginByName(transform_plugin_name,
+                                                 'Transform'):
+        err_msg = "Cannot activate transform plugin: '%s', Skipping." % \
+                  transform_plugin_name
+        nuoca_log(logging.WARNING, err_msg)
+      else:
+        a_plugin = self.manager.getPluginByName(transform_plugin_name,
+                                                'Transform')
+        if a_plugin:
+          plugins_to_start.append((a_plugin, transform_plugin_config))
+          self._transform_plugins[transform_plugin_name] = \
+            (a_plugin, transform_plugin_config)
+          self._transform_chain.append(a_plugin)
+
+    self._startup_plugins(plugins_to_start)
 
   # test if the plugin name is configured in NuoCA.
   def _is_plugin_name_configured(self, name):
@@ -415,7 +1097,13 @@ class NuoCA(object):
       self.manager.deactivatePluginByName(output_plugin, 'Output')
       a_plugin = self.manager.getPluginByName(output_plugin, 'Output')
       self._shutdown_plugin(a_plugin)
-    # TODO Transform Plugins
+    for transform_plugin in self._transform_plugins:
+      self.manager.deactivatePluginByName(transform_plugin, 'Transform')
+      a_plugin = self.manager.getPluginByName(transform_plugin, 'Transform')
+      self._shutdown_plugin(a_plugin)
+    for a_transform in self._transform_chain:
+      if isinstance(a_transform, NuocaTransform):
+        a_transform.shutdown()
 
   @staticmethod
   def kill_all_plugin_processes(manager, timeout=5):
@@ -423,8 +1111,8 @@ class NuoCA(object):
     Kill any plugin processes that were left running after waiting up to
     the timeout value..
 
-    :param manager: MultiprocessPluginManager
-    :type manager: MultiprocessPluginManager
+    :param manager: NuocaPluginManager
+    :type manager: NuocaPluginManager
 
     :param timeout: Maximum time to wait (in seconds) for the process to
     self exit before killing.
@@ -433,15 +1121,23 @@ class NuoCA(object):
     """
     if not manager:
       return
+    start_time = nuoca_monotonic()
+    deadline = start_time + timeout
     all_plugins = manager.getAllPlugins()
-    wait_count = timeout
+    # The plugins exit in parallel, so the timeout is shared by all of them.
+    for a_plugin in all_plugins:
+      a_plugin.plugin_object.proc.join(max(deadline - nuoca_monotonic(), 0))
+    killed_plugins = []
     for a_plugin in all_plugins:
-      while a_plugin.plugin_object.proc.is_alive() and wait_count > 0:
-        time.sleep(1)
-        wait_count -= 1
       if a_plugin.plugin_object.proc.is_alive():
         nuoca_log(logging.INFO, "Killing plugin subprocess: %s" % a_plugin)
         a_plugin.plugin_object.proc.terminate()
+        killed_plugins.append(a_plugin)
+    for a_plugin in killed_plugins:
+      a_plugin.plugin_object.proc.join(1)
+    nuoca_log(logging.INFO, "%d plugins exited in %.3f seconds, %d killed"
+              % (len(all_plugins) - len(killed_plugins),
+                 nuoca_monotonic() - start_time, len(killed_plugins)))
 
   def _remove_all_plugins(self, timeout=5):
     """
@@ -455,7 +1151,9 @@ class NuoCA(object):
     for output_plugin in self._output_plugins:
       a_plugin = self.manager.getPluginByName(output_plugin, 'Output')
       self._exit_plugin(a_plugin)
-    # TODO Transform Plugins
+    for transform_plugin in self._transform_plugins:
+      a_plugin = self.manager.getPluginByName(transform_plugin, 'Transform')
+      self._exit_plugin(a_plugin)
 
     # At this point all configured plugin subprocesses should be exiting
     # on their own.  However, if there is any plugin subprocess that didn't
@@ -469,18 +1167,44 @@ class NuoCA(object):
     """
     self._create_plugin_manager()
     self._activate_configured_plugins()
-    interval_sync = IntervalSync(interval=self._collection_interval,
-                                 seed_ts=self._starttime)
+    self._dispatcher.start()
 
-    # Collection Interval Loop
+    # One schedule per distinct collection interval.  Input plugins that
+    # share an interval are collected together.
+    scheduler = IntervalScheduler(self._starttime,
+                                  self._config.SCHEDULE_OVERRUN_POLICY,
+                                  self._config.SCHEDULE_TOLERANCE)
+    scheduler.add(self._collection_interval, self._collection_interval)
+    for interval in set(self._input_intervals.values()):
+      if interval != self._collection_interval:
+        scheduler.add(interval, interval)
+
+    # Collection Interval Loop.  The self test counts the NuoCA collection
+    # intervals.
     loop_count = 0
+    loop_start_time = nuoca_monotonic()
     while self._enabled:
+      collection_timestamp, due_intervals = \
+        scheduler.wait_for_next_interval()
+      self._metrics.observe('schedule.wakeup_lateness',
+                            scheduler.last_lateness)
+      for stat_name, stat_value in scheduler.get_stats().iteritems():
+        if stat_value:
+          self._metrics.increment('schedule.' + stat_name, stat_value)
+      self._collection_cycle(collection_timestamp * 1000, due_intervals)
+      if self._collection_interval not in due_intervals:
+        continue
       loop_count += 1
-      collection_timestamp = interval_sync.wait_for_next_interval()
-      self._collection_cycle(collection_timestamp * 1000)
       if self._self_test:
         if loop_count >= self._config.SELFTEST_LOOP_COUNT:
           self._enabled = False
+    if self._max_speed:
+      elapsed = nuoca_monotonic() - loop_start_time
+      nuoca_log(logging.INFO,
+                "max speed: %d collection cycles in %.3f seconds, "
+                "%.1f cycles per second, %d dropped by the output queue"
+                % (loop_count, elapsed, loop_count / max(elapsed, 1e-9),
+                   self._dispatcher.get_stats()['dropped_batches']))
 
   def shutdown(self, timeout=5):
     """
@@ -489,19 +1213,26 @@ class NuoCA(object):
     :type timeout: ``int``
     """
     nuoca_log(logging.INFO, "nuoca server shutdown")
+    start_time = nuoca_monotonic()
+    self._dispatcher.stop(timeout)
     self._shutdown_all_plugins()
     self._remove_all_plugins(timeout)
+    nuoca_log(logging.INFO, "nuoca server shutdown in %.3f seconds"
+              % (nuoca_monotonic() - start_time))
+    if self._max_speed:
+      set_nuoca_clock(SystemClock())
     nuoca_logging_shutdown()
 
 
 def nuoca_run(config_file, collection_interval, plugin_dir,
               starttime, verbose, self_test,
-              log_level, output_values):
+              log_level, output_values, max_speed=False):
   nuoca_obj = None
   try:
     nuoca_obj = NuoCA(config_file, collection_interval, plugin_dir,
                       starttime, verbose, self_test,
-                      logging.getLevelName(log_level), output_values)
+                      logging.getLevelName(log_level), output_values,
+                      max_speed)
     nuoca_obj.start()
   except AttributeError as e:
     msg = str(e)
@@ -543,10 +1274,16 @@ def nuoca_run(config_file, collection_interval, plugin_dir,
               default=None,
               help='Optional. One or more output values as '
                    'key=value pairs separated by commas. Multples allowed')
+@click.option('--max-speed', is_flag=True, default=False,
+              help='Run the collection intervals back to back on a '
+                   'virtual clock, e.g. with --self-test, and log the '
+                   'collection cycle rate')
 def nuoca(config_file, collection_interval, plugin_dir,
-          starttime, verbose, self_test, log_level, output_values):
+          starttime, verbose, self_test, log_level, output_values,
+          max_speed):
   nuoca_run(config_file, collection_interval, plugin_dir,
-            starttime, verbose, self_test, log_level, output_values)
+            starttime, verbose, self_test, log_level, output_values,
+            max_speed)
 
 if __name__ == "__main__":
   nuoca()
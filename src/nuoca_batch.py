@@ -0,0 +1,244 @@
+"""
+Compact batch format for time-series values sent between NuoCA and its
+plugins.
+
+Most plugins produce the same set of keys in every row and every
+collection cycle.  A CollectedBatch sends each set of keys (a schema) once
+per pipe and sends rows as (schema id, values tuple) pairs.  A
+BatchEncoder on the sending end remembers which schemas it has sent, and
+the BatchDecoder on the receiving end remembers the schemas it has
+received.
+
+Rows are turned back into dicts only when a plugin needs them, e.g. for
+an Output Plugin's store() method.
+
+A row whose schema the decoder does not know, e.g. because a batch with
+its definition was lost, is skipped.  The receiver then asks the sender
+to reset its encoder, so that the schemas are sent again.
+"""
+
+import itertools
+import logging
+
+from nuoca_util import nuoca_log
+
+
+class CollectedBatch(object):
+  """
+  Rows of time-series values, encoded against the schemas of a
+  BatchEncoder.
+
+  :ivar schemas: Schemas that are new to the receiver, by schema id.
+  :type schemas: ``dict`` of ``tuple``
+  :ivar rows: List of (schema id, values tuple)
+  :type rows: ``list`` of ``tuple``
+  """
+  __slots__ = ('schemas', 'rows')
+
+  def __init__(self, schemas=None, rows=None):
+    self.schemas = schemas or {}
+    self.rows = rows or []
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getstate__(self):
+    return self.schemas, self.rows
+
+  def __setstate__(self, state):
+    self.schemas, self.rows = state
+
+
+class BatchEncoder(object):
+  """
+  Sending end of a stream of CollectedBatch objects.
+  """
+  MAX_SCHEMAS = 10000  # Start over if the keys never repeat.
+
+  def __init__(self):
+    self._schema_ids = {}
+
+  def reset(self):
+    """
+    Forget the schemas that were sent, e.g. because the receiver was
+    restarted or is missing some of them.  They are all sent again.
+    """
+    self._schema_ids = {}
+
+  def encode(self, ts_values):
+    """
+    :param ts_values: time-series values
+    :type ts_values: ``list`` of ``dict``
+
+    :return: The encoded values
+    :type: ``CollectedBatch``
+    """
+    if len(self._schema_ids) > self.MAX_SCHEMAS:
+      self.reset()
+    schema_ids = self._schema_ids
+    new_schemas = {}
+    rows = []
+    for ts_value in ts_values:
+      schema = tuple(ts_value.iterkeys())
+      schema_id = schema_ids.get(schema)
+      if schema_id is None:
+        schema_id = len(schema_ids)
+        schema_ids[schema] = schema_id
+        new_schemas[schema_id] = schema
+      rows.append((schema_id, tuple(ts_value.itervalues())))
+    return CollectedBatch(new_schemas, rows)
+
+
+class BatchDecoder(object):
+  """
+  Receiving end of a stream of CollectedBatch objects.
+  """
+  def __init__(self):
+    self._schemas = {}
+    self._schemas_missing = False
+
+  def reset(self):
+    self._schemas = {}
+
+  def pop_schemas_missing(self):
+    """
+    :return: True if rows were skipped because their schema was unknown,
+      since the last call.  The encoder should then be reset.
+    :type: ``bool``
+    """
+    schemas_missing = self._schemas_missing
+    self._schemas_missing = False
+    return schemas_missing
+
+  def _skip_unknown_rows(self, batch):
+    """
+    :return: The rows of the batch whose schema is known.
+    :type: ``list`` of ``tuple``
+    """
+    schemas = self._schemas
+    known_rows = [x for x in batch.rows if x[0] in schemas]
+    if len(known_rows) != len(batch.rows):
+      self._schemas_missing = True
+      nuoca_log(logging.WARNING,
+                "Skipped %d rows with an unknown batch schema"
+                % (len(batch.rows) - len(known_rows)))
+    return known_rows
+
+  def update_schemas(self, batch):
+    """
+    Learn the new schemas in a batch.  decode() does this itself.
+
+    :param batch: The batch
+    :type batch: ``CollectedBatch``
+    """
+    if batch.schemas:
+      self._schemas.update(batch.schemas)
+
+  def get_schema(self, schema_id):
+    """
+    :return: The keys of a schema.
+    :type: ``tuple``
+    """
+    return self._schemas[schema_id]
+
+  def decode(self, batch):
+    """
+    :param batch: The batch
+    :type batch: ``CollectedBatch``
+
+    :return: time-series values
+    :type: ``list`` of ``dict``
+    """
+    self.update_schemas(batch)
+    schemas = self._schemas
+    return [dict(itertools.izip(schemas[schema_id], values))
+            for schema_id, values in self._skip_unknown_rows(batch)]
+
+
+class PrefixingBatchDecoder(BatchDecoder):
+  """
+  BatchDecoder for the collected values from an Input Plugin.  Each key is
+  prefixed with the row's 'nuocaCollectionName', or with the plugin name,
+  and a 'TimeStamp' value is also stored as the row's 'timestamp'.  The
+  prefixed keys are built once per schema instead of once per row.
+  """
+  COLLECTION_NAME_KEY = 'nuocaCollectionName'
+  MAX_PREFIXED_SCHEMAS = 10000
+
+  def __init__(self, default_prefix):
+    """
+    :param default_prefix: Key prefix for rows without a
+      'nuocaCollectionName', normally the plugin name.
+    :type default_prefix: ``str``
+    """
+    super(PrefixingBatchDecoder, self).__init__()
+    self._default_prefix = default_prefix
+    self._name_indexes = {}
+    self._prefixed_schemas = {}
+
+  def reset(self):
+    super(PrefixingBatchDecoder, self).reset()
+    self._name_indexes = {}
+    self._prefixed_schemas = {}
+
+  def update_schemas(self, batch):
+    super(PrefixingBatchDecoder, self).update_schemas(batch)
+    if batch.schemas:
+      for schema_id in batch.schemas:
+        self._name_indexes.pop(schema_id, None)
+      for cache_key in [x for x in self._prefixed_schemas
+                        if x[0] in batch.schemas]:
+        del self._prefixed_schemas[cache_key]
+
+  def _get_name_index(self, schema_id):
+    schema = self._schemas[schema_id]
+    name_index = None
+    if self.COLLECTION_NAME_KEY in schema:
+      name_index = schema.index(self.COLLECTION_NAME_KEY)
+    self._name_indexes[schema_id] = name_index
+    return name_index
+
+  def _prefix_schema(self, schema_id, key_prefix):
+    schema = self._schemas[schema_id]
+    prefixed_keys = []
+    kept_indexes = []
+    timestamp_key = None
+    for index, key in enumerate(schema):
+      if key == self.COLLECTION_NAME_KEY:
+        continue
+      prefixed_key = key_prefix + '.' + key
+      prefixed_keys.append(prefixed_key)
+      kept_indexes.append(index)
+      if key == 'TimeStamp':
+        timestamp_key = prefixed_key
+    if len(kept_indexes) == len(schema):
+      kept_indexes = None
+    if len(self._prefixed_schemas) > self.MAX_PREFIXED_SCHEMAS:
+      self._prefixed_schemas = {}
+    prefixed_schema = (tuple(prefixed_keys), kept_indexes, timestamp_key)
+    self._prefixed_schemas[(schema_id, key_prefix)] = prefixed_schema
+    return prefixed_schema
+
+  def decode(self, batch):
+    self.update_schemas(batch)
+    rval = []
+    for schema_id, values in self._skip_unknown_rows(batch):
+      if schema_id in self._name_indexes:
+        name_index = self._name_indexes[schema_id]
+      else:
+        name_index = self._get_name_index(schema_id)
+      if name_index is None:
+        key_prefix = self._default_prefix
+      else:
+        key_prefix = values[name_index]
+      prefixed_schema = self._prefixed_schemas.get((schema_id, key_prefix))
+      if prefixed_schema is None:
+        prefixed_schema = self._prefix_schema(schema_id, key_prefix)
+      prefixed_keys, kept_indexes, timestamp_key = prefixed_schema
+      if kept_indexes is not None:
+        values = [values[x] for x in kept_indexes]
+      new_values = dict(itertools.izip(prefixed_keys, values))
+      if timestamp_key is not None:
+        new_values['timestamp'] = int(new_values[timestamp_key])
+      rval.append(new_values)
+    return rval
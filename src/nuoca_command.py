@@ -0,0 +1,329 @@
+"""
+Command execution service for NuoCA plugins.
+
+Starting a shell for every command costs a fork and an exec of /bin/sh
+before the command itself is even started.  A CommandExecutor keeps a
+pool of long-lived /bin/sh worker processes instead.  Each command is
+written to an idle worker, which runs it in a subshell and reports its
+exit code after a unique end marker on stdout and stderr.  Several
+commands run at once on different workers, each with its own timeout.
+
+Results of idempotent commands, such as 'mount' or 'ip a', can be cached
+for a number of seconds.
+
+Plugins normally use the execute_command() and execute_commands()
+functions in nuoca_util.
+"""
+
+import errno
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import uuid
+
+from nuoca_util import nuoca_log, nuoca_monotonic
+
+TIMEOUT_EXIT_CODE = 124  # As returned by the timeout(1) command.
+
+
+class ShellWorker(object):
+  """
+  A long-lived /bin/sh process that runs one command at a time.
+  """
+  READ_SIZE = 65536
+
+  def __init__(self):
+    # The worker gets its own process group, so that a command that times
+    # out can be killed together with its children.
+    self._proc = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  close_fds=True, preexec_fn=os.setsid)
+    self._stdout_fd = self._proc.stdout.fileno()
+    self._stderr_fd = self._proc.stderr.fileno()
+    self._marker = None
+    self._output = None
+    self._deadline = None
+
+  @property
+  def deadline(self):
+    return self._deadline
+
+  def is_alive(self):
+    return self._proc.poll() is None
+
+  def fds(self):
+    """
+    :return: The file descriptors to wait on while a command runs.
+    """
+    return [x for x in (self._stdout_fd, self._stderr_fd)
+            if self._marker not in self._output[x]]
+
+  def start(self, command, timeout=None):
+    """
+    Start a command.
+
+    :param command: command line to execute
+    :type command: ``str``
+
+    :param timeout: Optional maximum seconds for the command.
+    :type timeout: ``float``
+    """
+    self._marker = '__NUOCA_END_%s__' % uuid.uuid4().hex
+    self._output = {self._stdout_fd: '', self._stderr_fd: ''}
+    self._deadline = None
+    if timeout is not None:
+      self._deadline = nuoca_monotonic() + timeout
+    script = "(%s\n) </dev/null\n" \
+             "printf '%s %%d\\n' $?\n" \
+             "printf '%s\\n' >&2\n" % (command, self._marker, self._marker)
+    self._proc.stdin.write(script)
+    self._proc.stdin.flush()
+
+  def read(self, fd):
+    """
+    Read the output that is ready on one of the fds().
+
+    :return: True if the command has finished.
+    """
+    try:
+      data = os.read(fd, self.READ_SIZE)
+    except OSError as e:
+      if e.errno in (errno.EINTR, errno.EAGAIN):
+        return False
+      raise
+    if not data:
+      raise IOError("Shell worker exited")
+    self._output[fd] += data
+    return not self.fds()
+
+  def result(self):
+    """
+    :return: (exit_code, stdout, stderr) of the finished command.
+    """
+    stdout, _, exit_line = self._output[self._stdout_fd].rpartition(
+        self._marker)
+    stderr = self._output[self._stderr_fd].rpartition(self._marker)[0]
+    self._marker = None
+    self._output = None
+    self._deadline = None
+    return int(exit_line.split()[0]), stdout, stderr
+
+  def partial_result(self, error_msg):
+    """
+    :return: (TIMEOUT_EXIT_CODE, stdout, stderr) with the output so far.
+    """
+    stdout = self._output[self._stdout_fd]
+    stderr = self._output[self._stderr_fd] + error_msg
+    return TIMEOUT_EXIT_CODE, stdout, stderr
+
+  def kill(self):
+    try:
+      os.killpg(self._proc.pid, signal.SIGKILL)
+    except OSError:
+      pass
+    self._proc.wait()
+    self.close()
+
+  def close(self):
+    for pipe in (self._proc.stdin, self._proc.stdout, self._proc.stderr):
+      try:
+        pipe.close()
+      except (IOError, OSError):
+        pass
+    if self._proc.poll() is None:
+      try:
+        os.killpg(self._proc.pid, signal.SIGTERM)
+      except OSError:
+        pass
+      self._proc.wait()
+
+
+class CommandExecutor(object):
+  """
+  Thread safe pool of ShellWorker processes.  Workers are started when
+  they are first needed and are reused.  A worker whose command times out
+  is killed and replaced.  Commands from different threads run at the same
+  time, up to max_workers in all.
+  """
+  def __init__(self, max_workers=4, default_timeout=None):
+    """
+    :param max_workers: Maximum number of commands that run at once.
+    :type max_workers: ``int``
+
+    :param default_timeout: Maximum seconds for a command that is run
+      without a timeout, or None for no limit.
+    :type default_timeout: ``float``
+    """
+    if max_workers < 1:
+      raise AttributeError("CommandExecutor needs at least one worker")
+    self._max_workers = max_workers
+    self._default_timeout = default_timeout
+    self._idle_workers = []
+    self._busy_workers = 0
+    # Held only for the worker pool and the cache, never while a command
+    # runs.
+    self._lock = threading.Lock()
+    self._worker_released = threading.Condition(self._lock)
+    self._cache = {}
+
+  def close(self):
+    with self._lock:
+      for worker in self._idle_workers:
+        worker.close()
+      self._idle_workers = []
+      self._cache = {}
+
+  def _acquire_worker(self, wait):
+    """
+    :param wait: Wait for a worker while max_workers commands are running.
+    :type wait: ``bool``
+
+    :return: An idle or new worker, or None if none is free and wait is
+      False.
+    :type: ``ShellWorker``
+    """
+    with self._lock:
+      while self._busy_workers >= self._max_workers:
+        if not wait:
+          return None
+        self._worker_released.wait()
+      self._busy_workers += 1
+      while self._idle_workers:
+        worker = self._idle_workers.pop()
+        if worker.is_alive():
+          return worker
+        worker.close()
+    try:
+      return ShellWorker()
+    except Exception:
+      self._release_worker(None)
+      raise
+
+  def _release_worker(self, worker):
+    """
+    :param worker: A worker that is idle again, or None for a worker that
+      was closed.
+    :type worker: ``ShellWorker``
+    """
+    with self._lock:
+      self._busy_workers -= 1
+      if worker:
+        self._idle_workers.append(worker)
+      self._worker_released.notify()
+
+  def execute(self, command, timeout=None, cache_ttl=None):
+    """
+    Execute a posix command.
+
+    :param command: command line to execute
+    :type command: ``str``
+
+    :param timeout: Optional maximum seconds for the command.  None means
+      the default timeout.
+    :type timeout: ``float``
+
+    :param cache_ttl: Return the result of the same command from up to
+      this many seconds ago, instead of running it again.
+    :type cache_ttl: ``float``
+
+    :return: Python tuple of (exit_code, stdout, stderr)
+    """
+    if cache_ttl:
+      with self._lock:
+        cached = self._cache.get(command)
+      if cached and nuoca_monotonic() - cached[0] < cache_ttl:
+        return cached[1]
+    result = self.execute_all([command], timeout)[0]
+    if cache_ttl and result[0] == 0:
+      with self._lock:
+        self._cache[command] = (nuoca_monotonic(), result)
+    return result
+
+  def execute_all(self, commands, timeout=None):
+    """
+    Execute posix commands concurrently, up to max_workers at once.
+
+    :param commands: command lines to execute
+    :type commands: ``list`` of ``str``
+
+    :param timeout: Optional maximum seconds for each command.  None
+      means the default timeout.
+    :type timeout: ``float``
+
+    :return: ``list`` of (exit_code, stdout, stderr), in the order of the
+      commands.  A command that times out gets exit code 124.
+    """
+    if timeout is None:
+      timeout = self._default_timeout
+    results = [None] * len(commands)
+    pending = list(enumerate(commands))
+    pending.reverse()
+    running = {}  # Command index by worker
+    try:
+      while pending or running:
+        while pending:
+          # Wait for a worker only when none of these commands is running.
+          worker = self._acquire_worker(wait=not running)
+          if not worker:
+            break
+          index, command = pending.pop()
+          try:
+            worker.start(command, timeout)
+          except (IOError, OSError) as e:
+            worker.close()
+            self._release_worker(None)
+            results[index] = (-1, '', "Unable to run command: %s" % str(e))
+            continue
+          running[worker] = index
+        if not running:
+          continue
+
+        fd_workers = {}
+        for worker in running:
+          for fd in worker.fds():
+            fd_workers[fd] = worker
+        deadlines = [x.deadline for x in running if x.deadline is not None]
+        wait_time = None
+        if deadlines:
+          wait_time = max(0.0, min(deadlines) - nuoca_monotonic())
+        try:
+          ready_fds = select.select(fd_workers.keys(), [], [], wait_time)[0]
+        except select.error as e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+
+        for fd in ready_fds:
+          worker = fd_workers[fd]
+          if worker not in running:
+            continue
+          try:
+            if worker.read(fd):
+              results[running.pop(worker)] = worker.result()
+              self._release_worker(worker)
+          except (IOError, OSError) as e:
+            results[running.pop(worker)] = \
+                (-1, '', "Shell worker failed: %s" % str(e))
+            worker.close()
+            self._release_worker(None)
+
+        now = nuoca_monotonic()
+        for worker in [x for x in running
+                       if x.deadline is not None and x.deadline <= now]:
+          index = running.pop(worker)
+          nuoca_log(logging.WARNING, "Command timed out after %s seconds: %s"
+                    % (str(timeout), commands[index]))
+          results[index] = worker.partial_result(
+              "Command timed out after %s seconds\n" % str(timeout))
+          worker.kill()
+          self._release_worker(None)
+    finally:
+      # Only after an unexpected exception.
+      for worker in running:
+        worker.kill()
+        self._release_worker(None)
+    return results
@@ -13,7 +13,46 @@ class NuocaConfig(object):
   """
   NUOCA_TMPDIR = '/tmp/nuoca'  # Temporary directory for NuoCA
   NUOCA_LOGFILE = '/tmp/nuoca/nuoca.log'  # Path to logfile for NuoCA
+  # The logfile is written at most once per LOG_FLUSH_INTERVAL seconds,
+  # unless LOG_FLUSH_RECORDS log records are waiting.
+  LOG_FLUSH_INTERVAL = 1
+  LOG_FLUSH_RECORDS = 100
   PLUGIN_PIPE_TIMEOUT = 5  # Plugin communication pipe timeout in seconds
+  # Learn each plugin's collect, store and transform timeouts from its
+  # response latencies, between PLUGIN_MIN_TIMEOUT and PLUGIN_MAX_TIMEOUT.
+  # PLUGIN_MAX_TIMEOUT is also used until a timeout is learned.  None means
+  # PLUGIN_PIPE_TIMEOUT.
+  PLUGIN_ADAPTIVE_TIMEOUT = False
+  PLUGIN_MIN_TIMEOUT = 1
+  PLUGIN_MAX_TIMEOUT = None
+  # Consecutive timeouts before a plugin is quarantined and restarted, and
+  # the first and maximum seconds to wait before restarting it.
+  PLUGIN_MAX_FAILURES = 3
+  PLUGIN_RESTART_BACKOFF = 1
+  PLUGIN_RESTART_MAX_BACKOFF = 300
+  # What to do with collection intervals that pass while a collection cycle
+  # overruns: 'skip', 'catch_up' or 'coalesce'.  An interval that passed by
+  # less than SCHEDULE_TOLERANCE seconds is not an overrun.
+  SCHEDULE_OVERRUN_POLICY = 'skip'
+  SCHEDULE_TOLERANCE = 0.001
+  # Long-lived shell processes that run execute_command() commands, per
+  # NuoCA or plugin process.  Also the most commands that run at once.
+  COMMAND_WORKERS = 4
+  # Max seconds for an execute_command() command that sets no timeout.
+  COMMAND_TIMEOUT = 60
+  # Seconds to reuse a scan of /proc for process lookups.
+  PROCESS_INDEX_TTL = 1
+  # Max seconds to wait for all input plugins in one collection cycle.
+  # None means the collection interval.
+  COLLECTION_CYCLE_TIMEOUT = None
+  # Max collection cycles queued for the output plugins, and what to do
+  # when the queue is full: 'drop_oldest' loses the oldest cycle, 'spill'
+  # writes cycles to disk until the queue drains, and 'block' keeps every
+  # cycle but delays collection until a slow output plugin catches up.
+  OUTPUT_QUEUE_SIZE = 60
+  OUTPUT_QUEUE_POLICY = 'drop_oldest'
+  # Bytes in each direction of the ring for plugins with 'nuocaTransport: shm'
+  SHM_RING_SIZE = 8 * 1024 * 1024
   NUOCA_CONFIG_FILE = None
   SELFTEST_LOOP_COUNT = 5  # Number of Collection Intervals in selftest.
   SUBPROCESS_EXIT_TIMEOUT = 5  # Max seconds to wait for subprocess exit
@@ -0,0 +1,229 @@
+"""
+Output dispatcher for NuoCA.
+
+The collection loop hands each cycle's time-series values to an
+OutputDispatcher, which queues them and delivers them to the output plugins
+on its own thread.  A slow output plugin then delays only the dispatcher,
+never the next collection interval.
+"""
+
+import cPickle
+import logging
+import os
+import threading
+
+from nuoca_util import nuoca_log, nuoca_monotonic, BoundedQueue
+
+
+class OutputDispatcher(object):
+  """
+  Bounded queue of collection cycles plus the thread that drains it.
+
+  Overflow policies, applied when the queue is full:
+
+    block: the collection loop waits for the dispatcher to make room, so
+      a slow output plugin delays collection again.
+    drop_oldest: the oldest queued cycle is discarded.  Collection is
+      never delayed, but a slow output plugin loses values.  The default.
+    spill: cycles are written to files in the spill directory and are
+      delivered, in order, once the queue has drained.  Collection is
+      not delayed and no values are lost, at the cost of disk space.
+  """
+  BLOCK = BoundedQueue.BLOCK
+  DROP_OLDEST = BoundedQueue.DROP_OLDEST
+  SPILL = 'spill'
+  POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+  def __init__(self, store_func, max_batches, overflow_policy=DROP_OLDEST,
+               spill_dir=None):
+    """
+    :param store_func: Called on the dispatcher thread with the list of
+      time-series values from one collection cycle.
+    :type store_func: ``callable``
+
+    :param max_batches: Maximum number of collection cycles in the queue.
+    :type max_batches: ``int``
+
+    :param overflow_policy: One of OutputDispatcher.POLICIES
+    :type overflow_policy: ``str``
+
+    :param spill_dir: Directory for spilled cycles.  Required by the
+      spill policy.
+    :type spill_dir: ``str``
+    """
+    if overflow_policy not in self.POLICIES:
+      raise AttributeError("Unknown OUTPUT_QUEUE_POLICY: %s" %
+                           overflow_policy)
+    if overflow_policy == self.SPILL and not spill_dir:
+      raise AttributeError("The spill OUTPUT_QUEUE_POLICY needs a "
+                           "spill directory")
+    self._store_func = store_func
+    self._overflow_policy = overflow_policy
+    queue_policy = overflow_policy
+    if overflow_policy == self.SPILL:
+      queue_policy = BoundedQueue.DROP_NEWEST
+    self._queue = BoundedQueue(max_batches, queue_policy)
+    self._spill_dir = spill_dir
+    # Guards the spill files and the counters, which are updated on both
+    # the collection thread and the dispatcher thread.
+    self._lock = threading.Lock()
+    self._spill_files = []
+    self._spill_seq = 0
+    self._thread = None
+    self._stopping = False
+    self._stop_now = False
+    self._dropped_batches = 0
+    self._dropped_rows = 0
+    self._spilled_batches = 0
+    self._delivered_batches = 0
+    if self._spill_dir:
+      self._init_spill_dir()
+
+  def _init_spill_dir(self):
+    if not os.path.exists(self._spill_dir):
+      os.makedirs(self._spill_dir)
+    stale_files = [x for x in os.listdir(self._spill_dir)
+                   if x.endswith('.spill')]
+    for stale_file in stale_files:
+      os.remove(os.path.join(self._spill_dir, stale_file))
+    if stale_files:
+      nuoca_log(logging.WARNING,
+                "OutputDispatcher: removed %d stale spill files from %s"
+                % (len(stale_files), self._spill_dir))
+
+  @property
+  def queue_depth(self):
+    return len(self._queue) + len(self._spill_files)
+
+  def get_stats(self):
+    """
+    :return: Queue depth and drop counters.
+    :type: ``dict``
+    """
+    with self._lock:
+      return {'queue_depth': len(self._queue),
+              'spill_depth': len(self._spill_files),
+              'dropped_batches': self._dropped_batches,
+              'dropped_rows': self._dropped_rows,
+              'spilled_batches': self._spilled_batches,
+              'delivered_batches': self._delivered_batches}
+
+  def start(self):
+    self._stopping = False
+    self._stop_now = False
+    self._thread = threading.Thread(target=self._dispatcher_thread,
+                                    name='nuoca-output-dispatcher')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout=None):
+    """
+    Deliver what is still queued and stop the dispatcher thread.  When
+    the queue has not drained after the timeout, the rest of the queue is
+    not delivered, but the collection cycle that is being delivered is
+    still waited for, so that the output plugins are not shut down while
+    they are in use.  Its delivery is bounded by the plugin response
+    timeouts.
+
+    :param timeout: Maximum seconds to wait for the queue to drain.
+    :type timeout: ``float``
+    """
+    if not self._thread:
+      return
+    self._stopping = True
+    self._thread.join(timeout)
+    if self._thread.is_alive():
+      self._stop_now = True
+      if self.queue_depth:
+        nuoca_log(logging.WARNING,
+                  "OutputDispatcher: stopped with %d collection cycles "
+                  "undelivered" % self.queue_depth)
+      self._thread.join()
+    self._thread = None
+    nuoca_log(logging.INFO, "OutputDispatcher stats: %s" %
+              str(self.get_stats()))
+
+  def put(self, batch):
+    """
+    Queue the time-series values from one collection cycle.
+
+    :param batch: time-series values
+    :type batch: ``list`` of ``dict``
+    """
+    if not batch:
+      return
+    if self._overflow_policy == self.SPILL:
+      with self._lock:
+        # Once spilling starts, keep spilling until the spill files are
+        # delivered so that collection cycles stay in order.
+        if self._spill_files or self._queue.put(batch) is not None:
+          self._spill(batch)
+      return
+    dropped_batch = self._queue.put(batch)
+    if dropped_batch is not None:
+      with self._lock:
+        self._dropped_batches += 1
+        self._dropped_rows += len(dropped_batch)
+      nuoca_log(logging.WARNING,
+                "OutputDispatcher: queue full, dropped %d rows"
+                % len(dropped_batch))
+
+  def _spill(self, batch):
+    # Called with the lock held.
+    self._spill_seq += 1
+    spill_path = os.path.join(self._spill_dir,
+                              "%012d.spill" % self._spill_seq)
+    try:
+      with open(spill_path, 'wb') as spill_file:
+        cPickle.dump(batch, spill_file, cPickle.HIGHEST_PROTOCOL)
+      self._spill_files.append(spill_path)
+      self._spilled_batches += 1
+    except Exception as e:
+      self._dropped_batches += 1
+      self._dropped_rows += len(batch)
+      nuoca_log(logging.ERROR,
+                "OutputDispatcher: unable to spill %d rows: %s"
+                % (len(batch), str(e)))
+
+  def _unspill(self):
+    with self._lock:
+      if not self._spill_files:
+        return None
+      spill_path = self._spill_files.pop(0)
+    try:
+      with open(spill_path, 'rb') as spill_file:
+        batch = cPickle.load(spill_file)
+      os.remove(spill_path)
+      return batch
+    except Exception as e:
+      nuoca_log(logging.ERROR,
+                "OutputDispatcher: unable to read spill file %s: %s"
+                % (spill_path, str(e)))
+      return None
+
+  def _dispatcher_thread(self):
+    while not self._stop_now:
+      if self._spill_files:
+        batch = self._queue.get(timeout=0)
+        if batch is None:
+          batch = self._unspill()
+      else:
+        batch = self._queue.get(timeout=0.5)
+      if batch is None:
+        if self._stopping and not self.queue_depth:
+          break
+        continue
+      if self._stop_now:
+        break
+      start_time = nuoca_monotonic()
+      # noinspection PyBroadException
+      try:
+        self._store_func(batch)
+        with self._lock:
+          self._delivered_batches += 1
+      except Exception as e:
+        nuoca_log(logging.ERROR,
+                  "OutputDispatcher: store error: %s" % str(e))
+      nuoca_log(logging.DEBUG,
+                "OutputDispatcher: stored %d rows in %.3f seconds",
+                len(batch), nuoca_monotonic() - start_time)
@@ -0,0 +1,295 @@
+"""
+Grok patterns for NuoCA, without Logstash.
+
+A grok pattern is a regular expression that refers to named patterns:
+
+  %{TIMESTAMP_ISO8601:timestamp} %{LOGLEVEL:loglevel} %{GREEDYDATA}
+
+GrokLibrary expands such a pattern into one precompiled Python regular
+expression.  Each %{NAME:field} becomes a group that captures 'field';
+%{NAME} and the groups of the named patterns do not capture.  Oniguruma
+named groups, (?<field>...), capture 'field' too.  The captures are
+returned in the order of the pattern, and the same field can be captured
+more than once, as in Logstash.
+
+GrokFilter applies the Logstash grok filter to an event dict: the first
+pattern that matches sets the captured fields, following the same
+keep_empty_captures and overwrite rules, and an event that no pattern
+matches is tagged with '_grokparsefailure'.
+
+The base patterns are the ones of the Logstash grok-patterns file that
+NuoCA uses.  More patterns are loaded from files in the Logstash format,
+such as etc/logstash/nuodb_patterns/agent_log.
+"""
+
+import os
+import re
+
+GROK_BASE_PATTERNS = r"""
+USERNAME [a-zA-Z0-9._-]+
+USER %{USERNAME}
+INT (?:[+-]?(?:[0-9]+))
+BASE10NUM (?<![0-9.+-])(?>[+-]?(?:(?:[0-9]+(?:\.[0-9]+)?)|(?:\.[0-9]+)))
+NUMBER (?:%{BASE10NUM})
+BASE16NUM (?<![0-9A-Fa-f])(?:[+-]?(?:0x)?(?:[0-9A-Fa-f]+))
+POSINT \b(?:[1-9][0-9]*)\b
+NONNEGINT \b(?:[0-9]+)\b
+WORD \b\w+\b
+NOTSPACE \S+
+SPACE \s*
+DATA .*?
+GREEDYDATA .*
+QUOTEDSTRING (?>(?<!\\)(?>"(?>\\.|[^\\"]+)+"|""|(?>'(?>\\.|[^\\']+)+')|''|(?>`(?>\\.|[^\\`]+)+`)|``))
+UUID [A-Fa-f0-9]{8}-(?:[A-Fa-f0-9]{4}-){3}[A-Fa-f0-9]{12}
+IPV6 ((([0-9A-Fa-f]{1,4}:){7}([0-9A-Fa-f]{1,4}|:))|(([0-9A-Fa-f]{1,4}:){6}(:[0-9A-Fa-f]{1,4}|((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9A-Fa-f]{1,4}:){5}(((:[0-9A-Fa-f]{1,4}){1,2})|:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3})|:))|(([0-9A-Fa-f]{1,4}:){4}(((:[0-9A-Fa-f]{1,4}){1,3})|((:[0-9A-Fa-f]{1,4})?:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9A-Fa-f]{1,4}:){3}(((:[0-9A-Fa-f]{1,4}){1,4})|((:[0-9A-Fa-f]{1,4}){0,2}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9A-Fa-f]{1,4}:){2}(((:[0-9A-Fa-f]{1,4}){1,5})|((:[0-9A-Fa-f]{1,4}){0,3}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(([0-9A-Fa-f]{1,4}:){1}(((:[0-9A-Fa-f]{1,4}){1,6})|((:[0-9A-Fa-f]{1,4}){0,4}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:))|(:(((:[0-9A-Fa-f]{1,4}){1,7})|((:[0-9A-Fa-f]{1,4}){0,5}:((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}))|:)))(%.+)?
+IPV4 (?<![0-9])(?:(?:[0-1]?[0-9]{1,2}|2[0-4][0-9]|25[0-5])[.](?:[0-1]?[0-9]{1,2}|2[0-4][0-9]|25[0-5])[.](?:[0-1]?[0-9]{1,2}|2[0-4][0-9]|25[0-5])[.](?:[0-1]?[0-9]{1,2}|2[0-4][0-9]|25[0-5]))(?![0-9])
+IP (?:%{IPV6}|%{IPV4})
+HOSTNAME \b(?:[0-9A-Za-z][0-9A-Za-z-]{0,62})(?:\.(?:[0-9A-Za-z][0-9A-Za-z-]{0,62}))*(\.?|\b)
+IPORHOST (?:%{IP}|%{HOSTNAME})
+HOSTPORT %{IPORHOST}:%{POSINT}
+PATH (?:%{UNIXPATH}|%{WINPATH})
+UNIXPATH (/([\w_%!$@:.,+~-]+|\\.)*)+
+WINPATH (?>[A-Za-z]+:|\\)(?:\\[^\\?*]*)+
+MONTHNUM (?:0?[1-9]|1[0-2])
+MONTHDAY (?:(?:0[1-9])|(?:[12][0-9])|(?:3[01])|[1-9])
+YEAR (?>\d\d){1,2}
+HOUR (?:2[0123]|[01]?[0-9])
+MINUTE (?:[0-5][0-9])
+SECOND (?:(?:[0-5]?[0-9]|60)(?:[:.,][0-9]+)?)
+TIME (?!<[0-9])%{HOUR}:%{MINUTE}(?::%{SECOND})(?![0-9])
+ISO8601_TIMEZONE (?:Z|[+-]%{HOUR}(?::?%{MINUTE}))
+ISO8601_SECOND (?:%{SECOND}|60)
+TIMESTAMP_ISO8601 %{YEAR}-%{MONTHNUM}-%{MONTHDAY}[T ]%{HOUR}:?%{MINUTE}(?::?%{SECOND})?%{ISO8601_TIMEZONE}?
+LOGLEVEL ([Aa]lert|ALERT|[Tt]race|TRACE|[Dd]ebug|DEBUG|[Nn]otice|NOTICE|[Ii]nfo|INFO|[Ww]arn?(?:ing)?|WARN?(?:ING)?|[Ee]rr?(?:or)?|ERR?(?:OR)?|[Cc]rit?(?:ical)?|CRIT?(?:ICAL)?|[Ff]atal|FATAL|[Ss]evere|SEVERE|EMERG(?:ENCY)?|[Ee]merg(?:ency)?)
+"""
+
+GROK_PARSE_FAILURE = '_grokparsefailure'
+
+# %{NAME}, %{NAME:field} or %{NAME:field:type}; an Oniguruma named group;
+# an Oniguruma atomic group, which Python does not have; an escape or a
+# character class, copied as is; a plain group, which does not capture:
+# Python supports only 100 groups.
+_GROK_TOKEN = re.compile(
+    r'%\{(?P<name>\w+)(?::(?P<field>[\w@\[\].-]+))?(?::\w+)?\}'
+    r'|\(\?<(?P<group>[A-Za-z_]\w*)>'
+    r'|(?P<atomic>\(\?>)'
+    r'|(?P<verbatim>\\.|\[\^?\]?(?:\\.|[^\]\\])*\])'
+    r'|(?P<plain>\((?!\?))')
+
+
+def parse_patterns(lines):
+  """
+  :param lines: Lines of a pattern file: 'NAME pattern', blank lines and
+    '#' comments.
+  :type lines: iterable of ``str``
+
+  :return: Patterns by name.
+  :type: ``dict``
+  """
+  patterns = {}
+  for line in lines:
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    fields = line.split(None, 1)
+    if len(fields) == 2:
+      patterns[fields[0]] = fields[1]
+  return patterns
+
+
+class GrokPattern(object):
+  """
+  A compiled grok pattern.
+  """
+  def __init__(self, pattern, regex, fields):
+    """
+    :param pattern: The grok pattern.
+    :type pattern: ``str``
+
+    :param regex: The compiled regular expression.
+    :param fields: The field captured by each group of the regex, in the
+      order of the groups.
+    :type fields: ``list`` of ``str``
+    """
+    self._pattern = pattern
+    self._regex = regex
+    self._fields = fields
+    self._groups = [regex.groupindex['g%d' % x] for x in range(len(fields))]
+
+  @property
+  def pattern(self):
+    return self._pattern
+
+  @property
+  def regex(self):
+    return self._regex
+
+  @property
+  def fields(self):
+    return self._fields
+
+  def match(self, text):
+    """
+    :param text: Text to search for the pattern.
+    :type text: ``str``
+
+    :return: (field, value) of each capture, in the order of the pattern,
+      or None if the pattern does not match.  The value of a group that
+      did not participate in the match is None.
+    :type: ``list`` of ``tuple``
+    """
+    match = self._regex.search(text)
+    if not match:
+      return None
+    return zip(self._fields, [match.group(x) for x in self._groups])
+
+
+class GrokLibrary(object):
+  """
+  Named grok patterns, and a cache of compiled grok patterns.
+  """
+  def __init__(self, patterns=None):
+    """
+    :param patterns: Patterns by name, in addition to the base patterns.
+    :type patterns: ``dict``
+    """
+    self._patterns = parse_patterns(GROK_BASE_PATTERNS.splitlines())
+    if patterns:
+      self._patterns.update(patterns)
+    self._compiled = {}
+
+  def add_patterns_from_file(self, path):
+    with open(path) as pattern_file:
+      self._patterns.update(parse_patterns(pattern_file))
+    self._compiled.clear()
+
+  def add_patterns_from_dir(self, path):
+    """
+    Load every pattern file in a directory, like Logstash patterns_dir.
+    """
+    for name in sorted(os.listdir(path)):
+      file_path = os.path.join(path, name)
+      if os.path.isfile(file_path):
+        self.add_patterns_from_file(file_path)
+
+  def _expand(self, pattern, fields, stack):
+    parts = []
+    position = 0
+    for token in _GROK_TOKEN.finditer(pattern):
+      parts.append(pattern[position:token.start()])
+      position = token.end()
+      if token.group('verbatim'):
+        parts.append(token.group())
+      elif token.group('atomic') or token.group('plain'):
+        parts.append('(?:')
+      elif token.group('group'):
+        parts.append('(?P<g%d>' % len(fields))
+        fields.append(token.group('group'))
+      else:
+        name = token.group('name')
+        if name not in self._patterns:
+          raise AttributeError("Undefined grok pattern: %s" % name)
+        if name in stack:
+          raise AttributeError("Recursive grok pattern: %s" % name)
+        if token.group('field'):
+          parts.append('(?P<g%d>' % len(fields))
+          fields.append(token.group('field'))
+        else:
+          parts.append('(?:')
+        parts.append(self._expand(self._patterns[name], fields,
+                                  stack + [name]))
+        parts.append(')')
+    parts.append(pattern[position:])
+    return ''.join(parts)
+
+  def compile(self, pattern):
+    """
+    :param pattern: A grok pattern.
+    :type pattern: ``str``
+
+    :return: The compiled pattern.  '.' matches newlines, as in Logstash.
+    :type: ``GrokPattern``
+    """
+    compiled = self._compiled.get(pattern)
+    if compiled is None:
+      fields = []
+      regex = self._expand(pattern, fields, [])
+      try:
+        compiled = GrokPattern(pattern, re.compile(regex, re.DOTALL), fields)
+      except re.error as e:
+        raise AttributeError("Invalid grok pattern '%s': %s" %
+                             (pattern, str(e)))
+      self._compiled[pattern] = compiled
+    return compiled
+
+
+def add_tag(event, tag):
+  tags = event.setdefault('tags', [])
+  if tag not in tags:
+    tags.append(tag)
+
+
+class GrokFilter(object):
+  """
+  The Logstash grok filter, for one field of an event dict.
+  """
+  def __init__(self, library, patterns, field='message', overwrite=(),
+               keep_empty_captures=False):
+    """
+    :param library: Named patterns.
+    :type library: ``GrokLibrary``
+
+    :param patterns: Grok patterns, tried in order until one matches.
+    :type patterns: ``str`` or ``list`` of ``str``
+
+    :param field: Field of the event to match.
+    :type field: ``str``
+
+    :param overwrite: Fields that a capture replaces.  Other fields that
+      already have a value become lists of values.
+    :type overwrite: ``list`` of ``str``
+
+    :param keep_empty_captures: Set fields whose captures are empty or
+      did not participate in the match to their value, instead of
+      skipping them.
+    :type keep_empty_captures: ``bool``
+    """
+    if isinstance(patterns, basestring):
+      patterns = [patterns]
+    self._patterns = [library.compile(x) for x in patterns]
+    self._field = field
+    self._overwrite = set(overwrite)
+    self._keep_empty_captures = keep_empty_captures
+
+  def _handle(self, event, field, value):
+    if not self._keep_empty_captures and (value is None or value == ''):
+      return
+    if field in self._overwrite:
+      event[field] = value
+      return
+    current = event.get(field)
+    if current is None:
+      event[field] = value
+    elif isinstance(current, list):
+      current.append(value)
+    else:
+      event[field] = [current, value]
+
+  def apply(self, event):
+    """
+    :param event: Event to match and update.
+    :type event: ``dict``
+
+    :return: True if a pattern matched.
+    :type: ``bool``
+    """
+    text = event.get(self._field)
+    if isinstance(text, basestring):
+      for pattern in self._patterns:
+        captures = pattern.match(text)
+        if captures is not None:
+          for field, value in captures:
+            self._handle(event, field, value)
+          return True
+    add_tag(event, GROK_PARSE_FAILURE)
+    return False
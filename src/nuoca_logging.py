@@ -0,0 +1,198 @@
+"""
+Asynchronous, batched logging for NuoCA.
+
+NuoCA and its plugin processes log through a QueueLogHandler.  In the
+NuoCA process, a log record is appended to an in-memory queue and the
+call returns.  In a plugin process, the record is formatted and sent to
+NuoCA as one datagram over a Unix socket that is created before the
+plugins are forked.  A single LogWriter thread in the NuoCA process
+writes the records from both to the log file in batches, and flushes the
+file on a timer or when enough records have been written.
+"""
+
+import collections
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+
+class LogChannel(object):
+  """
+  Datagram socket pair that carries formatted log lines from the plugin
+  processes to the LogWriter.
+  """
+  MAX_DATAGRAM = 65000
+
+  def __init__(self):
+    self.recv_sock, self.send_sock = socket.socketpair(socket.AF_UNIX,
+                                                       socket.SOCK_DGRAM)
+    self.recv_sock.setblocking(False)
+
+  def send(self, line, block=True):
+    """
+    Send a log line.  An empty line wakes up the LogWriter.
+
+    :param line: The log line
+    :type line: ``str``
+
+    :param block: Wait for room in the socket buffer.  Otherwise the line
+      is dropped if there is no room.
+    :type block: ``bool``
+    """
+    flags = 0
+    if not block:
+      flags = socket.MSG_DONTWAIT
+    try:
+      self.send_sock.send(line[:self.MAX_DATAGRAM], flags)
+    except socket.error:
+      pass
+
+  def recv_all(self):
+    """
+    :return: The log lines that are ready, without blocking.
+    :type: ``list`` of ``str``
+    """
+    lines = []
+    while True:
+      try:
+        lines.append(self.recv_sock.recv(self.MAX_DATAGRAM))
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return lines
+        raise
+
+  def close(self):
+    self.recv_sock.close()
+    self.send_sock.close()
+
+
+class QueueLogHandler(logging.Handler):
+  """
+  Logging handler that hands records to a LogWriter instead of writing
+  them.
+  """
+  def __init__(self, log_writer, level=logging.NOTSET):
+    logging.Handler.__init__(self, level)
+    self._log_writer = log_writer
+
+  def emit(self, record):
+    self._log_writer.put(self, record)
+
+
+class LogWriter(object):
+  """
+  The thread that writes all NuoCA log records to the log file.
+  """
+  def __init__(self, logfile_name, flush_interval=1.0, flush_records=100):
+    """
+    :param logfile_name: Path of the log file.
+    :type logfile_name: ``str``
+
+    :param flush_interval: Maximum seconds that a record stays unflushed.
+    :type flush_interval: ``float``
+
+    :param flush_records: Flush after this many records.
+    :type flush_records: ``int``
+    """
+    self._logfile_name = logfile_name
+    self._flush_interval = flush_interval
+    self._flush_records = flush_records
+    self._owner_pid = os.getpid()
+    self._queue = collections.deque()
+    self._channel = LogChannel()
+    # Written with os.write(), so that a forked plugin process has no
+    # copy of buffered lines.
+    self._fd = os.open(logfile_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                       0o644)
+    self._pending = []
+    self._enabled = False
+    self._thread = None
+
+  def put(self, handler, record):
+    """
+    Queue a log record.  Called by QueueLogHandler.emit() in any process.
+    """
+    if os.getpid() != self._owner_pid:
+      # A plugin process: format here and send the line to NuoCA.
+      try:
+        self._channel.send(handler.format(record) + '\n')
+      except Exception:
+        handler.handleError(record)
+      return
+    self._queue.append((handler, record))
+    if len(self._queue) % self._flush_records == 0:
+      self._channel.send('', block=False)
+
+  def start(self):
+    self._enabled = True
+    self._thread = threading.Thread(target=self._run, name='NuocaLogWriter')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout=5):
+    """
+    Write and flush the remaining records, and close the log file.
+    """
+    if os.getpid() != self._owner_pid:
+      return
+    self._enabled = False
+    self._channel.send('', block=False)
+    if self._thread:
+      self._thread.join(timeout)
+      self._thread = None
+    self._gather_pending()
+    self._flush()
+    os.close(self._fd)
+    self._channel.close()
+
+  def _gather_pending(self):
+    """
+    Format the queued records and receive the lines from the plugin
+    processes.
+    """
+    while self._queue:
+      handler, record = self._queue.popleft()
+      try:
+        self._pending.append(handler.format(record) + '\n')
+      except Exception:
+        handler.handleError(record)
+    self._pending.extend([x for x in self._channel.recv_all() if x])
+
+  def _flush(self):
+    if not self._pending:
+      return
+    data = ''.join(self._pending)
+    self._pending = []
+    while data:
+      try:
+        written = os.write(self._fd, data)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      data = data[written:]
+
+  def _run(self):
+    last_flush_time = time.time()
+    while self._enabled:
+      timeout = self._flush_interval
+      if self._pending:
+        timeout = max(0.0, last_flush_time + self._flush_interval -
+                      time.time())
+      try:
+        select.select([self._channel.recv_sock], [], [], timeout)
+      except select.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+      self._gather_pending()
+      now = time.time()
+      # At most one write per flush interval, unless many records wait.
+      if self._pending and \
+          (len(self._pending) >= self._flush_records or
+           now - last_flush_time >= self._flush_interval):
+        self._flush()
+        last_flush_time = now
@@ -0,0 +1,294 @@
+"""
+Logstash style event input for NuoCA.
+
+LogstashInputPlugin is the base class of the input plugins that collect
+Logstash events: the Logstash plugin, which runs Logstash and reads the
+events that it writes to stdout, and the NuoAdminAgentLog plugin, which
+parses the NuoDB agent.log itself.  The events are gathered by a
+background thread into a bounded collect queue, and each collection
+drains the queue.  The base class handles the configuration items that
+do not depend on how the events are read: logstashSincedbPath,
+nuocaCollectionName, host_uuid_shortname and the collect queue items.
+
+The plugins live in separate plugin modules that Yapsy loads by path, so
+the code that they share is kept here, in src, rather than imported from
+one plugin module into the other.
+
+JsonLinesReader reads the events of a Logstash json_lines stdout.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+
+from nuoca_plugin import NuocaMPInputPlugin
+from nuoca_util import nuoca_log, nuoca_monotonic, TimestampParser
+
+
+class JsonLinesReader(object):
+  """
+  Reads JSON lines from a file descriptor a block at a time, and decodes
+  the complete lines of each block together.
+  """
+  def __init__(self, fd, block_size=1048576, max_logged_messages=10,
+               log_interval=60.0, clock=nuoca_monotonic):
+    """
+    :param fd: File descriptor to read.
+    :type fd: ``int``
+
+    :param block_size: Bytes read at once.
+    :type block_size: ``int``
+
+    :param max_logged_messages: Maximum lines that are not JSON objects
+      logged every log_interval.
+    :type max_logged_messages: ``int``
+
+    :param log_interval: Seconds.
+    :type log_interval: ``float``
+
+    :param clock: Returns the current time in seconds.
+    :type clock: ``callable``
+    """
+    self._fd = fd
+    self._block_size = block_size
+    self._max_logged_messages = max_logged_messages
+    self._log_interval = log_interval
+    self._clock = clock
+    self._partial = ''
+    self._lock = threading.Lock()
+    self._lines = 0
+    self._total_lines = 0
+    self._parse_failures = 0
+    self._messages = 0
+    self._stats_time = clock()
+    self._log_time = self._stats_time
+    self._logged_messages = 0
+    self._suppressed_messages = 0
+
+  @property
+  def total_lines(self):
+    return self._total_lines
+
+  def read(self):
+    """
+    Wait for the next block.
+
+    :return: The JSON objects of the lines completed by the block, or
+      None at the end of the file.
+    :type: ``list`` of ``dict``
+    """
+    while True:
+      try:
+        data = os.read(self._fd, self._block_size)
+        break
+      except OSError as e:
+        if e.errno != errno.EINTR:
+          raise
+    if not data:
+      lines = [self._partial] if self._partial else []
+      self._partial = ''
+      objects = self.decode_lines(lines)
+      self._log_suppressed_messages()
+      return objects or None
+    data = self._partial + data
+    end = data.rfind('\n')
+    if end < 0:
+      self._partial = data
+      return []
+    self._partial = data[end + 1:]
+    return self.decode_lines(data[:end].split('\n'))
+
+  def decode_lines(self, lines):
+    """
+    :param lines: Complete lines.
+    :type lines: ``list`` of ``str``
+
+    :return: The JSON objects of the lines.
+    :type: ``list`` of ``dict``
+    """
+    json_lines = [x for x in lines if x[:1] == '{']
+    objects = []
+    parse_failures = 0
+    if json_lines:
+      try:
+        # One call for the whole block.
+        objects = json.loads('[%s]' % ','.join(json_lines))
+      except ValueError:
+        objects = []
+        for line in json_lines:
+          try:
+            objects.append(json.loads(line))
+          except ValueError:
+            parse_failures += 1
+    messages = []
+    if len(json_lines) != len(lines):
+      messages = [x for x in lines if x[:1] != '{' and x.strip()]
+      self._log_messages(messages)
+    with self._lock:
+      self._lines += len(lines)
+      self._total_lines += len(lines)
+      self._parse_failures += parse_failures
+      self._messages += len(messages)
+    return objects
+
+  def _log_messages(self, messages):
+    # Logstash messages about itself, rate limited.
+    now = self._clock()
+    if now - self._log_time >= self._log_interval:
+      self._log_suppressed_messages()
+      self._log_time = now
+      self._logged_messages = 0
+    for message in messages:
+      if self._logged_messages < self._max_logged_messages:
+        self._logged_messages += 1
+        nuoca_log(logging.INFO, "logstash message: %s" % message)
+      else:
+        self._suppressed_messages += 1
+
+  def _log_suppressed_messages(self):
+    if self._suppressed_messages:
+      nuoca_log(logging.INFO, "%d logstash messages not logged"
+                % self._suppressed_messages)
+      self._suppressed_messages = 0
+
+  def get_stats(self, reset=True):
+    """
+    :param reset: Start new counts.
+    :type reset: ``bool``
+
+    :return: {'logstash_lines_per_second', 'logstash_parse_failures',
+      'logstash_messages'}, since the last reset.
+    :type: ``dict``
+    """
+    with self._lock:
+      now = self._clock()
+      elapsed = now - self._stats_time
+      stats = {'logstash_lines_per_second':
+               round(self._lines / elapsed, 2) if elapsed > 0 else 0.0,
+               'logstash_parse_failures': self._parse_failures,
+               'logstash_messages': self._messages}
+      if reset:
+        self._lines = 0
+        self._parse_failures = 0
+        self._messages = 0
+        self._stats_time = now
+    return stats
+
+
+class LogstashInputPlugin(NuocaMPInputPlugin):
+  """
+  Base class of the plugins that collect Logstash events.  A subclass
+  calls _configure_input() from its startup(), and puts the events on
+  the collect queue from its own thread.  A subclass that reads a
+  Logstash stdout sets _logstash_reader, and its counters are recorded
+  as plugin metrics too.
+  """
+  def __init__(self, parent_pipe, plugin_name):
+    """
+    :param parent_pipe: Provided by Yapsy
+    :param plugin_name: Plugin name
+    :type plugin_name: ``str``
+    """
+    super(LogstashInputPlugin, self).__init__(parent_pipe, plugin_name)
+    self._config = None
+    self._nuocaCollectionName = None
+    self._logstash_sincedb_path = None
+    self._line_counter = 0
+    self._local_hostname = socket.gethostname()
+    self._host_uuid_shortname = False
+    self._host_shortid = None
+    self._logstash_collect_queue = self.new_collect_queue()
+    self._logstash_reader = None
+    self._timestamp_parser = TimestampParser()
+
+  @property
+  def logstash_collect_queue(self):
+    return self._logstash_collect_queue
+
+  def _configure_input(self, config):
+    """
+    Configure the items that do not depend on how the input file is
+    read: logstashSincedbPath, nuocaCollectionName, host_uuid_shortname
+    and the collect queue.
+    """
+    uuid_hostname_regex = \
+      '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-'
+    if 'logstashSincedbPath' in config:
+      self._logstash_sincedb_path = \
+        os.path.expandvars(config['logstashSincedbPath'])
+    else:
+      if 'logstashInputFilePath' in config:
+        nuoca_log(logging.INFO, "%s Plugin Input File Path: %s" %
+                  (self._plugin_name, str(config['logstashInputFilePath'])))
+        hexdigest = hashlib.md5(config['logstashInputFilePath']).hexdigest()
+        self._logstash_sincedb_path = \
+          "%s/.sincedb_%s" % (os.environ['HOME'], hexdigest)
+
+    nuoca_log(logging.INFO, "%s Plugin sincedb_path: %s" %
+              (self._plugin_name, str(self._logstash_sincedb_path)))
+
+    if 'nuocaCollectionName' in config:
+      self._nuocaCollectionName = config['nuocaCollectionName']
+
+    # For Coach hostnames in the format: uuid-shortId
+    if 'host_uuid_shortname' in config:
+      self._host_uuid_shortname = config['host_uuid_shortname']
+
+    if self._host_uuid_shortname:
+      m2 = re.search(uuid_hostname_regex, self._local_hostname)
+      if m2:
+        self._host_shortid = self._local_hostname[37:]
+
+    self._logstash_collect_queue = self.new_collect_queue(config)
+
+  def collect(self, collection_interval):
+    """
+    Drain the collect queue.
+
+    :return: The events, with the base values and a 'TimeStamp' in epoch
+      milliseconds.
+    :type: ``list`` of ``dict``
+    """
+    rval = None
+    try:
+      nuoca_log(logging.DEBUG,
+                "Called collect() in %s Plugin process"
+                % self._plugin_name)
+      base_values = super(LogstashInputPlugin, self).\
+        collect(collection_interval)
+      base_values['Hostname'] = self._local_hostname
+      if self._host_shortid:
+        base_values['HostShortID'] = self._host_shortid
+      if self._nuocaCollectionName:
+        base_values['nuocaCollectionName'] = self._nuocaCollectionName
+      rval = []
+      collected_dicts = self._logstash_collect_queue.drain()
+      self.record_collect_queue_metrics(self._logstash_collect_queue)
+      if self._logstash_reader:
+        stats = self._logstash_reader.get_stats()
+        self.set_metric_gauge('logstash_lines_per_second',
+                              stats['logstash_lines_per_second'])
+        self.increment_metric('logstash_parse_failures',
+                              stats['logstash_parse_failures'])
+        self.increment_metric('logstash_messages',
+                              stats['logstash_messages'])
+      if not collected_dicts:
+        return rval
+
+      timestamped_dicts = [x for x in collected_dicts if 'timestamp' in x]
+      epoch_millis = self._timestamp_parser.to_epoch_millis_batch(
+          [x['timestamp'] for x in timestamped_dicts])
+      for collected_dict, millis in zip(timestamped_dicts, epoch_millis):
+        if millis is not None:
+          collected_dict['TimeStamp'] = millis
+      for collected_dict in collected_dicts:
+        collected_dict.update(base_values)
+        rval.append(collected_dict)
+    except Exception as e:
+      nuoca_log(logging.ERROR, str(e))
+    return rval
@@ -0,0 +1,266 @@
+"""
+Log file tailing for NuoCA, without Logstash.
+
+LogTailer follows a log file like the Logstash file input:
+
+- Lines are read from the last position, and a line is returned only
+  once it is complete.  Empty lines are skipped.
+- The position is kept in a sincedb file, in the Logstash format:
+  'inode major minor position'.  The file is read from that position
+  after a restart.  A file without a position is read from the beginning,
+  or from its end.
+- When the file is rotated (the path has a new inode), the rest of the
+  old file is read before the new file.  When the file is truncated, it
+  is read again from the beginning.
+
+MultilineCodec joins the lines of one record, like the Logstash multiline
+codec with negate => true and what => "previous": a line that does not
+match the pattern belongs to the record before it.  A record is complete
+when the next record starts, or when no line was added to it for
+auto_flush_interval seconds.
+"""
+
+import errno
+import logging
+import os
+
+from nuoca_util import nuoca_log, nuoca_monotonic
+
+
+class LogTailer(object):
+  """
+  Follows one log file.  Not thread safe.
+  """
+  def __init__(self, path, sincedb_path=None, start_position='beginning',
+               sincedb_write_interval=15.0, read_size=65536):
+    """
+    :param path: Path of the log file.  It need not exist yet.
+    :type path: ``str``
+
+    :param sincedb_path: Path of the sincedb file, or None to keep the
+      position in memory only.
+    :type sincedb_path: ``str``
+
+    :param start_position: 'beginning' or 'end': where to start reading
+      a file that has no position in the sincedb.
+    :type start_position: ``str``
+
+    :param sincedb_write_interval: Minimum seconds between sincedb
+      writes.
+    :type sincedb_write_interval: ``float``
+
+    :param read_size: Bytes read from the file at once.
+    :type read_size: ``int``
+    """
+    if start_position not in ('beginning', 'end'):
+      raise AttributeError("Invalid start position: %s" % start_position)
+    self._path = path
+    self._sincedb_path = sincedb_path
+    self._start_position = start_position
+    self._sincedb_write_interval = sincedb_write_interval
+    self._read_size = read_size
+    self._sincedb = self._read_sincedb()
+    self._sincedb_write_time = None
+    self._sincedb_dirty = False
+    self._file = None
+    self._file_key = None
+    self._position = 0  # Position after the last complete line
+    self._partial = ''
+
+  @property
+  def path(self):
+    return self._path
+
+  @property
+  def position(self):
+    return self._position
+
+  @staticmethod
+  def _stat_key(stat):
+    return (stat.st_ino, os.major(stat.st_dev), os.minor(stat.st_dev))
+
+  def _read_sincedb(self):
+    sincedb = {}
+    if not self._sincedb_path or not os.path.isfile(self._sincedb_path):
+      return sincedb
+    try:
+      with open(self._sincedb_path) as sincedb_file:
+        for line in sincedb_file:
+          fields = line.split()
+          if len(fields) >= 4:
+            sincedb[tuple([int(x) for x in fields[:3]])] = int(fields[3])
+    except (IOError, ValueError) as e:
+      nuoca_log(logging.WARNING, "Cannot read sincedb %s: %s"
+                % (self._sincedb_path, str(e)))
+    return sincedb
+
+  def write_sincedb(self, force=False):
+    """
+    Write the positions to the sincedb file, at most every
+    sincedb_write_interval seconds unless forced.
+    """
+    if not self._sincedb_path or not self._sincedb_dirty:
+      return
+    now = nuoca_monotonic()
+    if not force and self._sincedb_write_time is not None and \
+        now - self._sincedb_write_time < self._sincedb_write_interval:
+      return
+    self._sincedb_write_time = now
+    self._sincedb_dirty = False
+    if self._sincedb_path == os.devnull:
+      return
+    temp_path = "%s.new" % self._sincedb_path
+    try:
+      with open(temp_path, 'w') as sincedb_file:
+        for key, position in sorted(self._sincedb.items()):
+          sincedb_file.write("%d %d %d %d\n" % (key + (position,)))
+      os.rename(temp_path, self._sincedb_path)
+    except (IOError, OSError) as e:
+      nuoca_log(logging.WARNING, "Cannot write sincedb %s: %s"
+                % (self._sincedb_path, str(e)))
+
+  def _set_position(self, position):
+    self._position = position
+    if self._file_key is not None:
+      self._sincedb[self._file_key] = position
+      self._sincedb_dirty = True
+
+  def _open(self, stat, start_position):
+    try:
+      new_file = open(self._path, 'rb')
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        nuoca_log(logging.WARNING, "Cannot open %s: %s"
+                  % (self._path, str(e)))
+      return False
+    self._close_file()
+    self._file = new_file
+    self._file_key = self._stat_key(os.fstat(new_file.fileno()))
+    self._partial = ''
+    position = self._sincedb.get(self._file_key)
+    if position is None or position > stat.st_size:
+      position = stat.st_size if start_position == 'end' else 0
+    self._file.seek(position)
+    self._set_position(position)
+    nuoca_log(logging.INFO, "Tailing %s from position %d"
+              % (self._path, position))
+    return True
+
+  def _close_file(self):
+    if self._file:
+      self._file.close()
+      self._file = None
+
+  def _read_available(self, lines):
+    while True:
+      data = self._file.read(self._read_size)
+      if not data:
+        return
+      data = self._partial + data
+      end = data.rfind('\n')
+      if end < 0:
+        self._partial = data
+        continue
+      complete = data[:end]
+      self._partial = data[end + 1:]
+      lines.extend([x for x in complete.split('\n') if x])
+      self._set_position(self._file.tell() - len(self._partial))
+
+  def read_lines(self):
+    """
+    :return: The complete, non-empty lines added to the file since the
+      last call, without their newlines.
+    :type: ``list`` of ``str``
+    """
+    lines = []
+    try:
+      stat = os.stat(self._path)
+    except OSError:
+      stat = None
+    if self._file is None:
+      if stat is None:
+        return lines
+      # A file seen for the first time starts at start_position; a file
+      # that replaces a rotated one is read from its beginning.
+      if not self._open(stat, self._start_position
+                        if self._file_key is None else 'beginning'):
+        return lines
+    elif stat is None or self._stat_key(stat) != self._file_key:
+      # Rotated: finish the old file, then follow the new one.
+      self._read_available(lines)
+      nuoca_log(logging.INFO, "%s was rotated" % self._path)
+      self._close_file()
+      if stat is None or not self._open(stat, 'beginning'):
+        self.write_sincedb()
+        return lines
+    elif stat.st_size < self._position:
+      nuoca_log(logging.INFO, "%s was truncated" % self._path)
+      self._file.seek(0)
+      self._partial = ''
+      self._set_position(0)
+    self._read_available(lines)
+    self.write_sincedb()
+    return lines
+
+  def close(self):
+    self.write_sincedb(force=True)
+    self._close_file()
+
+
+class MultilineCodec(object):
+  """
+  Joins continuation lines to the record that they belong to.
+  """
+  MULTILINE_TAG = 'multiline'
+
+  def __init__(self, pattern, auto_flush_interval=5.0):
+    """
+    :param pattern: Compiled regular expression that a line that starts
+      a record contains.
+    :param auto_flush_interval: Seconds after which an incomplete record
+      is complete, or None to wait for the next record.
+    :type auto_flush_interval: ``float``
+    """
+    self._pattern = pattern
+    self._auto_flush_interval = auto_flush_interval
+    self._lines = []
+    self._last_line_time = None
+
+  def decode(self, lines, now=None):
+    """
+    :param lines: New lines.
+    :type lines: ``list`` of ``str``
+
+    :param now: Monotonic time, for auto flush.
+    :type now: ``float``
+
+    :return: The records completed by the new lines, as (message, tags).
+    :type: ``list`` of ``tuple``
+    """
+    records = []
+    for line in lines:
+      if self._pattern.search(line) and self._lines:
+        records.append(self._record())
+      self._lines.append(line)
+    if lines:
+      self._last_line_time = nuoca_monotonic() if now is None else now
+    elif self._lines and self._auto_flush_interval is not None:
+      if now is None:
+        now = nuoca_monotonic()
+      if now - self._last_line_time >= self._auto_flush_interval:
+        records.append(self._record())
+    return records
+
+  def flush(self):
+    """
+    :return: The incomplete record as [(message, tags)], if any.
+    """
+    if self._lines:
+      return [self._record()]
+    return []
+
+  def _record(self):
+    tags = [self.MULTILINE_TAG] if len(self._lines) > 1 else []
+    message = '\n'.join(self._lines)
+    self._lines = []
+    return message, tags
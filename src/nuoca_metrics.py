@@ -0,0 +1,288 @@
+"""
+NuoCA internal metrics.
+
+NuocaMetrics keeps counters, gauges and latency histograms for NuoCA's
+own work: plugin response times, bytes read from plugin pipes, rows per
+collection cycle, timeouts, cycle overruns and output store times.  Input
+plugins add the metrics of their own work, such as the events dropped by
+their collect queues, as plugin.<plugin name>.<metric name>.  When
+the built-in 'NuoCA' input is configured, the metrics are added to each
+collection cycle as one more row of time-series values, and are reset
+after each cycle.
+
+Example configuration:
+
+INPUT_PLUGINS:
+- NuoCA:
+- NuoMonitor:
+    ...
+
+LatencyTracker learns how long each plugin takes to respond to each kind
+of request, and derives the response timeouts that NuoCA uses.
+"""
+
+import bisect
+import collections
+import logging
+import threading
+
+from nuoca_util import nuoca_log
+
+
+class Histogram(object):
+  """
+  Latency histogram with fixed bucket bounds in seconds.
+  """
+  BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+  def __init__(self):
+    self._bucket_counts = [0] * (len(self.BOUNDS) + 1)
+    self._count = 0
+    self._sum = 0.0
+    self._max = 0.0
+
+  @property
+  def count(self):
+    return self._count
+
+  def observe(self, seconds):
+    self._bucket_counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+    self._count += 1
+    self._sum += seconds
+    if seconds > self._max:
+      self._max = seconds
+
+  def percentile(self, percent):
+    """
+    Estimate a percentile as the upper bound of the bucket that holds it.
+    Values above the last bound are estimated as the maximum value.
+
+    :param percent: Percentile, from 0 to 100.
+    :type percent: ``float``
+
+    :return: Estimated value in seconds.
+    :type: ``float``
+    """
+    if not self._count:
+      return 0.0
+    rank = self._count * percent / 100.0
+    seen = 0
+    for index, bucket_count in enumerate(self._bucket_counts):
+      seen += bucket_count
+      if seen >= rank and bucket_count:
+        if index < len(self.BOUNDS):
+          return min(self.BOUNDS[index], self._max)
+        break
+    return self._max
+
+  def get_values(self, name):
+    """
+    :param name: Metric name used as the prefix of each key.
+    :type name: ``str``
+
+    :return: Count, sum, max, percentiles and bucket counts.  Times are
+      in milliseconds.
+    :type: ``dict``
+    """
+    rval = {name + '.count': self._count,
+            name + '.sum_ms': self._sum * 1000.0,
+            name + '.max_ms': self._max * 1000.0,
+            name + '.p50_ms': self.percentile(50) * 1000.0,
+            name + '.p90_ms': self.percentile(90) * 1000.0,
+            name + '.p99_ms': self.percentile(99) * 1000.0}
+    for index, bound in enumerate(self.BOUNDS):
+      rval['%s.le_%gms' % (name, bound * 1000.0)] = \
+          self._bucket_counts[index]
+    rval[name + '.le_infms'] = self._bucket_counts[-1]
+    return rval
+
+
+class NuocaMetrics(object):
+  """
+  Thread safe set of counters, gauges and histograms.  The collection loop
+  and the output dispatcher thread both record metrics.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._gauges = {}
+    self._histograms = {}
+
+  def increment(self, name, value=1):
+    """
+    Add to a counter.  Counters are reset by get_values().
+    """
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  def set_gauge(self, name, value):
+    """
+    Set a gauge.  Gauges keep their last value.
+    """
+    with self._lock:
+      self._gauges[name] = value
+
+  def observe(self, name, seconds):
+    """
+    Add a time to a histogram.  Histograms are reset by get_values().
+    """
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if not histogram:
+        histogram = Histogram()
+        self._histograms[name] = histogram
+      histogram.observe(seconds)
+
+  def get_values(self, prefix, reset=True):
+    """
+    Get all metrics as time-series values.
+
+    :param prefix: Prefix of each key, e.g. 'NuoCA'.
+    :type prefix: ``str``
+
+    :param reset: Reset the counters and histograms.
+    :type reset: ``bool``
+
+    :return: time-series values
+    :type: ``dict``
+    """
+    with self._lock:
+      counters = self._counters
+      histograms = self._histograms
+      gauges = dict(self._gauges)
+      if reset:
+        self._counters = {}
+        self._histograms = {}
+      else:
+        counters = dict(counters)
+        histograms = dict(histograms)
+    rval = {}
+    for name, value in counters.iteritems():
+      rval[prefix + '.' + name] = value
+    for name, value in gauges.iteritems():
+      rval[prefix + '.' + name] = value
+    for name, histogram in histograms.iteritems():
+      rval.update(histogram.get_values(prefix + '.' + name))
+    return rval
+
+
+class LatencyStats(object):
+  """
+  Rolling latency statistics of one plugin action: an exponentially
+  weighted moving average and mean deviation, and a window of recent
+  samples for the 99th percentile.
+  """
+  def __init__(self, alpha, window):
+    self._alpha = alpha
+    self._samples = collections.deque(maxlen=window)
+    self.ewma = None
+    self.deviation = 0.0
+    self.timeout = None
+
+  @property
+  def count(self):
+    return len(self._samples)
+
+  def observe(self, seconds):
+    self._samples.append(seconds)
+    if self.ewma is None:
+      self.ewma = seconds
+      self.deviation = seconds / 2.0
+      return
+    error = seconds - self.ewma
+    self.ewma += self._alpha * error
+    self.deviation += self._alpha * (abs(error) - self.deviation)
+
+  def percentile(self, percent):
+    samples = sorted(self._samples)
+    index = min(len(samples) - 1, int(len(samples) * percent / 100.0))
+    return samples[index]
+
+
+class LatencyTracker(object):
+  """
+  Thread safe per plugin, per action (e.g. 'collect' or 'store') response
+  timeouts learned from response latencies.
+
+  Once an action has enough samples, its timeout is the larger of the
+  99th percentile and EWMA + 4 * deviation, times a safety multiplier,
+  bounded by a floor and a ceiling.  Until then, and after a timeout, the
+  ceiling is used.
+  """
+  MIN_SAMPLES = 5
+  LOG_CHANGE = 0.25  # Log timeout changes larger than this fraction.
+  WINDOW = 100
+  ALPHA = 0.2
+
+  def __init__(self, floor, ceiling, multiplier=3.0):
+    """
+    :param floor: Minimum timeout in seconds.
+    :type floor: ``float``
+
+    :param ceiling: Maximum timeout in seconds.
+    :type ceiling: ``float``
+
+    :param multiplier: Safety multiplier of the learned latency.
+    :type multiplier: ``float``
+    """
+    if floor <= 0 or ceiling < floor:
+      raise AttributeError("Invalid plugin timeout bounds: %s, %s"
+                           % (str(floor), str(ceiling)))
+    self._floor = float(floor)
+    self._ceiling = float(ceiling)
+    self._multiplier = multiplier
+    self._lock = threading.Lock()
+    self._stats = {}
+
+  def _get_stats(self, name, action):
+    stats = self._stats.get((name, action))
+    if not stats:
+      stats = LatencyStats(self.ALPHA, self.WINDOW)
+      self._stats[(name, action)] = stats
+    return stats
+
+  def observe(self, name, action, seconds):
+    """
+    Record the latency of a response.
+    """
+    with self._lock:
+      self._get_stats(name, action).observe(seconds)
+
+  def reset(self, name, action):
+    """
+    Forget what was learned, e.g. after a timeout, so that the ceiling is
+    used until there are new samples.
+    """
+    with self._lock:
+      self._stats.pop((name, action), None)
+
+  def get_timeout(self, name, action):
+    """
+    :return: The response timeout in seconds.
+    :type: ``float``
+    """
+    with self._lock:
+      stats = self._stats.get((name, action))
+      if not stats or stats.count < self.MIN_SAMPLES:
+        return self._ceiling
+      latency = max(stats.percentile(99),
+                    stats.ewma + 4 * stats.deviation)
+      timeout = min(self._ceiling,
+                    max(self._floor, latency * self._multiplier))
+      last_timeout = stats.timeout
+      stats.timeout = timeout
+    if last_timeout is None or abs(timeout - last_timeout) > \
+        last_timeout * self.LOG_CHANGE:
+      nuoca_log(logging.INFO, "Plugin %s %s timeout: %.3f seconds"
+                % (name, action, timeout))
+    return timeout
+
+  def get_timeouts(self):
+    """
+    :return: The last timeout used, by (name, action).
+    :type: ``dict``
+    """
+    with self._lock:
+      return dict([(key, stats.timeout)
+                   for key, stats in self._stats.iteritems()
+                   if stats.timeout is not None])
@@ -4,9 +4,15 @@ Created on May 4, 2017
 @author: tgates
 """
 
+import os
+import threading
 import traceback
 import logging
-from nuoca_util import nuoca_gettimestamp, nuoca_log
+from nuoca_batch import BatchDecoder, BatchEncoder
+from nuoca_config import NuocaConfig
+from nuoca_spool import PartialStoreError, Spool, SpoolDrainer
+from nuoca_util import nuoca_gettimestamp, nuoca_log, sync_virtual_clock, \
+    BoundedQueue
 from yapsy.IMultiprocessChildPlugin import IMultiprocessChildPlugin
 
 
@@ -97,7 +103,24 @@ class NuocaMPInputPlugin(NuocaMPPlugin):
     1) Implement a Class that derives from NuocaMPInputPlugin
     2) call this __init__ function from the Plugin's __init__.
     3) Implement a collect() method that calls this collect() method.
+
+  NuoCA asks for the collected values as a CollectedBatch (see nuoca_batch),
+  which sends the keys of each row only when they change.
+
+  A plugin that gathers values in a background thread between collections
+  can keep them in a bounded queue from new_collect_queue().  Its
+  maximum depth and overflow policy are set with the 'collectQueueMaxDepth'
+  and 'collectQueueOverflowPolicy' plugin config items.
+
+  Counters about the plugin's own work, such as the events that its
+  collect queue dropped, are not time-series values of what it collects.
+  The plugin records them with increment_metric() and set_metric_gauge(),
+  and they are sent to NuoCA beside the collected values.  NuoCA adds
+  them to its own metrics as plugin.<plugin name>.<metric name>, which
+  the built-in 'NuoCA' input emits.
   """
+  DEFAULT_COLLECT_QUEUE_MAX_DEPTH = 100000
+  DEFAULT_COLLECT_QUEUE_OVERFLOW_POLICY = BoundedQueue.DROP_OLDEST
   def __init__(self, parent_pipe, plugin_name):
     """
     :param parent_pipe: Provided by Yapsy
@@ -106,6 +129,9 @@ class NuocaMPInputPlugin(NuocaMPPlugin):
     """
     super(NuocaMPInputPlugin, self).__init__(parent_pipe, plugin_name, "Input")
     self._collection_name = plugin_name
+    self._batch_encoder = BatchEncoder()
+    self._metric_counters = {}
+    self._metric_gauges = {}
 
   def _send_response(self, status_code, err_msg=None, resp_dict=None):
     response = {'status_code': status_code}
@@ -133,12 +159,27 @@ class NuocaMPInputPlugin(NuocaMPPlugin):
           continue
         action = request_from_parent['action']
         if action == 'collect':
+          if 'virtual_time' in request_from_parent:
+            sync_virtual_clock(request_from_parent['virtual_time'])
+          if request_from_parent.get('reset_schemas'):
+            # NuoCA is missing some schemas, so send them all again.
+            self._batch_encoder.reset()
           collection_interval = request_from_parent['collection_interval']
           collected_values = self.collect(collection_interval)
-          self._send_response(0, None, {'collected_values': collected_values})
+          if request_from_parent.get('batch') and \
+              type(collected_values) is list:
+            resp_dict = {'collected_batch':
+                         self._batch_encoder.encode(collected_values)}
+          else:
+            resp_dict = {'collected_values': collected_values}
+          plugin_metrics = self._pop_metrics()
+          if plugin_metrics:
+            resp_dict['plugin_metrics'] = plugin_metrics
+          self._send_response(0, None, resp_dict)
           continue
         elif action == 'startup':
           config = request_from_parent['config']
+          self._batch_encoder.reset()
           if config:
             if 'nuocaCollectionName' in config:
               self._collection_name = config['nuocaCollectionName']
@@ -164,6 +205,75 @@ class NuocaMPInputPlugin(NuocaMPPlugin):
   def deactivate(self):
     super(NuocaMPInputPlugin, self).deactivate()
 
+  def new_collect_queue(self, config=None):
+    """
+    Create a bounded queue for values gathered between collections.
+
+    :param config: Plugin config with the optional 'collectQueueMaxDepth'
+      and 'collectQueueOverflowPolicy' items.
+    :type config: ``dict``
+
+    :return: The queue
+    :type: ``BoundedQueue``
+    """
+    config = config or {}
+    return BoundedQueue(
+        int(config.get('collectQueueMaxDepth',
+                       self.DEFAULT_COLLECT_QUEUE_MAX_DEPTH)),
+        config.get('collectQueueOverflowPolicy',
+                   self.DEFAULT_COLLECT_QUEUE_OVERFLOW_POLICY))
+
+  def increment_metric(self, name, value=1):
+    """
+    Add to a counter of the plugin's own work.  It is sent to NuoCA with
+    the next collect response, and counts from zero again.
+
+    :param name: Metric name
+    :type name: ``str``
+
+    :param value: Amount to add
+    :type value: ``int``
+    """
+    self._metric_counters[name] = self._metric_counters.get(name, 0) + value
+
+  def set_metric_gauge(self, name, value):
+    """
+    Set a gauge of the plugin's own work.  It is sent to NuoCA with the
+    next collect response.
+
+    :param name: Metric name
+    :type name: ``str``
+    """
+    self._metric_gauges[name] = value
+
+  def _pop_metrics(self):
+    """
+    :return: The counters and gauges recorded since the last call, or
+      None if there are none.
+    :type: ``dict``
+    """
+    if not self._metric_counters and not self._metric_gauges:
+      return None
+    metrics = {'counters': self._metric_counters,
+               'gauges': self._metric_gauges}
+    self._metric_counters = {}
+    self._metric_gauges = {}
+    return metrics
+
+  def record_collect_queue_metrics(self, collect_queue):
+    """
+    Record the dropped count and high-water mark of a collect queue since
+    the last call, as the collect_queue_dropped counter and the
+    collect_queue_high_water_mark gauge.
+
+    :param collect_queue: Queue from new_collect_queue()
+    :type collect_queue: ``BoundedQueue``
+    """
+    stats = collect_queue.get_stats()
+    self.increment_metric('collect_queue_dropped', stats['dropped'])
+    self.set_metric_gauge('collect_queue_high_water_mark',
+                          stats['high_water_mark'])
+
   def collect(self, collection_interval):
     """
     NuoCA Input Plugins must implement their own collect() method.  The
@@ -198,10 +308,25 @@ class NuocaMPOutputPlugin(NuocaMPPlugin):
     1) Implement a Class that derives from NuocaMPOutputPlugin
     2) call this __init__ function from the Plugin's __init__.
     3) Implement a store() method that calls this store() method.
+    4) Optionally implement a store_batch() method to store the values
+       from a whole collection cycle at once.
+
+  An Output Plugin whose store_batch() raises an exception when its sink
+  is unavailable can be configured with 'nuocaSpool' (see nuoca_spool).
+  The values that it fails to store are then spooled to disk and
+  replayed once the sink recovers.  A store_batch() that stores only
+  some of the values raises a PartialStoreError with the rest, so that
+  only those are spooled.  Without a spool nothing would keep the values,
+  so a plugin raises only when 'spooling' is True.  Otherwise it logs
+  the error and stores the rest of the values.
   """
   def __init__(self, parent_pipe, plugin_name):
     super(NuocaMPOutputPlugin, self).__init__(parent_pipe, plugin_name,
                                               "Output")
+    self._batch_decoder = BatchDecoder()
+    self._spool = None
+    self._spool_drainer = None
+    self._store_lock = threading.Lock()
 
   def _send_response(self, status_code, err_msg=None, resp_dict=None):
     response = {'status_code': status_code}
@@ -233,15 +358,32 @@ class NuocaMPOutputPlugin(NuocaMPPlugin):
           resp_from_store = self.store(ts_values)
           self._send_response(0, None, resp_from_store)
           continue
+        elif action == 'store_batch':
+          if 'ts_batch' in request_from_parent:
+            ts_values = self._batch_decoder.decode(
+                request_from_parent['ts_batch'])
+          else:
+            ts_values = request_from_parent['ts_values']
+          resp_from_store = self._store_batch_or_spool(ts_values)
+          if self._batch_decoder.pop_schemas_missing():
+            # Ask NuoCA to send all of the schemas again.
+            resp_from_store = dict(resp_from_store or {})
+            resp_from_store['reset_schemas'] = True
+          self._send_response(0, None, resp_from_store)
+          continue
         elif action == 'startup':
           config = request_from_parent['config']
           startup_rval = self.startup(config)
+          if startup_rval and config and config.get('nuocaSpool'):
+            startup_rval = self._open_spool(config)
           self._send_response(int(not startup_rval))
           continue
         elif action == 'shutdown':
+          self._close_spool()
           self.shutdown()
           continue
         elif action == 'exit':
+          self._close_spool()
           self.enabled = False
           self._send_response(0, None, {'goodbye': 'world'})
           continue
@@ -253,17 +395,192 @@ class NuocaMPOutputPlugin(NuocaMPPlugin):
         err_msg = "Unhandled exception: %s\n%s" % (e, traceback.format_exc())
         self._send_response(1, err_msg)
 
+  def _open_spool(self, config):
+    """
+    Open the spool and start its drainer.
+
+    :param config: The plugin configuration, with 'nuocaSpool'.
+    :type config: ``dict``
+
+    :return: True if successful
+    :type: ``bool``
+    """
+    spool_config = config['nuocaSpool']
+    if not isinstance(spool_config, dict):
+      spool_config = {}
+    spool_dir = config.get('nuoca_spool_dir') or \
+        os.path.join(NuocaConfig.NUOCA_TMPDIR, 'spool', self.plugin_name)
+    try:
+      self._spool = Spool(spool_dir,
+                          int(spool_config.get('maxBytes', 64 * 1024 * 1024)),
+                          int(spool_config.get('segmentBytes',
+                                               4 * 1024 * 1024)))
+      self._spool_drainer = SpoolDrainer(
+          self._spool, self.store_batch, self._store_lock,
+          float(spool_config.get('drainRate', 10)))
+    except Exception as e:
+      nuoca_log(logging.ERROR, "%s plugin: unable to open spool: %s"
+                % (self.plugin_name, str(e)))
+      self._spool = None
+      return False
+    self._spool_drainer.start()
+    return True
+
+  @property
+  def spooling(self):
+    """
+    :return: True if a spool keeps the values that cannot be stored.
+      store() and store_batch() raise an exception for those values only
+      when spooling.
+    :type: ``bool``
+    """
+    return self._spool is not None
+
+  def _close_spool(self):
+    if self._spool_drainer:
+      self._spool_drainer.stop()
+      self._spool_drainer = None
+    if self._spool is not None:
+      with self._store_lock:
+        self._spool.close()
+      self._spool = None
+
+  def _store_batch_or_spool(self, ts_values):
+    """
+    Store the values from a collection cycle.  With a spool, values that
+    cannot be stored, and values that arrive while older values are still
+    spooled, are appended to the spool.
+    """
+    if self._spool is None:
+      return self.store_batch(ts_values)
+    with self._store_lock:
+      if not len(self._spool):
+        try:
+          return self.store_batch(ts_values)
+        except PartialStoreError as e:
+          ts_values = e.unstored
+          nuoca_log(logging.WARNING,
+                    "%s plugin: unable to store %d values, spooling them: %s"
+                    % (self.plugin_name, len(ts_values), str(e)))
+        except Exception as e:
+          nuoca_log(logging.WARNING,
+                    "%s plugin: unable to store values, spooling them: %s"
+                    % (self.plugin_name, str(e)))
+      if ts_values:
+        self._spool.append(ts_values)
+    self._spool_drainer.wake()
+    return None
+
   def store(self, ts_values):
     pass
 
+  def store_batch(self, ts_values):
+    """
+    Store all of the time-series values from one collection cycle.
+
+    NuoCA sends a single 'store_batch' message per collection cycle.  The
+    default implementation calls store() once for each item.  Output
+    Plugins that can write many values at once should override this
+    method.
+
+    :param ts_values: time-series values
+    :type ts_values: ``list`` of ``dict``
+
+    :raises PartialStoreError: When spooling, with the values that store()
+      failed to store.
+    """
+    unstored = []
+    error = None
+    for ts_value in ts_values:
+      try:
+        self.store(ts_value)
+      except Exception as e:
+        unstored.append(ts_value)
+        error = e
+    if not unstored:
+      return
+    msg = "unable to store %d of %d values: %s" % \
+          (len(unstored), len(ts_values), str(error))
+    if self.spooling:
+      raise PartialStoreError(msg, unstored)
+    nuoca_log(logging.ERROR, "%s plugin: %s" % (self.plugin_name, msg))
+
 
 class NuocaMPTransformPlugin(NuocaMPPlugin):
   """
   NuoCA Multi-Process Transformation Plugin
+
+  This is a base class for ALL NuoCA Transform Plugins.
+
+  All NuoCA Transform Plugins must do:
+    1) Implement a Class that derives from NuocaMPTransformPlugin
+    2) call this __init__ function from the Plugin's __init__.
+    3) Implement a transform() method.
   """
   def __init__(self, parent_pipe, plugin_name):
     super(NuocaMPTransformPlugin, self).__init__(parent_pipe,
                                                  plugin_name, "Transform")
-    raise Exception("Not Yet Implemented")
 
+  def _send_response(self, status_code, err_msg=None, resp_dict=None):
+    response = {'status_code': status_code}
+    if err_msg:
+      response['error_msg'] = err_msg
+    if resp_dict:
+      response['resp_values'] = resp_dict
+    self.parent_pipe.send(response)
 
+  def run(self):
+    """
+    This function is called by Yapsy
+    """
+    self.enabled = True
+    while self.enabled:
+      try:
+        request_from_parent = self.parent_pipe.recv()
+        if not request_from_parent:
+          self._send_response(2, "Empty request from parent in Plugin: %s"
+                              % self.name)
+          continue
+        if 'action' not in request_from_parent:
+          self._send_response(2, "Action missing from request in Plugin: %s"
+                              % self.name)
+          continue
+        action = request_from_parent['action']
+        if action == 'transform':
+          ts_values = request_from_parent['ts_values']
+          transformed_values = self.transform(ts_values)
+          self._send_response(0, None, {'ts_values': transformed_values})
+          continue
+        elif action == 'startup':
+          config = request_from_parent['config']
+          startup_rval = self.startup(config)
+          self._send_response(int(not startup_rval))
+          continue
+        elif action == 'shutdown':
+          self.shutdown()
+          continue
+        elif action == 'exit':
+          self.enabled = False
+          self._send_response(0, None, {'goodbye': 'world'})
+          continue
+        else:
+          self._send_response(2, "Action %s unknown in Plugin: %s"
+                              % (action, self.name))
+          continue
+      except Exception as e:
+        err_msg = "Unhandled exception: %s\n%s" % (e, traceback.format_exc())
+        self._send_response(1, err_msg)
+
+  def transform(self, ts_values):
+    """
+    NuoCA Transform Plugins must implement their own transform() method.
+    It is called with all of the time-series values from one collection
+    cycle, and returns the values to pass on to the next transform, and
+    finally to the output plugins.
+
+    :param ts_values: time-series values
+    :type ts_values: ``list`` of ``dict``
+    :return: transformed time-series values
+    :type: ``list`` of ``dict``
+    """
+    return ts_values
@@ -0,0 +1,292 @@
+"""
+NuoCA Plugin Manager
+
+NuocaPluginManager is a Yapsy MultiprocessPluginManager that can also host
+selected plugins in the NuoCA process, each on its own thread.  The plugin
+host is chosen per plugin with 'nuocaPluginHost' in the plugin
+configuration:
+
+  process: (default) The plugin runs in its own process and messages are
+    pickled through a multiprocessing Pipe.
+  thread: The plugin runs on a thread in the NuoCA process and messages
+    are passed by reference through an InProcessPipe.
+
+Thread hosting is meant for lightweight plugins, where the memory of a
+whole Python process and a pickled round-trip per message cost more than
+the plugin itself.  A thread hosted plugin shares the NuoCA process, so it
+must not block the interpreter, change the process environment, or modify
+values after it has sent them.
+
+Either way the parent side of the plugin is a proxy with a 'child_pipe'
+and a 'proc', so NuoCA talks to both kinds of plugin in the same way.
+
+A process hosted plugin can also set 'nuocaTransport: shm', so that large
+messages are passed through shared memory instead of the pipe.  See
+nuoca_shm.
+"""
+
+import collections
+import errno
+import logging
+import os
+import threading
+
+from nuoca_shm import ShmPipe
+from nuoca_util import nuoca_log, wait_for_pipes
+from yapsy.IPlugin import IPlugin
+from yapsy.MultiprocessPluginManager import MultiprocessPluginManager
+from yapsy.MultiprocessPluginProxy import MultiprocessPluginProxy
+
+PROCESS_HOST = 'process'
+THREAD_HOST = 'thread'
+PLUGIN_HOSTS = (PROCESS_HOST, THREAD_HOST)
+
+PIPE_TRANSPORT = 'pipe'
+SHM_TRANSPORT = 'shm'
+PLUGIN_TRANSPORTS = (PIPE_TRANSPORT, SHM_TRANSPORT)
+
+
+class InProcessPipe(object):
+  """
+  One end of an in-process, two-way message channel.  It supports the
+  subset of the multiprocessing Connection interface that NuoCA and the
+  plugins use: send(), recv(), poll(), fileno() and close().  Messages
+  are not copied.  A byte written to an OS pipe per message makes the
+  channel usable with select().  Once an end is closed, its file
+  descriptors may be reused, so it is not used again.
+  """
+  def __init__(self, incoming, read_fd, outgoing, write_fd):
+    self._incoming = incoming
+    self._read_fd = read_fd
+    self._outgoing = outgoing
+    self._write_fd = write_fd
+    self._closed = False
+
+  @staticmethod
+  def pair():
+    """
+    Create both ends of a channel.
+
+    :return: Two connected InProcessPipe objects.
+    """
+    a_to_b = collections.deque()
+    b_to_a = collections.deque()
+    a_to_b_read_fd, a_to_b_write_fd = os.pipe()
+    b_to_a_read_fd, b_to_a_write_fd = os.pipe()
+    end_a = InProcessPipe(b_to_a, b_to_a_read_fd, a_to_b, a_to_b_write_fd)
+    end_b = InProcessPipe(a_to_b, a_to_b_read_fd, b_to_a, b_to_a_write_fd)
+    return end_a, end_b
+
+  def fileno(self):
+    return self._read_fd
+
+  def send(self, obj):
+    if self._closed:
+      raise IOError("InProcessPipe is closed")
+    self._outgoing.append(obj)
+    os.write(self._write_fd, b'.')
+
+  def recv(self):
+    if self._closed:
+      raise EOFError()
+    while True:
+      try:
+        if not os.read(self._read_fd, 1):
+          raise EOFError()
+        break
+      except OSError as e:
+        if e.errno != errno.EINTR:
+          raise
+    return self._incoming.popleft()
+
+  def poll(self, timeout=0.0):
+    if self._closed:
+      raise IOError("InProcessPipe is closed")
+    if timeout is None:
+      timeout = 365 * 24 * 3600
+    return bool(wait_for_pipes([self], timeout))
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    for fd in (self._read_fd, self._write_fd):
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+
+class PluginThread(object):
+  """
+  Runs a plugin's run() method on a daemon thread, and provides the part
+  of the multiprocessing.Process interface that NuoCA uses.
+  """
+  def __init__(self, plugin):
+    self._plugin = plugin
+    self._thread = threading.Thread(target=self._run,
+                                    name="nuoca-plugin-%s" % plugin.plugin_name)
+    self._thread.daemon = True
+
+  def _run(self):
+    try:
+      self._plugin.run()
+    except (EOFError, IOError, OSError) as e:
+      # The pipe was closed, e.g. because the plugin was respawned.
+      nuoca_log(logging.INFO, "Plugin thread %s stopped: %s"
+                % (self._plugin.plugin_name, str(e)))
+
+  @property
+  def plugin(self):
+    return self._plugin
+
+  @property
+  def pid(self):
+    return os.getpid()
+
+  @property
+  def exitcode(self):
+    if self._thread.is_alive():
+      return None
+    return 0
+
+  def start(self):
+    self._thread.start()
+
+  def is_alive(self):
+    return self._thread.is_alive()
+
+  def join(self, timeout=None):
+    self._thread.join(timeout)
+
+  def terminate(self):
+    # Python threads cannot be killed.  The thread is a daemon thread, so
+    # it will not keep the NuoCA process from exiting.
+    nuoca_log(logging.WARNING,
+              "Cannot terminate thread hosted plugin: %s" %
+              self._plugin.plugin_name)
+
+
+class ThreadPluginProxy(IPlugin):
+  """
+  Parent side of a thread hosted plugin.  It mirrors Yapsy's
+  MultiprocessPluginProxy: 'proc' is the PluginThread and 'child_pipe' is
+  the parent's end of the InProcessPipe.
+  """
+  def __init__(self):
+    IPlugin.__init__(self)
+    self.proc = None
+    self.child_pipe = None
+
+
+class NuocaPluginManager(MultiprocessPluginManager):
+  """
+  Yapsy MultiprocessPluginManager that hosts each plugin in either a
+  process or a thread.
+  """
+  def __init__(self, plugin_hosts=None, plugin_transports=None,
+               shm_ring_size=8 * 1024 * 1024, **kwargs):
+    """
+    :param plugin_hosts: Plugin host (one of PLUGIN_HOSTS) by plugin name.
+      Plugins that are not listed run in their own process.
+    :type plugin_hosts: ``dict``
+
+    :param plugin_transports: Transport (one of PLUGIN_TRANSPORTS) by
+      plugin name.  Plugins that are not listed use a pipe.
+    :type plugin_transports: ``dict``
+
+    :param shm_ring_size: Bytes in each direction of a shared memory ring.
+    :type shm_ring_size: ``int``
+    """
+    MultiprocessPluginManager.__init__(self, **kwargs)
+    self._plugin_hosts = plugin_hosts or {}
+    self._plugin_transports = plugin_transports or {}
+    self._shm_ring_size = shm_ring_size
+    self._loading_plugin_name = None
+
+  def get_plugin_host(self, plugin_name):
+    return self._plugin_hosts.get(plugin_name, PROCESS_HOST)
+
+  def get_plugin_transport(self, plugin_name):
+    return self._plugin_transports.get(plugin_name, PIPE_TRANSPORT)
+
+  def loadPlugins(self, callback=None):
+    # Yapsy calls the callback just before it instantiates each plugin,
+    # which tells instanciateElement() which plugin it is creating.
+    def load_callback(plugin_info):
+      self._loading_plugin_name = plugin_info.name
+      if callback:
+        callback(plugin_info)
+    try:
+      return MultiprocessPluginManager.loadPlugins(self, load_callback)
+    finally:
+      self._loading_plugin_name = None
+
+  def respawn_plugin(self, plugin_info):
+    """
+    Replace a plugin's process, or thread, with a new instance of the
+    plugin class.  The new instance must be sent its startup message.
+
+    :param plugin_info: Yapsy PluginInfo of the plugin.
+    :return: The new proxy, which is also the new plugin_info.plugin_object
+    """
+    old_proxy = plugin_info.plugin_object
+    old_proc = old_proxy.proc
+    if old_proc.is_alive():
+      old_proc.terminate()
+      old_proc.join(1)
+    # Both ends of the old pair: the plugin's end is kept here too, as a
+    # copy for a process and shared with a thread.
+    if isinstance(old_proc, PluginThread):
+      plugin_pipe = old_proc.plugin.parent_pipe
+    else:
+      plugin_pipe = old_proc.parent_pipe
+    for pipe in (old_proxy.child_pipe, plugin_pipe):
+      try:
+        pipe.close()
+      except Exception as e:
+        nuoca_log(logging.DEBUG, "Closing pipe of plugin %s: %s" %
+                  (plugin_info.name, str(e)))
+    self._loading_plugin_name = plugin_info.name
+    try:
+      new_proxy = self.instanciateElement(old_proxy.plugin_class)
+    finally:
+      self._loading_plugin_name = None
+    new_proxy.activate()
+    plugin_info.plugin_object = new_proxy
+    return new_proxy
+
+  def instanciateElement(self, element):
+    proxy = self._instanciate_element(element)
+    # Remember the plugin class so that the plugin can be respawned.
+    proxy.plugin_class = element
+    return proxy
+
+  def _instanciate_element(self, element):
+    plugin_name = self._loading_plugin_name
+    transport = self.get_plugin_transport(plugin_name)
+    if self.get_plugin_host(plugin_name) != THREAD_HOST:
+      if transport != SHM_TRANSPORT:
+        return MultiprocessPluginManager.instanciateElement(self, element)
+      return self._instanciate_shm_element(element)
+    if transport == SHM_TRANSPORT:
+      nuoca_log(logging.WARNING,
+                "Plugin %s is hosted on a thread, ignoring "
+                "nuocaTransport: shm" % plugin_name)
+    nuoca_log(logging.INFO, "Hosting plugin on a thread: %s" % plugin_name)
+    proxy = ThreadPluginProxy()
+    parent_pipe, child_pipe = InProcessPipe.pair()
+    proxy.proc = PluginThread(element(child_pipe))
+    proxy.child_pipe = parent_pipe
+    proxy.proc.start()
+    return proxy
+
+  def _instanciate_shm_element(self, element):
+    nuoca_log(logging.INFO, "Using shared memory transport for plugin: %s"
+              % self._loading_plugin_name)
+    proxy = MultiprocessPluginProxy()
+    parent_pipe, child_pipe = ShmPipe.pair(self._shm_ring_size)
+    proxy.proc = element(child_pipe)
+    proxy.child_pipe = parent_pipe
+    proxy.proc.start()
+    return proxy
@@ -0,0 +1,197 @@
+"""
+Shared memory transport for NuoCA plugins.
+
+A ShmPipe wraps the multiprocessing Connection between NuoCA and a plugin
+process.  Each message is pickled once.  Large messages, such as the
+'collected_values' of a busy input plugin or a 'store_batch' for an
+output plugin, are written into a ring buffer in shared memory, and only a
+small record of where to find them goes through the pipe.  Small messages,
+and large ones that do not fit in the free space of the ring, go through
+the pipe as before.
+
+Each direction has its own ring, with one writer and one reader.  The
+rings are anonymous shared mmaps that are created before the plugin
+process is forked, so no shared memory names or files have to be cleaned
+up.
+"""
+
+import cPickle
+import logging
+import mmap
+import multiprocessing
+import struct
+
+from nuoca_util import nuoca_log
+
+_POSITIONS = struct.Struct('=QQ')  # Write position, read position
+_SHM_RECORD = struct.Struct('=QQ')  # Ring position, length
+_PIPE_MSG = b'P'
+_SHM_MSG = b'S'
+
+
+class ShmRing(object):
+  """
+  Single writer, single reader byte ring in a shared mmap.
+
+  The write and read positions are byte counts that only grow.  Each is
+  changed by one side only: the writer stores the write position and the
+  reader stores the read position.  A record is always contiguous in the
+  ring, so a record that does not fit before the end of the ring starts
+  at the beginning instead.
+  """
+  def __init__(self, size):
+    """
+    :param size: Size of the ring data in bytes.
+    :type size: ``int``
+    """
+    if size <= 0:
+      raise AttributeError("Shared memory ring size must be positive: %s"
+                           % str(size))
+    self._size = size
+    self._mmap = mmap.mmap(-1, _POSITIONS.size + size)
+    _POSITIONS.pack_into(self._mmap, 0, 0, 0)
+    self._closed = False
+
+  @property
+  def size(self):
+    return self._size
+
+  @property
+  def closed(self):
+    return self._closed
+
+  def _positions(self):
+    return _POSITIONS.unpack_from(self._mmap, 0)
+
+  def write(self, data):
+    """
+    Copy data into the ring.
+
+    :param data: bytes to write.
+    :type data: ``str``
+
+    :return: Ring position of the data, or None if there is not enough
+      free space.
+    :type: ``int``, ``None``
+    """
+    length = len(data)
+    write_pos, read_pos = self._positions()
+    offset = write_pos % self._size
+    if offset + length > self._size:
+      # Skip the end of the ring.
+      write_pos += self._size - offset
+      offset = 0
+    if write_pos + length - read_pos > self._size:
+      return None
+    start = _POSITIONS.size + offset
+    self._mmap[start:start + length] = data
+    struct.pack_into('=Q', self._mmap, 0, write_pos + length)
+    return write_pos
+
+  def read(self, position, length):
+    """
+    Copy a record out of the ring and free its space.  Records must be
+    read in the order they were written.
+
+    :param position: Ring position returned by write().
+    :type position: ``int``
+
+    :param length: Length of the record.
+    :type length: ``int``
+
+    :return: The record
+    :type: ``str``
+    """
+    start = _POSITIONS.size + position % self._size
+    data = self._mmap[start:start + length]
+    struct.pack_into('=Q', self._mmap, 8, position + length)
+    return data
+
+  def close(self):
+    if not self._closed:
+      self._closed = True
+      self._mmap.close()
+
+
+class ShmPipe(object):
+  """
+  One end of a plugin pipe that moves large messages through shared
+  memory.  It has the same interface as the multiprocessing Connection
+  that it wraps: send(), recv(), poll(), fileno() and close().
+  """
+  def __init__(self, connection, send_ring, recv_ring, min_shm_bytes):
+    self._connection = connection
+    self._send_ring = send_ring
+    self._recv_ring = recv_ring
+    self._min_shm_bytes = min_shm_bytes
+    self._shm_messages = 0
+    self._pipe_messages = 0
+    self.last_recv_size = 0
+
+  @staticmethod
+  def pair(ring_size, min_shm_bytes=4096):
+    """
+    Create a connected pair of ShmPipe objects.  Create the pair before
+    forking the plugin process.
+
+    :param ring_size: Size in bytes of the ring for each direction.
+    :type ring_size: ``int``
+
+    :param min_shm_bytes: Messages smaller than this go through the pipe.
+    :type min_shm_bytes: ``int``
+
+    :return: Parent end and child end.
+    """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    to_child = ShmRing(ring_size)
+    to_parent = ShmRing(ring_size)
+    return (ShmPipe(parent_conn, to_child, to_parent, min_shm_bytes),
+            ShmPipe(child_conn, to_parent, to_child, min_shm_bytes))
+
+  @property
+  def shm_messages(self):
+    return self._shm_messages
+
+  @property
+  def pipe_messages(self):
+    return self._pipe_messages
+
+  def fileno(self):
+    return self._connection.fileno()
+
+  def poll(self, timeout=0.0):
+    return self._connection.poll(timeout)
+
+  def send(self, obj):
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    if len(data) >= self._min_shm_bytes:
+      position = self._send_ring.write(data)
+      if position is not None:
+        self._shm_messages += 1
+        self._connection.send_bytes(
+            _SHM_MSG + _SHM_RECORD.pack(position, len(data)))
+        return
+      nuoca_log(logging.DEBUG,
+                "ShmPipe: %d byte message does not fit in the shared "
+                "memory ring, sending it through the pipe", len(data))
+    self._pipe_messages += 1
+    self._connection.send_bytes(_PIPE_MSG + data)
+
+  def recv(self):
+    message = self._connection.recv_bytes()
+    if message[:1] == _SHM_MSG:
+      position, length = _SHM_RECORD.unpack_from(message, 1)
+      data = self._recv_ring.read(position, length)
+    else:
+      data = message[1:]
+    self.last_recv_size = len(data)
+    return cPickle.loads(data)
+
+  def close(self):
+    """
+    Close the connection and unmap both rings in this process.  The rings
+    are shared with the other end, which must not be used here after.
+    """
+    self._connection.close()
+    self._send_ring.close()
+    self._recv_ring.close()
@@ -0,0 +1,432 @@
+"""
+Durable spool for NuoCA output plugins.
+
+When an output plugin's sink is down, the time-series values that it
+fails to store are appended to a Spool on disk instead of being lost.  A
+SpoolDrainer thread replays them, oldest first, once the sink recovers.
+
+The spool is a directory of fixed size segment files.  Each segment is
+mmap'd and holds records of the form:
+
+  length (4 bytes), crc32 (4 bytes), pickled payload
+
+A zero length marks the end of the records in a segment.  The payload is
+written before its header, so a record that was only partly written when
+NuoCA stopped is never read.  Records with a bad CRC are skipped.  The
+read position is kept in a small cursor file, so records that were
+replayed are not replayed again after a restart.
+
+The spool has a size cap.  When it is full, the oldest segment is evicted,
+even if it still has records that were not replayed.
+
+Example configuration:
+
+OUTPUT_PLUGINS:
+- ElasticSearch:
+    HOST: localhost
+    PORT: 9200
+    INDEX: nuoca
+    nuocaSpool:
+      maxBytes: 104857600  # Size cap of the spool
+      segmentBytes: 4194304  # Size of each segment file
+      drainRate: 10  # Maximum collection cycles replayed per second
+"""
+
+import cPickle
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from nuoca_util import nuoca_log
+
+_RECORD_HEADER = struct.Struct('=II')  # Payload length, crc32
+_SEGMENT_SUFFIX = '.seg'
+_CURSOR_FILE = 'cursor'
+
+
+class PartialStoreError(Exception):
+  """
+  Raised by a store function that stored only some of its time-series
+  values.  Only the values that were not stored are spooled, or replayed
+  again, so the others are not stored twice.
+
+  :ivar unstored: The values that were not stored.
+  :type unstored: ``list``
+  """
+  def __init__(self, message, unstored):
+    super(PartialStoreError, self).__init__(message)
+    self.unstored = unstored
+
+
+class Spool(object):
+  """
+  Append-only, segment based queue of pickled objects on disk.  A Spool
+  is not thread safe.
+  """
+  def __init__(self, directory, max_bytes=64 * 1024 * 1024,
+               segment_bytes=4 * 1024 * 1024):
+    """
+    :param directory: Directory for the segment files.  Records left
+      there by an earlier spool are replayed.
+    :type directory: ``str``
+
+    :param max_bytes: Size cap of all segment files.
+    :type max_bytes: ``int``
+
+    :param segment_bytes: Size of each segment file.  A record that is
+      larger gets a segment of its own.
+    :type segment_bytes: ``int``
+    """
+    if segment_bytes <= _RECORD_HEADER.size or max_bytes < segment_bytes:
+      raise AttributeError("Invalid spool size: maxBytes=%s, "
+                           "segmentBytes=%s"
+                           % (str(max_bytes), str(segment_bytes)))
+    self._directory = directory
+    self._max_bytes = max_bytes
+    self._segment_bytes = segment_bytes
+    self._segment_sizes = {}  # File size by segment number
+    self._segment_records = {}  # Records not yet read, by segment number
+    self._write_segment = None
+    self._write_map = None
+    self._write_offset = 0
+    self._read_segment = None
+    self._read_map = None
+    self._read_offset = 0
+    self._peeked = None  # (next read offset, object)
+    self._evicted_records = 0
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    self._recover()
+
+  def __len__(self):
+    return sum(self._segment_records.itervalues())
+
+  @property
+  def evicted_records(self):
+    return self._evicted_records
+
+  def _segment_path(self, segment):
+    return os.path.join(self._directory,
+                        '%012d%s' % (segment, _SEGMENT_SUFFIX))
+
+  @staticmethod
+  def _map_file(path, size=None):
+    with open(path, 'r+b') as segment_file:
+      if size:
+        segment_file.truncate(size)
+      return mmap.mmap(segment_file.fileno(), 0)
+
+  @staticmethod
+  def _read_record(segment_map, offset):
+    """
+    :return: (payload, next offset), (None, next offset) for a corrupt
+      record, or (None, None) at the end of the segment.
+    """
+    if offset + _RECORD_HEADER.size > len(segment_map):
+      return None, None
+    length, crc = _RECORD_HEADER.unpack_from(segment_map, offset)
+    start = offset + _RECORD_HEADER.size
+    if not length or start + length > len(segment_map):
+      return None, None
+    payload = segment_map[start:start + length]
+    if zlib.crc32(payload) & 0xffffffff != crc:
+      return None, start + length
+    return payload, start + length
+
+  def _scan_segment(self, segment_map, offset):
+    """
+    :return: Number of valid records from the offset, and the end offset.
+    """
+    records = 0
+    while True:
+      payload, next_offset = self._read_record(segment_map, offset)
+      if next_offset is None:
+        return records, offset
+      if payload is not None:
+        records += 1
+      offset = next_offset
+
+  def _read_cursor(self):
+    try:
+      with open(os.path.join(self._directory, _CURSOR_FILE)) as cursor_file:
+        segment, offset = cursor_file.read().split()
+        return int(segment), int(offset)
+    except (IOError, ValueError):
+      return None, 0
+
+  def _write_cursor(self):
+    cursor_path = os.path.join(self._directory, _CURSOR_FILE)
+    with open(cursor_path + '.tmp', 'w') as cursor_file:
+      cursor_file.write('%d %d' % (self._read_segment, self._read_offset))
+    os.rename(cursor_path + '.tmp', cursor_path)
+
+  def _recover(self):
+    segments = sorted([int(x[:-len(_SEGMENT_SUFFIX)])
+                       for x in os.listdir(self._directory)
+                       if x.endswith(_SEGMENT_SUFFIX)])
+    cursor_segment, cursor_offset = self._read_cursor()
+    for segment in list(segments):
+      path = self._segment_path(segment)
+      if (cursor_segment is not None and segment < cursor_segment) or \
+          not os.path.getsize(path):
+        os.remove(path)
+        segments.remove(segment)
+    for segment in segments:
+      segment_map = self._map_file(self._segment_path(segment))
+      start_offset = 0
+      if segment == cursor_segment:
+        start_offset = cursor_offset
+      records, end_offset = self._scan_segment(segment_map, start_offset)
+      self._segment_sizes[segment] = len(segment_map)
+      self._segment_records[segment] = records
+      if segment == segments[-1]:
+        # Keep appending to the last segment.
+        self._write_segment = segment
+        self._write_map = segment_map
+        self._write_offset = end_offset
+      else:
+        segment_map.close()
+    if not self._segment_sizes:
+      self._new_segment(0, self._segment_bytes)
+    self._read_segment = min(self._segment_sizes)
+    self._read_offset = 0
+    if self._read_segment == cursor_segment:
+      self._read_offset = cursor_offset
+    if len(self):
+      nuoca_log(logging.INFO, "Spool %s: recovered %d records"
+                % (self._directory, len(self)))
+
+  def _new_segment(self, segment, size):
+    path = self._segment_path(segment)
+    open(path, 'wb').close()
+    if self._write_map:
+      if self._write_segment == self._read_segment:
+        # Keep reading from the old write segment.
+        self._read_map = self._write_map
+      else:
+        self._write_map.close()
+    self._write_segment = segment
+    self._write_map = self._map_file(path, size)
+    self._write_offset = 0
+    self._segment_sizes[segment] = size
+    self._segment_records[segment] = 0
+
+  def _evict_oldest_segment(self):
+    segment = min(self._segment_sizes)
+    evicted = self._segment_records.pop(segment)
+    del self._segment_sizes[segment]
+    self._evicted_records += evicted
+    nuoca_log(logging.WARNING, "Spool %s is full, discarded %d records"
+              % (self._directory, evicted))
+    if segment == self._read_segment:
+      if self._read_map and self._read_map is not self._write_map:
+        self._read_map.close()
+      self._read_map = None
+      self._peeked = None
+      self._read_segment = min(self._segment_sizes)
+      self._read_offset = 0
+      self._write_cursor()
+    os.remove(self._segment_path(segment))
+
+  def append(self, obj):
+    """
+    Append an object to the spool.
+
+    :param obj: A picklable object
+    """
+    payload = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    record_size = _RECORD_HEADER.size + len(payload)
+    # Leave room for the zero length that ends the segment.
+    if self._write_offset + record_size + _RECORD_HEADER.size > \
+        len(self._write_map):
+      self._new_segment(self._write_segment + 1,
+                        max(self._segment_bytes,
+                            record_size + _RECORD_HEADER.size))
+      while sum(self._segment_sizes.itervalues()) > self._max_bytes and \
+          len(self._segment_sizes) > 1:
+        self._evict_oldest_segment()
+    start = self._write_offset + _RECORD_HEADER.size
+    self._write_map[start:start + len(payload)] = payload
+    _RECORD_HEADER.pack_into(self._write_map, self._write_offset,
+                             len(payload), zlib.crc32(payload) & 0xffffffff)
+    self._write_offset = start + len(payload)
+    self._segment_records[self._write_segment] += 1
+
+  def _get_read_map(self):
+    if self._read_segment == self._write_segment:
+      return self._write_map
+    if not self._read_map:
+      self._read_map = self._map_file(self._segment_path(self._read_segment))
+    return self._read_map
+
+  def _next_read_segment(self):
+    if self._read_map:
+      self._read_map.close()
+      self._read_map = None
+    os.remove(self._segment_path(self._read_segment))
+    del self._segment_sizes[self._read_segment]
+    del self._segment_records[self._read_segment]
+    self._read_segment = min(self._segment_sizes)
+    self._read_offset = 0
+    self._write_cursor()
+
+  def peek(self):
+    """
+    :return: The oldest object in the spool, or None if it is empty.  The
+      object stays in the spool until ack() is called.
+    """
+    if self._peeked:
+      return self._peeked[1]
+    while len(self):
+      payload, next_offset = self._read_record(self._get_read_map(),
+                                               self._read_offset)
+      if next_offset is None:
+        if self._read_segment == self._write_segment:
+          return None
+        self._next_read_segment()
+        continue
+      if payload is None:
+        nuoca_log(logging.WARNING, "Spool %s: skipped a corrupt record"
+                  % self._directory)
+        self._read_offset = next_offset
+        continue
+      self._peeked = (next_offset, cPickle.loads(payload))
+      return self._peeked[1]
+    return None
+
+  def ack(self):
+    """
+    Remove the object returned by peek() from the spool.
+    """
+    if not self._peeked:
+      return
+    self._read_offset = self._peeked[0]
+    self._peeked = None
+    self._segment_records[self._read_segment] -= 1
+    self._write_cursor()
+
+  def close(self):
+    if self._read_map and self._read_map is not self._write_map:
+      self._read_map.close()
+    self._read_map = None
+    if self._write_map:
+      self._write_map.close()
+      self._write_map = None
+
+
+class SpoolDrainer(object):
+  """
+  Thread that replays the objects in a Spool through a store function,
+  oldest first.  If the store function raises an exception, the object
+  stays in the spool and is retried after a backoff.  After a
+  PartialStoreError, only its unstored values are retried.
+  """
+  MAX_RETRY_INTERVAL = 60.0
+
+  def __init__(self, spool, store_func, lock, drain_rate=10.0,
+               retry_interval=1.0):
+    """
+    :param spool: The spool
+    :type spool: ``Spool``
+
+    :param store_func: Called with each object from the spool.
+    :type store_func: ``callable``
+
+    :param lock: Held while the spool is used.
+    :type lock: ``threading.Lock``
+
+    :param drain_rate: Maximum objects replayed per second.
+    :type drain_rate: ``float``
+
+    :param retry_interval: Seconds to wait after the first failure.
+    :type retry_interval: ``float``
+    """
+    if drain_rate <= 0:
+      raise AttributeError("Spool drainRate must be positive: %s"
+                           % str(drain_rate))
+    self._spool = spool
+    self._store_func = store_func
+    self._lock = lock
+    self._drain_interval = 1.0 / drain_rate
+    self._retry_interval = retry_interval
+    self._wake_event = threading.Event()
+    self._stop_event = threading.Event()
+    self._thread = None
+    self._unstored = None  # (spooled object, values not yet stored)
+
+  def start(self):
+    self._stop_event.clear()
+    self._thread = threading.Thread(target=self._run,
+                                    name='SpoolDrainer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout=5):
+    self._stop_event.set()
+    self._wake_event.set()
+    if self._thread:
+      self._thread.join(timeout)
+
+  def wake(self):
+    """
+    Tell the drainer that there is something new in the spool.
+    """
+    self._wake_event.set()
+
+  def _drain_one(self):
+    """
+    :return: True if an object was replayed, False if the spool is
+      empty, None if the store function failed.
+    """
+    # The lock is not held while the store function runs, so that new
+    # values can be spooled meanwhile.
+    with self._lock:
+      if self._stop_event.is_set():
+        return False
+      obj = self._spool.peek()
+      if obj is None:
+        return False
+    values = obj
+    if self._unstored and self._unstored[0] is obj:
+      values = self._unstored[1]
+    try:
+      self._store_func(values)
+    except PartialStoreError as e:
+      self._unstored = (obj, e.unstored)
+      nuoca_log(logging.WARNING,
+                "SpoolDrainer: unable to replay %d spooled values: %s"
+                % (len(e.unstored), str(e)))
+      return None
+    except Exception as e:
+      nuoca_log(logging.WARNING,
+                "SpoolDrainer: unable to replay spooled values: %s"
+                % str(e))
+      return None
+    self._unstored = None
+    with self._lock:
+      # The spool may have been closed, or the object evicted, meanwhile.
+      if self._stop_event.is_set():
+        return False
+      if self._spool.peek() is obj:
+        self._spool.ack()
+      drained = not len(self._spool)
+    if drained:
+      nuoca_log(logging.INFO, "SpoolDrainer: spool drained")
+    return True
+
+  def _run(self):
+    retry_interval = self._retry_interval
+    while not self._stop_event.is_set():
+      self._wake_event.clear()
+      replayed = self._drain_one()
+      if replayed:
+        retry_interval = self._retry_interval
+        self._stop_event.wait(self._drain_interval)
+      elif replayed is None:
+        self._stop_event.wait(retry_interval)
+        retry_interval = min(retry_interval * 2, self.MAX_RETRY_INTERVAL)
+      else:
+        self._wake_event.wait()
@@ -0,0 +1,158 @@
+"""
+NuoCA plugin supervisor.
+
+PluginSupervisor tracks the health of each plugin: consecutive response
+timeouts, process exits and failed startups.  A plugin that times out
+too often, exits or fails to start is quarantined: NuoCA stops sending it
+requests, so it no longer costs each collection cycle its response
+timeout.  A quarantined plugin is due for a restart after a backoff that
+doubles with each quarantine, up to a maximum.
+
+The supervisor only keeps the bookkeeping.  NuoCA does the restarts.
+"""
+
+import logging
+import threading
+
+from nuoca_util import nuoca_log, nuoca_monotonic
+
+
+class PluginHealth(object):
+  """
+  Health of one plugin.
+  """
+  def __init__(self, name, backoff):
+    self.name = name
+    self.consecutive_failures = 0
+    self.consecutive_successes = 0
+    self.quarantined = False
+    self.quarantine_reason = None
+    self.restart_time = None
+    self.backoff = backoff
+    self.quarantines = 0
+    self.restarts = 0
+
+
+class PluginSupervisor(object):
+  """
+  Thread safe plugin health bookkeeping.  The collection loop and the
+  output dispatcher thread both report plugin responses.
+  """
+  # Consecutive successful responses after which the backoff is reset.
+  HEALTHY_RESPONSES = 10
+
+  def __init__(self, max_failures=3, initial_backoff=1.0, max_backoff=300.0,
+               clock=nuoca_monotonic):
+    """
+    :param max_failures: Consecutive response timeouts that quarantine a
+      plugin.
+    :type max_failures: ``int``
+
+    :param initial_backoff: Seconds before the first restart.
+    :type initial_backoff: ``float``
+
+    :param max_backoff: Maximum seconds between restarts.
+    :type max_backoff: ``float``
+
+    :param clock: Returns the current time in seconds.
+    :type clock: ``callable``
+    """
+    if max_failures < 1:
+      raise AttributeError("PLUGIN_MAX_FAILURES must be at least 1")
+    self._max_failures = max_failures
+    self._initial_backoff = initial_backoff
+    self._max_backoff = max_backoff
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._health = {}
+
+  def _get_health(self, name):
+    health = self._health.get(name)
+    if not health:
+      health = PluginHealth(name, self._initial_backoff)
+      self._health[name] = health
+    return health
+
+  def is_quarantined(self, name):
+    health = self._health.get(name)
+    return bool(health and health.quarantined)
+
+  def record_success(self, name):
+    """
+    Record a response from a plugin.
+    """
+    with self._lock:
+      health = self._get_health(name)
+      health.consecutive_failures = 0
+      health.consecutive_successes += 1
+      if health.consecutive_successes >= self.HEALTHY_RESPONSES:
+        health.backoff = self._initial_backoff
+
+  def record_failure(self, name, reason):
+    """
+    Record a response timeout.
+
+    :return: True if the plugin was quarantined.
+    :type: ``bool``
+    """
+    with self._lock:
+      health = self._get_health(name)
+      health.consecutive_successes = 0
+      health.consecutive_failures += 1
+      if health.quarantined or \
+          health.consecutive_failures < self._max_failures:
+        return False
+      reason = "%d consecutive failures, last: %s" % \
+               (health.consecutive_failures, reason)
+      self._quarantine(health, reason)
+      return True
+
+  def quarantine(self, name, reason):
+    """
+    Quarantine a plugin now, e.g. because its process exited.
+    """
+    with self._lock:
+      self._quarantine(self._get_health(name), reason)
+
+  def _quarantine(self, health, reason):
+    health.quarantined = True
+    health.quarantine_reason = reason
+    health.quarantines += 1
+    health.consecutive_successes = 0
+    health.restart_time = self._clock() + health.backoff
+    nuoca_log(logging.WARNING,
+              "Quarantined plugin %s (%s), restart in %.1f seconds"
+              % (health.name, reason, health.backoff))
+    health.backoff = min(health.backoff * 2, self._max_backoff)
+
+  def get_plugins_to_restart(self):
+    """
+    :return: Names of the quarantined plugins whose backoff has passed.
+    :type: ``list``
+    """
+    now = self._clock()
+    with self._lock:
+      return [x.name for x in self._health.values()
+              if x.quarantined and x.restart_time <= now]
+
+  def restart_succeeded(self, name):
+    with self._lock:
+      health = self._get_health(name)
+      health.quarantined = False
+      health.quarantine_reason = None
+      health.restart_time = None
+      health.consecutive_failures = 0
+      health.restarts += 1
+    nuoca_log(logging.INFO, "Restarted plugin: %s" % name)
+
+  def get_stats(self):
+    """
+    :return: Quarantine state, quarantine count and restart count by
+      plugin name.
+    :type: ``dict``
+    """
+    with self._lock:
+      return dict([(x.name, {'quarantined': int(x.quarantined),
+                             'quarantines': x.quarantines,
+                             'restarts': x.restarts})
+                   for x in self._health.values()])
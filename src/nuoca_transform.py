@@ -0,0 +1,302 @@
+"""
+Built-in NuoCA Transforms
+
+Transforms run between collection and storage.  Each transform receives
+every time-series value from a collection cycle and returns the values to
+pass on to the next transform, and finally to the output plugins.
+
+The built-in transforms run in the NuoCA process.  They are configured in
+the TRANSFORM_PLUGINS section of the NuoCA configuration, in the order they
+are applied, next to any Yapsy transform plugins.
+
+Example configuration:
+
+TRANSFORM_PLUGINS:
+- Rate:
+    keys:
+    - NuoMon.Commits
+    - NuoMon.Deletes
+    seriesKeys:
+    - NuoMon.Hostname
+    - NuoMon.ProcessId
+- Scale:
+    keyPattern: '^NuoMon[.]Memory'
+    factor: 0.000001
+    suffix: _MB
+- Rename:
+    fields:
+      ZBX.system.cpu.util[,idle]: cpu.idle
+"""
+
+import logging
+import re
+
+from nuoca_util import nuoca_log
+
+
+class NuocaTransform(object):
+  """
+  Base class for the built-in NuoCA Transforms.
+  """
+  def __init__(self, transform_name):
+    self._transform_name = transform_name
+    self._config = None
+
+  @property
+  def transform_name(self):
+    return self._transform_name
+
+  def startup(self, config):
+    self._config = config
+    return True
+
+  def shutdown(self):
+    pass
+
+  def transform(self, ts_values):
+    """
+    Transform the time-series values from one collection cycle.
+
+    :param ts_values: time-series values
+    :type ts_values: ``list`` of ``dict``
+
+    :return: transformed time-series values
+    :type: ``list`` of ``dict``
+    """
+    return ts_values
+
+
+class KeySelectionTransform(NuocaTransform):
+  """
+  Base class for transforms that apply to a selection of keys, given by a
+  'keys' list and/or a 'keyPattern' regular expression.
+  """
+  def __init__(self, transform_name):
+    super(KeySelectionTransform, self).__init__(transform_name)
+    self._keys = frozenset()
+    self._key_regex = None
+    self._suffix = ''
+    self._selected_cache = {}
+
+  def startup(self, config):
+    super(KeySelectionTransform, self).startup(config)
+    if not config or ('keys' not in config and 'keyPattern' not in config):
+      nuoca_log(logging.ERROR,
+                "%s transform: 'keys' or 'keyPattern' missing from config."
+                % self._transform_name)
+      return False
+    if 'keys' in config:
+      self._keys = frozenset(config['keys'])
+    if 'keyPattern' in config:
+      self._key_regex = re.compile(config['keyPattern'])
+    if 'suffix' in config:
+      self._suffix = config['suffix']
+    return True
+
+  def is_selected(self, key):
+    # The answer is cached because the same keys arrive every cycle.
+    selected = self._selected_cache.get(key)
+    if selected is None:
+      selected = key in self._keys or \
+          bool(self._key_regex and self._key_regex.search(key))
+      if len(self._selected_cache) > 100000:
+        self._selected_cache.clear()
+      self._selected_cache[key] = selected
+    return selected
+
+
+class CounterTransform(KeySelectionTransform):
+  """
+  Base class for transforms that compare each value with the previous
+  value of the same series.
+
+  A series is one selected key plus the values of the 'seriesKeys' in the
+  row, e.g. the hostname and process id of a NuoDB engine.  The state kept
+  per series is a single (timestamp, value) tuple.  Series that have not
+  been seen for 'maxAge' seconds (default: 10 of the longest collection
+  intervals) are forgotten.
+
+  When several rows of one collection cycle have the same series, e.g.
+  one row per engine without 'seriesKeys', their values cannot be told
+  apart.  Nothing is derived for that series, and a warning is logged
+  once.
+  """
+  PRUNE_EVERY = 100  # Collection cycles between pruning old series
+
+  def __init__(self, transform_name, default_suffix):
+    super(CounterTransform, self).__init__(transform_name)
+    self._suffix = default_suffix
+    self._series_keys = ()
+    self._max_age_ms = None
+    self._state = {}
+    self._transform_count = 0
+    self._warned_ambiguous = False
+
+  def startup(self, config):
+    if not super(CounterTransform, self).startup(config):
+      return False
+    if 'seriesKeys' in config:
+      self._series_keys = tuple(config['seriesKeys'])
+    max_age = config.get('maxAge')
+    max_interval = config.get('nuoca_max_collection_interval',
+                              config.get('nuoca_collection_interval'))
+    if max_age is None and max_interval:
+      max_age = 10 * max_interval
+    if max_age:
+      self._max_age_ms = int(max_age) * 1000
+    return True
+
+  def compute(self, prev_ts, prev_value, ts, value):
+    """
+    Compute the derived value.
+
+    :return: The derived value, or None to emit nothing.
+    """
+    raise NotImplementedError("Child class must implement compute method")
+
+  def transform(self, ts_values):
+    newest_ts = None
+    seen = set()
+    ambiguous = set()
+    derived_values = []
+    for ts_value in ts_values:
+      ts = ts_value.get('timestamp')
+      if ts is None:
+        continue
+      if newest_ts is None or ts > newest_ts:
+        newest_ts = ts
+      series_id = tuple([ts_value.get(x) for x in self._series_keys])
+      for key, value in ts_value.iteritems():
+        if not self.is_selected(key):
+          continue
+        if not isinstance(value, (int, long, float)) or \
+            isinstance(value, bool):
+          continue
+        state_key = (series_id, key)
+        if state_key in seen:
+          ambiguous.add(state_key)
+          continue
+        seen.add(state_key)
+        prev = self._state.get(state_key)
+        self._state[state_key] = (ts, value)
+        if not prev or ts <= prev[0]:
+          continue
+        derived_value = self.compute(prev[0], prev[1], ts, value)
+        if derived_value is not None:
+          derived_values.append((ts_value, state_key, derived_value))
+    for ts_value, state_key, derived_value in derived_values:
+      if state_key not in ambiguous:
+        ts_value[state_key[1] + self._suffix] = derived_value
+    if ambiguous:
+      for state_key in ambiguous:
+        del self._state[state_key]
+      if not self._warned_ambiguous:
+        self._warned_ambiguous = True
+        nuoca_log(logging.WARNING,
+                  "%s transform: several rows of a collection cycle have "
+                  "the same series of %s, so nothing is derived for them.  "
+                  "Set 'seriesKeys' to the keys that tell the rows apart."
+                  % (self._transform_name,
+                     ', '.join(sorted(set([x[1] for x in ambiguous])))))
+
+    self._transform_count += 1
+    if self._max_age_ms and newest_ts is not None and \
+        self._transform_count % self.PRUNE_EVERY == 0:
+      oldest_ts = newest_ts - self._max_age_ms
+      for state_key in [k for k, v in self._state.iteritems()
+                        if v[0] < oldest_ts]:
+        del self._state[state_key]
+    return ts_values
+
+
+class RateTransform(CounterTransform):
+  """
+  Convert cumulative counters to per-second rates.  A counter that goes
+  backwards is treated as a reset and produces no rate for that cycle.
+  The rate is added under the key name plus suffix (default '_rate').
+  """
+  def __init__(self, transform_name='Rate'):
+    super(RateTransform, self).__init__(transform_name, '_rate')
+
+  def compute(self, prev_ts, prev_value, ts, value):
+    if value < prev_value:
+      return None
+    return (value - prev_value) * 1000.0 / (ts - prev_ts)
+
+
+class DeltaTransform(CounterTransform):
+  """
+  Compute the change in value since the previous collection.  The delta is
+  added under the key name plus suffix (default '_delta').
+  """
+  def __init__(self, transform_name='Delta'):
+    super(DeltaTransform, self).__init__(transform_name, '_delta')
+
+  def compute(self, prev_ts, prev_value, ts, value):
+    return value - prev_value
+
+
+class ScaleTransform(KeySelectionTransform):
+  """
+  Multiply values by 'factor', e.g. for unit conversion.  With a 'suffix'
+  the scaled value is added under a new key, otherwise it replaces the
+  original value.
+  """
+  def __init__(self, transform_name='Scale'):
+    super(ScaleTransform, self).__init__(transform_name)
+    self._factor = 1
+
+  def startup(self, config):
+    if not super(ScaleTransform, self).startup(config):
+      return False
+    if 'factor' not in config:
+      nuoca_log(logging.ERROR, "%s transform: 'factor' missing from config."
+                % self._transform_name)
+      return False
+    self._factor = float(config['factor'])
+    return True
+
+  def transform(self, ts_values):
+    for ts_value in ts_values:
+      scaled_values = []
+      for key, value in ts_value.iteritems():
+        if self.is_selected(key) and \
+            isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool):
+          scaled_values.append((key + self._suffix, value * self._factor))
+      for key, value in scaled_values:
+        ts_value[key] = value
+    return ts_values
+
+
+class RenameTransform(NuocaTransform):
+  """
+  Rename keys.  The 'fields' configuration maps old key names to new ones.
+  """
+  def __init__(self, transform_name='Rename'):
+    super(RenameTransform, self).__init__(transform_name)
+    self._fields = {}
+
+  def startup(self, config):
+    super(RenameTransform, self).startup(config)
+    if not config or 'fields' not in config:
+      nuoca_log(logging.ERROR, "%s transform: 'fields' missing from config."
+                % self._transform_name)
+      return False
+    self._fields = dict(config['fields'])
+    return True
+
+  def transform(self, ts_values):
+    for ts_value in ts_values:
+      for old_key, new_key in self._fields.iteritems():
+        if old_key in ts_value:
+          ts_value[new_key] = ts_value.pop(old_key)
+    return ts_values
+
+
+BUILTIN_TRANSFORMS = {
+  'Rate': RateTransform,
+  'Delta': DeltaTransform,
+  'Scale': ScaleTransform,
+  'Rename': RenameTransform
+}
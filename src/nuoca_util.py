@@ -1,12 +1,21 @@
+import calendar
+import collections
+import cPickle
 import datetime
+import errno
+import heapq
 import os
+import re
 import time
 import uuid
 import sys
 import hashlib
 import logging
-import subprocess
+import _multiprocessing
+import select
+import threading
 from nuoca_config import NuocaConfig
+from nuoca_logging import LogWriter, QueueLogHandler
 
 SECONDS_PER_DAY = 3600*24
 DEFAULT_SEED_TS = 931752000  # Default NuoCA Epoch Timestamp
@@ -17,6 +26,7 @@ if not os.path.exists(NuocaConfig.NUOCA_TMPDIR):
 
 nuoca_logger = None
 nuoca_loghandler = None
+nuoca_logwriter = None
 yapsy_logger = None
 yapsy_loghandler = None
 last_log_message = None
@@ -41,14 +51,33 @@ class UTC(datetime.tzinfo):
     return self._zero
 
 
-def initialize_logger(nuoca_logfile_name):
-  global nuoca_logger, nuoca_loghandler
+def initialize_logger(nuoca_logfile_name, flush_interval=1.0,
+                      flush_records=100):
+  """
+  Log to a file.  Records are written to the file by a LogWriter thread,
+  which also writes the records of the plugin processes that are forked
+  after this call.
+  :param nuoca_logfile_name: Path of the log file.
+  :type nuoca_logfile_name: ``str``
+  :param flush_interval: Maximum seconds that a record stays unflushed.
+  :type flush_interval: ``float``
+  :param flush_records: Flush after this many records.
+  :type flush_records: ``int``
+  """
+  global nuoca_logger, nuoca_loghandler, nuoca_logwriter
   global yapsy_logger, yapsy_loghandler
 
+  # Replace the handlers of an earlier call.
+  stop_log_writer()
+
   logging.basicConfig(level=logging.INFO)
+  nuoca_logwriter = LogWriter(nuoca_logfile_name, flush_interval,
+                              flush_records)
+  nuoca_logwriter.start()
+
   # Global NuoCA logger
   nuoca_logger = logging.getLogger('nuoca')
-  nuoca_loghandler = logging.FileHandler(nuoca_logfile_name)
+  nuoca_loghandler = QueueLogHandler(nuoca_logwriter)
   nuoca_loghandler.setLevel(logging.INFO)
   nuoca_loghandler.setFormatter(
     logging.Formatter('%(asctime)s NuoCA %(levelname)s %(message)s'))
@@ -56,13 +85,30 @@ def initialize_logger(nuoca_logfile_name):
 
   # Global Yapsy logger
   yapsy_logger = logging.getLogger('yapsy')
-  yapsy_loghandler = logging.FileHandler(nuoca_logfile_name)
+  yapsy_loghandler = QueueLogHandler(nuoca_logwriter)
   yapsy_loghandler.setLevel(logging.INFO)
   yapsy_loghandler.setFormatter(
     logging.Formatter('%(asctime)s YAPSY %(levelname)s %(message)s'))
   yapsy_logger.addHandler(yapsy_loghandler)
 
 
+def stop_log_writer():
+  """
+  Write the queued log records, and stop logging to the log file.
+  """
+  global nuoca_logger, nuoca_loghandler, nuoca_logwriter
+  global yapsy_logger, yapsy_loghandler
+  if nuoca_loghandler:
+    nuoca_logger.removeHandler(nuoca_loghandler)
+    nuoca_loghandler = None
+  if yapsy_loghandler:
+    yapsy_logger.removeHandler(yapsy_loghandler)
+    yapsy_loghandler = None
+  if nuoca_logwriter:
+    nuoca_logwriter.stop()
+    nuoca_logwriter = None
+
+
 def randomid():
   """
   Returns a unique 32 character string for correlating different log lines.
@@ -137,21 +183,32 @@ def nuoca_set_log_level(log_level):
   global nuoca_loghandler, yapsy_loghandler
   logging.getLogger('nuoca').setLevel(level=log_level)
   logging.getLogger('yapsy').setLevel(level=log_level)
-  nuoca_loghandler.setLevel(log_level)
-  yapsy_loghandler.setLevel(log_level)
+  if nuoca_loghandler:
+    nuoca_loghandler.setLevel(log_level)
+  if yapsy_loghandler:
+    yapsy_loghandler.setLevel(log_level)
 
 
-def nuoca_log(log_level, msg):
+def nuoca_log(log_level, msg, *args):
   """
-  Logger message
+  Logger message.  The message is only formatted with the args if the log
+  level is enabled, so that disabled DEBUG messages cost nothing:
+
+    nuoca_log(logging.DEBUG, "Response: %s", response)
+
   :param log_level: logger log level
   :param msg: str: log message
+  :param args: Optional arguments for the message format.
   """
-  global nuoca_logger, nuoca_loghandler
+  global nuoca_logger
   global last_log_message, last_log_error_message
 
   if not msg:
     return
+  if nuoca_logger and not nuoca_logger.isEnabledFor(log_level):
+    return
+  if args:
+    msg = msg % args
 
   last_log_message = msg
   if log_level == logging.ERROR:
@@ -162,13 +219,13 @@ def nuoca_log(log_level, msg):
     sys.stderr.write(msg)
     return
   nuoca_logger.log(log_level, msg)
-  nuoca_loghandler.flush()
 
 
 def nuoca_logging_shutdown():
   """
   Shutdown ALL logging
   """
+  stop_log_writer()
   logging.shutdown()
 
 
@@ -188,9 +245,192 @@ def nuoca_get_last_log_error_message():
 
 def nuoca_gettimestamp():
   """
-  Get the current Epoch time (Unix Timestamp)
+  Get the current Epoch time (Unix Timestamp) from the NuoCA clock
+  """
+  return int(nuoca_clock.time())
+
+
+def _init_monotonic():
+  """
+  Locate a monotonic clock function.  Python 2 has no time.monotonic(), so
+  fall back to clock_gettime(CLOCK_MONOTONIC) through ctypes, and finally
+  to time.time() on platforms where neither is available.
+  """
+  if hasattr(time, 'monotonic'):
+    return time.monotonic
+  try:
+    import ctypes
+    import ctypes.util
+
+    class _Timespec(ctypes.Structure):
+      _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_monotonic = 1  # CLOCK_MONOTONIC on Linux
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+      ts = _Timespec()
+      if clock_gettime(clock_monotonic, ctypes.byref(ts)) != 0:
+        return time.time()
+      return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    monotonic()
+    return monotonic
+  except Exception:
+    return time.time
+
+
+_monotonic = _init_monotonic()
+
+
+def nuoca_monotonic():
+  """
+  Get the current value of a monotonic clock in fractional seconds.  Only
+  the difference between two values is meaningful, so use this for
+  deadlines and durations that must not jump with the wall clock.
+
+  This is always the real clock, even with a VirtualClock, because it is
+  used for pipe timeouts and for measuring how long work takes.
+  """
+  return _monotonic()
+
+
+class SystemClock(object):
+  """
+  The clock that NuoCA uses for collection intervals and timestamps.
+  """
+  def time(self):
+    """
+    :return: UTC epoch seconds
+    :type: ``float``
+    """
+    return time.time()
+
+  def monotonic(self):
+    return _monotonic()
+
+  def sleep(self, seconds):
+    time.sleep(seconds)
+
+
+class VirtualClock(object):
+  """
+  A clock whose sleep() returns at once, after moving the clock forward.
+  With a VirtualClock, NuoCA runs its collection intervals back to back,
+  which makes self tests fast and measures the maximum cycle rate.
+  """
+  def __init__(self, start_time=None):
+    """
+    :param start_time: UTC epoch seconds to start at.  Defaults to now.
+    :type start_time: ``float``
+    """
+    if start_time is None:
+      start_time = time.time()
+    self._lock = threading.Lock()
+    self._start_time = start_time
+    self._elapsed = 0.0
+
+  def time(self):
+    with self._lock:
+      return self._start_time + self._elapsed
+
+  def monotonic(self):
+    with self._lock:
+      return self._elapsed
+
+  def sleep(self, seconds):
+    self.advance(seconds)
+
+  def advance(self, seconds):
+    if seconds > 0:
+      with self._lock:
+        self._elapsed += seconds
+
+  def set_time(self, epoch_seconds):
+    """
+    Move the clock forward to a point in time.  The clock never moves
+    back.
+    """
+    with self._lock:
+      self._elapsed = max(self._elapsed, epoch_seconds - self._start_time)
+
+
+nuoca_clock = SystemClock()
+
+
+def get_nuoca_clock():
+  return nuoca_clock
+
+
+def set_nuoca_clock(clock):
+  """
+  Replace the NuoCA clock used by IntervalSync, IntervalScheduler and
+  nuoca_gettimestamp().  Plugin processes that are forked afterwards
+  inherit it.
+
+  :param clock: A SystemClock or VirtualClock
+  """
+  global nuoca_clock
+  nuoca_clock = clock
+
+
+def sync_virtual_clock(epoch_seconds):
+  """
+  Move a plugin's VirtualClock to NuoCA's virtual time.  A plugin process
+  has its own copy of the clock, which does not advance by itself.
+
+  :param epoch_seconds: UTC epoch seconds
+  :type epoch_seconds: ``float``
+  """
+  if isinstance(nuoca_clock, VirtualClock):
+    nuoca_clock.set_time(epoch_seconds)
+  else:
+    set_nuoca_clock(VirtualClock(epoch_seconds))
+
+
+def wait_for_pipes(pipes, timeout):
+  """
+  Wait until one or more pipes have data available to read.
+
+  :param pipes: multiprocessing Connection objects, or any objects with a
+    fileno() method.
+  :type pipes: ``list``
+
+  :param timeout: Maximum seconds to wait.
+  :type timeout: ``float``
+
+  :return: ``list`` of the pipes that are ready to read.
+  """
+  if not pipes:
+    return []
+  timeout = max(timeout, 0)
+  deadline = nuoca_monotonic() + timeout
+  while True:
+    try:
+      ready, _, _ = select.select(pipes, [], [], timeout)
+      return ready
+    except (select.error, IOError, OSError) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+      timeout = max(deadline - nuoca_monotonic(), 0)
+
+
+def recv_with_size(pipe):
+  """
+  Receive a message from a pipe along with its size on the wire.
+
+  :param pipe: multiprocessing Connection, or a pipe object with a
+    'last_recv_size' attribute, such as a ShmPipe.
+  :return: (message, size in bytes) tuple.  The size is 0 for pipes that
+    pass messages by reference.
   """
-  return int(time.time())
+  if isinstance(pipe, _multiprocessing.Connection):
+    data = pipe.recv_bytes()
+    return cPickle.loads(data), len(data)
+  message = pipe.recv()
+  return message, getattr(pipe, 'last_recv_size', 0)
 
 
 def parse_keyval_list(options):
@@ -231,6 +471,165 @@ def parse_keyval_list(options):
   return ret
 
 
+class ProcessInfo(object):
+  """
+  A process found by ProcessIndex.
+  """
+  def __init__(self, pid, comm, cmdline):
+    self.pid = pid
+    self.comm = comm  # Command name, at most 15 characters
+    self.cmdline = cmdline  # Arguments, joined by spaces
+
+  def __repr__(self):
+    return "ProcessInfo(%d, %r)" % (self.pid, self.comm)
+
+
+class ProcessIndex(object):
+  """
+  Index of the running processes, read from /proc without forking.
+
+  The /proc/<pid>/comm and /proc/<pid>/cmdline of all processes are read
+  in one scan.  The scan is reused for ttl seconds, so that several
+  lookups in a row cost one scan.
+  """
+  # Fields of /proc/<pid>/stat after the command name, see proc(5).
+  _STAT_FIELDS = {'state': 0, 'ppid': 1, 'minflt': 7, 'majflt': 9,
+                  'utime': 11, 'stime': 12, 'num_threads': 17,
+                  'starttime': 19, 'vsize': 20, 'rss': 21, 'processor': 36}
+
+  def __init__(self, ttl=1.0, proc_dir='/proc'):
+    """
+    :param ttl: Seconds to reuse a scan.
+    :type ttl: ``float``
+
+    :param proc_dir: Mount point of the proc file system.
+    :type proc_dir: ``str``
+    """
+    self._ttl = ttl
+    self._proc_dir = proc_dir
+    self._processes = {}
+    self._scan_time = None
+    self._lock = threading.Lock()
+
+  def _read_proc_file(self, pid, name):
+    with open(os.path.join(self._proc_dir, str(pid), name)) as proc_file:
+      return proc_file.read()
+
+  def refresh(self):
+    """
+    Scan /proc now.
+    """
+    processes = {}
+    for entry in os.listdir(self._proc_dir):
+      if not entry.isdigit():
+        continue
+      pid = int(entry)
+      try:
+        comm = self._read_proc_file(pid, 'comm').rstrip('\n')
+        cmdline = self._read_proc_file(pid, 'cmdline')
+      except (IOError, OSError):
+        # The process exited during the scan.
+        continue
+      processes[pid] = ProcessInfo(pid, comm,
+                                   ' '.join(cmdline.rstrip('\0').split('\0')))
+    with self._lock:
+      self._processes = processes
+      self._scan_time = nuoca_monotonic()
+
+  def get_processes(self):
+    """
+    :return: ProcessInfo by pid, from a scan that is at most ttl seconds
+      old.
+    :type: ``dict``
+    """
+    with self._lock:
+      scan_time = self._scan_time
+    if scan_time is None or nuoca_monotonic() - scan_time >= self._ttl:
+      self.refresh()
+    with self._lock:
+      return self._processes
+
+  def find_pids(self, pattern, match='substring', field='comm'):
+    """
+    Find running processes.
+
+    :param pattern: Name, or regular expression, to look for.
+    :type pattern: ``str``
+
+    :param match: 'substring', 'exact' or 'regex'.  A regex is matched
+      with re.search().
+    :type match: ``str``
+
+    :param field: Match the 'comm' (command name) or the 'cmdline' of the
+      processes.
+    :type field: ``str``
+
+    :return: Sorted pids of the matching processes.
+    :type: ``list`` of ``int``
+    """
+    if field not in ('comm', 'cmdline'):
+      raise AttributeError("Unknown process field: %s" % field)
+    if match == 'substring':
+      matches = lambda value: pattern in value
+    elif match == 'exact':
+      matches = lambda value: pattern == value
+    elif match == 'regex':
+      matches = re.compile(pattern).search
+    else:
+      raise AttributeError("Unknown process match: %s" % match)
+    return sorted([pid for pid, info in self.get_processes().iteritems()
+                   if matches(getattr(info, field))])
+
+  def read_stat(self, pid):
+    """
+    Read /proc/<pid>/stat.  Times are in clock ticks, vsize in bytes and
+    rss in pages.
+
+    :param pid: Process id
+    :type pid: ``int``
+
+    :return: state, ppid, minflt, majflt, utime, stime, num_threads,
+      starttime, vsize, rss and processor of the process, or None if the
+      process does not exist.
+    :type: ``dict``
+    """
+    try:
+      stat = self._read_proc_file(pid, 'stat')
+    except (IOError, OSError):
+      return None
+    # The command name is in parentheses and can contain spaces.
+    fields = stat[stat.rindex(')') + 2:].split()
+    result = dict([(name, int(fields[index]))
+                   for name, index in self._STAT_FIELDS.iteritems()
+                   if name != 'state' and index < len(fields)])
+    result['state'] = fields[0]
+    return result
+
+
+_process_index = None
+
+
+def get_process_index():
+  """
+  :return: The ProcessIndex of this process.
+  :type: ``ProcessIndex``
+  """
+  global _process_index
+  if _process_index is None:
+    _process_index = ProcessIndex(NuocaConfig.PROCESS_INDEX_TTL)
+  return _process_index
+
+
+def find_processes(pattern, match='substring', field='comm'):
+  '''
+  Find running processes.  See ProcessIndex.find_pids().
+
+  :return: Sorted pids of the matching processes.
+  :type: ``list`` of ``int``
+  '''
+  return get_process_index().find_pids(pattern, match, field)
+
+
 def search_running_processes(search_str):
   '''
   Return True if the search_str is in the command of any running process
@@ -241,29 +640,203 @@ def search_running_processes(search_str):
   :return: True if process name is found, otherwise False
   '''
   try:
-    p = subprocess.Popen(["ps", "axo", "comm"], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    if (search_str in out):
-      return True
+    return bool(find_processes(search_str))
   except Exception:
     return False
-  return False
 
 
-def execute_command(command):
+_command_executor = None
+_command_executor_pid = None
+_command_executor_lock = threading.Lock()
+
+
+def get_command_executor():
+  """
+  :return: The CommandExecutor of this process.  A plugin process gets
+    its own when it first runs a command.  Thread hosted plugins share
+    the one of the NuoCA process.
+  :type: ``nuoca_command.CommandExecutor``
+  """
+  global _command_executor, _command_executor_pid
+  with _command_executor_lock:
+    if _command_executor_pid != os.getpid():
+      from nuoca_command import CommandExecutor
+      # Shell workers that were inherited from the parent belong to it.
+      _command_executor = CommandExecutor(NuocaConfig.COMMAND_WORKERS,
+                                          NuocaConfig.COMMAND_TIMEOUT)
+      _command_executor_pid = os.getpid()
+    return _command_executor
+
+
+def execute_command(command, timeout=None, cache_ttl=None):
   '''
-  Execute a posix command
+  Execute a posix command on one of the long-lived shell workers of this
+  process.
 
   :param command: command line to execute
   :type command: ``str``
 
+  :param timeout: Optional maximum seconds for the command.  A command
+    that times out is killed and returns exit code 124.  None means
+    NuocaConfig.COMMAND_TIMEOUT.
+  :type timeout: ``float``
+
+  :param cache_ttl: Optional seconds to reuse the result of an earlier,
+    successful run of the same command.  Use only for idempotent commands.
+  :type cache_ttl: ``float``
+
   :return: Python tuple of (exit_code, stdout, stderr)
   '''
-  p = subprocess.Popen([command], shell=True, stdout=subprocess.PIPE,
-                       stderr=subprocess.PIPE)
-  stdout, stderr = p.communicate()
-  exit_code = p.returncode
-  return (exit_code, stdout, stderr)
+  return get_command_executor().execute(command, timeout, cache_ttl)
+
+
+def execute_commands(commands, timeout=None):
+  '''
+  Execute posix commands concurrently on the shell workers of this
+  process.
+
+  :param commands: command lines to execute
+  :type commands: ``list`` of ``str``
+
+  :param timeout: Optional maximum seconds for each command.  None means
+    NuocaConfig.COMMAND_TIMEOUT.
+  :type timeout: ``float``
+
+  :return: ``list`` of (exit_code, stdout, stderr), in the order of the
+    commands.
+  '''
+  return get_command_executor().execute_all(commands, timeout)
+
+
+_ISO8601_SUFFIX = re.compile(r'(?:[.,](\d+))?(Z|[+-]\d\d(?::?\d\d)?)?$')
+
+
+class TimestampParser(object):
+  """
+  Converts timestamps to UTC epoch milliseconds.
+
+  Timestamps in the ISO-8601 formats that Logstash writes, such as
+  2017-06-01T12:00:01.250Z, are parsed directly.  The epoch seconds of
+  each date and time up to the second are cached, so timestamps within
+  the same second are converted without date arithmetic.  Other
+  timestamps are parsed with dateutil.  Timestamps without a time zone
+  are taken to be UTC.
+  """
+  def __init__(self, cache_size=4096):
+    """
+    :param cache_size: Maximum cached seconds.
+    :type cache_size: ``int``
+    """
+    self._cache_size = cache_size
+    self._epoch_seconds = {}
+    self._fallbacks = 0
+
+  @property
+  def fallbacks(self):
+    """
+    Number of timestamps that were parsed with dateutil.
+    """
+    return self._fallbacks
+
+  def _prefix_epoch_seconds(self, prefix):
+    """
+    :param prefix: 'YYYY-MM-DDTHH:MM:SS'
+    :return: UTC epoch seconds, or None if the prefix is not a valid date
+      and time.
+    """
+    try:
+      dt = datetime.datetime(int(prefix[0:4]), int(prefix[5:7]),
+                             int(prefix[8:10]), int(prefix[11:13]),
+                             int(prefix[14:16]), int(prefix[17:19]))
+    except ValueError:
+      return None
+    if len(self._epoch_seconds) >= self._cache_size:
+      self._epoch_seconds.clear()
+    seconds = calendar.timegm(dt.utctimetuple())
+    self._epoch_seconds[prefix] = seconds
+    return seconds
+
+  def _fallback(self, timestamp):
+    from dateutil.parser import parse as date_parse
+    self._fallbacks += 1
+    dt = date_parse(timestamp)
+    if dt.tzinfo is not None:
+      epoch_seconds = calendar.timegm(dt.utctimetuple())
+    else:
+      epoch_seconds = calendar.timegm(dt.timetuple())
+    return epoch_seconds * 1000 + dt.microsecond // 1000
+
+  def to_epoch_millis(self, timestamp):
+    """
+    :param timestamp: Date and time
+    :type timestamp: ``str``
+
+    :return: UTC epoch milliseconds
+    :type: ``int``
+    """
+    prefix = timestamp[:19]
+    seconds = self._epoch_seconds.get(prefix)
+    if seconds is None:
+      if len(prefix) != 19 or prefix[4] != '-' or prefix[7] != '-' or \
+          prefix[10] not in 'T ' or prefix[13] != ':' or prefix[16] != ':':
+        return self._fallback(timestamp)
+      seconds = self._prefix_epoch_seconds(prefix)
+      if seconds is None:
+        return self._fallback(timestamp)
+    suffix = timestamp[19:]
+    if suffix == 'Z':
+      return seconds * 1000
+    match = _ISO8601_SUFFIX.match(suffix)
+    if not match:
+      return self._fallback(timestamp)
+    fraction, zone = match.groups()
+    millis = seconds * 1000
+    if fraction:
+      millis += int(fraction[:3].ljust(3, '0'))
+    if zone and zone != 'Z':
+      minutes = int(zone[-2:]) if len(zone) > 3 else 0
+      offset = int(zone[1:3]) * 60 + minutes
+      if zone[0] == '+':
+        offset = -offset
+      millis += offset * 60000
+    return millis
+
+  def to_epoch_millis_batch(self, timestamps):
+    """
+    :param timestamps: Dates and times
+    :type timestamps: ``list`` of ``str``
+
+    :return: UTC epoch milliseconds of each timestamp, or None for a
+      timestamp that cannot be parsed.
+    :type: ``list``
+    """
+    to_epoch_millis = self.to_epoch_millis
+    millis = []
+    for timestamp in timestamps:
+      try:
+        millis.append(to_epoch_millis(timestamp))
+      except (ValueError, OverflowError, TypeError) as e:
+        nuoca_log(logging.WARNING, "Cannot parse timestamp '%s': %s"
+                  % (timestamp, str(e)))
+        millis.append(None)
+    return millis
+
+
+_timestamp_parser = TimestampParser()
+
+
+def timestamp_to_epoch_millis(timestamp):
+  '''
+  Convert a timestamp, such as 2017-06-01T12:00:01.250Z, to UTC epoch
+  milliseconds.  See TimestampParser.
+
+  :param timestamp: Date and time
+  :type timestamp: ``str``
+
+  :return: UTC epoch milliseconds
+  :type: ``int``
+  '''
+  return _timestamp_parser.to_epoch_millis(timestamp)
 
 
 def coerce_numeric(s):
@@ -283,6 +856,169 @@ def coerce_numeric(s):
       return s
 
 
+class BoundedQueue(object):
+  """
+  BoundedQueue
+
+  A thread-safe FIFO queue with a maximum depth.  When the queue is full,
+  put() follows the overflow policy:
+
+    block: wait until a consumer makes room.
+    drop_oldest: discard the item at the head of the queue.
+    drop_newest: discard the item being put.
+
+  The queue records its high-water mark, the largest depth that it
+  reached.
+  """
+  BLOCK = 'block'
+  DROP_OLDEST = 'drop_oldest'
+  DROP_NEWEST = 'drop_newest'
+  POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+  def __init__(self, maxlen, overflow_policy=BLOCK):
+    """
+    :param maxlen: Maximum number of items in the queue.
+    :type maxlen: ``int``
+
+    :param overflow_policy: One of BoundedQueue.POLICIES
+    :type overflow_policy: ``str``
+    """
+    if overflow_policy not in self.POLICIES:
+      raise AttributeError("Unknown queue overflow policy: %s" %
+                           overflow_policy)
+    if maxlen < 1:
+      raise AttributeError("Queue maxlen must be at least 1")
+    self._maxlen = maxlen
+    self._overflow_policy = overflow_policy
+    self._items = collections.deque()
+    self._lock = threading.Lock()
+    self._not_empty = threading.Condition(self._lock)
+    self._not_full = threading.Condition(self._lock)
+    self._dropped_count = 0
+    self._high_water_mark = 0
+
+  def __len__(self):
+    return len(self._items)
+
+  @property
+  def maxlen(self):
+    return self._maxlen
+
+  @property
+  def overflow_policy(self):
+    return self._overflow_policy
+
+  @property
+  def dropped_count(self):
+    return self._dropped_count
+
+  @property
+  def high_water_mark(self):
+    return self._high_water_mark
+
+  def full(self):
+    return len(self._items) >= self._maxlen
+
+  def put(self, item, timeout=None):
+    """
+    Add an item to the tail of the queue.
+
+    :param item: The item
+    :param timeout: Maximum seconds to wait for room with the block
+      policy.  None waits forever.
+    :type timeout: ``float``
+
+    :return: The item that was dropped to make room, or None.
+    """
+    with self._lock:
+      if len(self._items) >= self._maxlen:
+        if self._overflow_policy == self.DROP_NEWEST:
+          self._dropped_count += 1
+          return item
+        elif self._overflow_policy == self.DROP_OLDEST:
+          dropped_item = self._items.popleft()
+          self._dropped_count += 1
+          self._items.append(item)
+          self._not_empty.notify()
+          return dropped_item
+        else:
+          deadline = None
+          if timeout is not None:
+            deadline = nuoca_monotonic() + timeout
+          while len(self._items) >= self._maxlen:
+            if deadline is None:
+              self._not_full.wait()
+            else:
+              remaining = deadline - nuoca_monotonic()
+              if remaining <= 0:
+                self._dropped_count += 1
+                return item
+              self._not_full.wait(remaining)
+      self._items.append(item)
+      if len(self._items) > self._high_water_mark:
+        self._high_water_mark = len(self._items)
+      self._not_empty.notify()
+      return None
+
+  def get(self, timeout=None):
+    """
+    Remove and return the item at the head of the queue.
+
+    :param timeout: Maximum seconds to wait for an item.  None waits
+      forever.
+    :type timeout: ``float``
+
+    :return: The item, or None if the timeout expired.
+    """
+    with self._lock:
+      deadline = None
+      if timeout is not None:
+        deadline = nuoca_monotonic() + timeout
+      while not self._items:
+        if deadline is None:
+          self._not_empty.wait()
+        else:
+          remaining = deadline - nuoca_monotonic()
+          if remaining <= 0:
+            return None
+          self._not_empty.wait(remaining)
+      item = self._items.popleft()
+      self._not_full.notify()
+      return item
+
+  def drain(self):
+    """
+    Remove and return all the items, without waiting.  The items are
+    swapped out in one step, so a producer is held up only briefly.
+
+    :return: The items, oldest first.
+    :type: ``collections.deque``
+    """
+    with self._lock:
+      items = self._items
+      self._items = collections.deque()
+      self._not_full.notify_all()
+      return items
+
+  def get_stats(self, reset=True):
+    """
+    :param reset: Reset the dropped count, and the high-water mark to the
+      current depth.
+    :type reset: ``bool``
+
+    :return: Current depth, high-water mark and dropped count.
+    :type: ``dict``
+    """
+    with self._lock:
+      stats = {'depth': len(self._items),
+               'high_water_mark': self._high_water_mark,
+               'dropped': self._dropped_count}
+      if reset:
+        self._dropped_count = 0
+        self._high_water_mark = len(self._items)
+      return stats
+
+
 class IntervalSync(object):
   """
   IntervalSync
@@ -300,7 +1036,7 @@ class IntervalSync(object):
   that want to start the collections at specific time, should use seed_ts.
 
   """
-  def __init__(self, interval, seed_ts=None):
+  def __init__(self, interval, seed_ts=None, clock=None):
     """
     Initialize IntervalSync
 
@@ -311,8 +1047,10 @@ class IntervalSync(object):
       seed_ts is a point in the future, the next interval will begin at that
       seed_ts.
      :type ``int``
+    :param clock: Optional clock.  Defaults to the NuoCA clock.
     """
     self._interval = interval
+    self._clock = clock
     self._utc_tzinfo = UTC()
     self._seed_ts = seed_ts
     self._unix_epoch = datetime.datetime(1970, 1, 1, tzinfo=self._utc_tzinfo)
@@ -322,13 +1060,25 @@ class IntervalSync(object):
     self._seed_dt = datetime.datetime.fromtimestamp(self._seed_ts,
                                                     self._utc_tzinfo)
 
+  @property
+  def interval(self):
+    return self._interval
+
+  @property
+  def clock(self):
+    return self._clock or nuoca_clock
+
+  def _now_dt(self):
+    return datetime.datetime.fromtimestamp(self.clock.time(),
+                                           self._utc_tzinfo)
+
   def compute_next_interval(self):
     """
     Compute the next time interval.
 
     :return: datetime object for the next interval.
     """
-    now_dt = datetime.datetime.now(self._utc_tzinfo)
+    now_dt = self._now_dt()
     seed_delta = now_dt - self._seed_dt
     seed_delta_total_seconds = seed_delta.total_seconds()
     if seed_delta_total_seconds >= 0:
@@ -359,11 +1109,201 @@ class IntervalSync(object):
     # datetime.total_seconds() returns a floating point number
     # with microsecond accuracy.
 
-    next_ts = int((next_interval_dt - self._unix_epoch).total_seconds())
-    while True:
-      utc_now = datetime.datetime.now(self._utc_tzinfo)
-      diff = (next_interval_dt - utc_now).total_seconds()
-      if diff <= 0:
-        return next_ts
-      time.sleep(diff / 2.0)
+    next_ts = self.to_timestamp(next_interval_dt)
+    self.sleep_until(next_interval_dt)
+    return next_ts
+
+  def to_timestamp(self, interval_dt):
+    """
+    :param interval_dt: datetime returned by compute_next_interval()
+    :return: UTC epoch timestamp in seconds
+    :type: ``int``
+    """
+    return int((interval_dt - self._unix_epoch).total_seconds())
+
+  def next_timestamp(self, after_ts):
+    """
+    Compute the first interval after a point in time.
+
+    :param after_ts: UTC epoch seconds
+    :type after_ts: ``float``
+    :return: UTC epoch timestamp in seconds of the next interval.
+    :type: ``int``
+    """
+    if after_ts < self._seed_ts:
+      return self._seed_ts
+    elapsed_intervals = int(after_ts - self._seed_ts) // self._interval
+    return self._seed_ts + (elapsed_intervals + 1) * self._interval
+
+  def sleep_until(self, interval_dt):
+    """
+    Sleep until a precise point in time.  The point in time is converted
+    to a monotonic clock deadline once, so that the sleep is not affected
+    by wall clock changes.
+
+    :param interval_dt: datetime returned by compute_next_interval()
+    """
+    clock = self.clock
+    sleep_until_monotonic(
+      clock.monotonic() + (interval_dt - self._now_dt()).total_seconds(),
+      clock)
+
+
+def sleep_until_monotonic(deadline, clock=None):
+  """
+  Sleep until a monotonic clock deadline.  Normally this is a single
+  sleep; it sleeps again only if it was woken up early, e.g. by a signal.
+
+  :param deadline: clock.monotonic() deadline
+  :type deadline: ``float``
+  :param clock: Optional clock.  Defaults to the NuoCA clock.
+  """
+  clock = clock or nuoca_clock
+  while True:
+    remaining = deadline - clock.monotonic()
+    if remaining <= 0:
+      return
+    clock.sleep(remaining)
+
+
+class IntervalScheduler(object):
+  """
+  Runs several collection schedules, each with its own interval, from one
+  timer heap.  Every schedule follows IntervalSync semantics: intervals
+  are aligned to the same seed timestamp, so that the same intervals are
+  used by all processes and nodes.
+
+  Each wait converts the next interval to a monotonic clock deadline once
+  and sleeps once.  The scheduler records how late each wakeup was.
+
+  An interval that has already passed when the scheduler starts to wait
+  for it, because the caller was busy past it, is an overrun.  The
+  overrun policy decides what happens to it:
+
+    skip: the passed intervals are skipped, and the scheduler waits for
+      the next interval.
+    catch_up: each passed interval is returned in turn, without waiting.
+    coalesce: only the most recent passed interval is returned, without
+      waiting.
+  """
+  SKIP = 'skip'
+  CATCH_UP = 'catch_up'
+  COALESCE = 'coalesce'
+  OVERRUN_POLICIES = (SKIP, CATCH_UP, COALESCE)
+
+  def __init__(self, seed_ts=None, overrun_policy=SKIP, tolerance=0.001,
+               clock=None):
+    """
+    :param seed_ts: Optional seed timestamp in UTC epoch seconds, shared
+      by all schedules.  See IntervalSync.
+     :type ``int``
+    :param overrun_policy: One of IntervalScheduler.OVERRUN_POLICIES
+     :type ``str``
+    :param tolerance: Seconds that an interval can have passed, when
+      waiting for it starts, without counting as an overrun.
+     :type ``float``
+    :param clock: Optional clock.  Defaults to the NuoCA clock.
+    """
+    if overrun_policy not in self.OVERRUN_POLICIES:
+      raise AttributeError("Unknown SCHEDULE_OVERRUN_POLICY: %s" %
+                           overrun_policy)
+    self._seed_ts = seed_ts
+    self._overrun_policy = overrun_policy
+    self._tolerance = tolerance
+    self._clock = clock
+    self._heap = []
+    self._interval_syncs = {}
+    self._push_count = 0
+    self._last_lateness = 0.0
+    self._stats = {}
+    self._reset_stats()
+
+  def _reset_stats(self):
+    self._stats = {'skipped_intervals': 0,
+                   'caught_up_intervals': 0,
+                   'coalesced_intervals': 0}
+
+  @property
+  def last_lateness(self):
+    """
+    Seconds between the last interval and the wakeup for it.
+    """
+    return self._last_lateness
+
+  def get_stats(self, reset=True):
+    """
+    :param reset: Reset the counts.
+    :type reset: ``bool``
+    :return: Counts of skipped, caught up and coalesced intervals.
+    :type: ``dict``
+    """
+    stats = dict(self._stats)
+    if reset:
+      self._reset_stats()
+    return stats
+
+  def add(self, key, interval):
+    """
+    Add a schedule.
+
+    :param key: Identifies the schedule in wait_for_next_interval()
+    :param interval: time in seconds
+     :type ``int``
+    """
+    if key in self._interval_syncs:
+      raise AttributeError("Duplicate schedule: %s" % str(key))
+    interval_sync = IntervalSync(interval, self._seed_ts, self._clock)
+    self._interval_syncs[key] = interval_sync
+    self._push(interval_sync.next_timestamp(interval_sync.clock.time()), key)
+
+  def get_interval(self, key):
+    return self._interval_syncs[key].interval
+
+  def _push(self, interval_ts, key):
+    # The push count keeps heap entries with the same time in order.
+    self._push_count += 1
+    heapq.heappush(self._heap, (interval_ts, self._push_count, key))
+
+  def _apply_overrun_policy(self, now):
+    """
+    Reschedule the intervals that have already passed.
+    """
+    overdue = []
+    while self._heap and self._heap[0][0] < now - self._tolerance:
+      overdue.append(heapq.heappop(self._heap))
+    for interval_ts, _, key in overdue:
+      interval = self.get_interval(key)
+      passed_intervals = int(now - interval_ts) // interval + 1
+      if self._overrun_policy == self.SKIP:
+        self._stats['skipped_intervals'] += passed_intervals
+        interval_ts += passed_intervals * interval
+      elif self._overrun_policy == self.COALESCE:
+        self._stats['coalesced_intervals'] += passed_intervals - 1
+        interval_ts += (passed_intervals - 1) * interval
+      self._push(interval_ts, key)
+
+  def wait_for_next_interval(self):
+    """
+    Wait for the next interval of any schedule.
+
+    :return: (UTC timestamp of the interval, ``list`` of the keys of the
+      schedules that are due)
+    """
+    if not self._heap:
+      raise AttributeError("IntervalScheduler has no schedules")
+    clock = self._clock or nuoca_clock
+    now = clock.time()
+    self._apply_overrun_policy(now)
+    next_interval_ts = self._heap[0][0]
+    if next_interval_ts < now - self._tolerance:
+      self._stats['caught_up_intervals'] += 1
+    deadline = clock.monotonic() + (next_interval_ts - now)
+    sleep_until_monotonic(deadline, clock)
+    self._last_lateness = max(0.0, clock.monotonic() - deadline)
+    due = []
+    while self._heap and self._heap[0][0] <= next_interval_ts:
+      due.append(heapq.heappop(self._heap)[2])
+    for key in due:
+      self._push(next_interval_ts + self.get_interval(key), key)
+    return next_interval_ts, due
 
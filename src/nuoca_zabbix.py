@@ -0,0 +1,377 @@
+"""
+Native Zabbix agent client for NuoCA.
+
+ZabbixAgentClient fetches item values from a zabbix_agentd with passive
+checks, without running zabbix_get.  Each request is:
+
+  'ZBXD\\x01', data length (8 bytes, little endian), item key
+
+and the agent answers in the same format, then closes the connection.
+The agent serves one key per connection, so the client fetches many keys
+at once: up to max_connections non-blocking connections are open at the
+same time, multiplexed with select() in the calling thread.  Each key has
+its own timeout.
+
+ZabbixKeyCache keeps the state of each key, so that keys that are not
+supported and keys whose values do not change are not fetched in every
+collection.
+"""
+
+import errno
+import logging
+import select
+import socket
+import struct
+import threading
+
+from nuoca_util import nuoca_log, nuoca_monotonic
+
+ZBX_HEADER = 'ZBXD\x01'
+ZBX_NOTSUPPORTED = 'ZBX_NOTSUPPORTED'
+_DATA_LENGTH = struct.Struct('<Q')
+_CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def pack_request(data):
+  """
+  :param data: Item key, or response value.
+  :type data: ``str``
+
+  :return: The data with a ZBXD header.
+  :type: ``str``
+  """
+  return ZBX_HEADER + _DATA_LENGTH.pack(len(data)) + data
+
+
+def unpack_response(response):
+  """
+  :param response: Everything that the agent sent.
+  :type response: ``str``
+
+  :return: The value, or None if the response is incomplete.
+  :type: ``str``
+  """
+  if not response.startswith(ZBX_HEADER):
+    # Old agents answer without a header.
+    return response.rstrip('\n')
+  header_size = len(ZBX_HEADER) + _DATA_LENGTH.size
+  if len(response) < header_size:
+    return None
+  length = _DATA_LENGTH.unpack_from(response, len(ZBX_HEADER))[0]
+  if len(response) < header_size + length:
+    return None
+  return response[header_size:header_size + length]
+
+
+class _KeyRequest(object):
+  """
+  One key being fetched on its own connection.
+  """
+  def __init__(self, key, address, family, timeout):
+    self.key = key
+    self.deadline = nuoca_monotonic() + timeout
+    self.request = pack_request(key)
+    self.response = ''
+    self.sock = socket.socket(family, socket.SOCK_STREAM)
+    self.sock.setblocking(False)
+    self.connected = False
+    err = self.sock.connect_ex(address)
+    if err not in (0,) + _CONNECT_IN_PROGRESS:
+      self.sock.close()
+      raise socket.error(err, "Connect failed: %s" % errno.errorcode.get(
+          err, str(err)))
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def want_write(self):
+    return bool(self.request)
+
+  def handle_write(self):
+    if not self.connected:
+      err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if err:
+        raise socket.error(err, "Connect failed: %s" % errno.errorcode.get(
+            err, str(err)))
+      self.connected = True
+    sent = self.sock.send(self.request)
+    self.request = self.request[sent:]
+
+  def handle_read(self):
+    """
+    :return: True when the agent has closed the connection.
+    """
+    data = self.sock.recv(65536)
+    self.response += data
+    return not data
+
+  def close(self):
+    self.sock.close()
+
+
+class ZabbixAgentClient(object):
+  """
+  Fetches item values from one Zabbix agent.  Not thread safe.
+  """
+  def __init__(self, host='localhost', port=10050, max_connections=16,
+               timeout=3.0):
+    """
+    :param host: Host name or address of the agent.
+    :type host: ``str``
+
+    :param port: Port of the agent.
+    :type port: ``int``
+
+    :param max_connections: Maximum connections open at the same time.
+    :type max_connections: ``int``
+
+    :param timeout: Default seconds to wait for the value of each key.
+    :type timeout: ``float``
+    """
+    if max_connections < 1:
+      raise AttributeError("Zabbix maxConnections must be at least 1")
+    self._host = host
+    self._port = port
+    self._max_connections = max_connections
+    self._timeout = timeout
+    self._address = None
+    self._family = None
+
+  @property
+  def host(self):
+    return self._host
+
+  @property
+  def port(self):
+    return self._port
+
+  def _resolve(self):
+    # Resolved once, not for every key.
+    if self._address is None:
+      info = socket.getaddrinfo(self._host, self._port, 0,
+                                socket.SOCK_STREAM)[0]
+      self._family = info[0]
+      self._address = info[4]
+    return self._address
+
+  def get_value(self, key, timeout=None):
+    """
+    Fetch the value of one key.
+
+    :return: (value, error), see get_values()
+    """
+    values, errors = self.get_values([key], timeout)
+    return values.get(key), errors.get(key)
+
+  def get_values(self, keys, timeout=None):
+    """
+    Fetch the values of many keys concurrently.
+
+    :param keys: Zabbix item keys.
+    :type keys: ``list`` of ``str``
+
+    :param timeout: Seconds to wait for the value of each key.  Defaults
+      to the timeout of the client.
+    :type timeout: ``float``
+
+    :return: (values, errors).  values has the value of each key that the
+      agent answered, as a string.  A key that the agent does not support
+      has the value ZBX_NOTSUPPORTED.  errors has an error message for
+      each key that failed, and for each unsupported key.
+    :type: (``dict``, ``dict``)
+    """
+    if timeout is None:
+      timeout = self._timeout
+    values = {}
+    errors = {}
+    try:
+      address = self._resolve()
+    except socket.error as e:
+      message = "Cannot resolve Zabbix agent host %s: %s" % (self._host,
+                                                              str(e))
+      return values, dict([(key, message) for key in keys])
+    pending = list(keys)
+    pending.reverse()
+    running = []
+    try:
+      while pending or running:
+        while pending and len(running) < self._max_connections:
+          key = pending.pop()
+          try:
+            running.append(_KeyRequest(key, address, self._family, timeout))
+          except socket.error as e:
+            errors[key] = str(e)
+
+        if not running:
+          break
+        wait_time = max(0.0, min([x.deadline for x in running]) -
+                        nuoca_monotonic())
+        try:
+          readable, writable, _ = select.select(
+              running, [x for x in running if x.want_write()], [], wait_time)
+        except select.error as e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+
+        finished = set()
+        for request in writable:
+          try:
+            request.handle_write()
+          except socket.error as e:
+            errors[request.key] = str(e)
+            finished.add(request)
+        for request in readable:
+          if request in finished:
+            continue
+          try:
+            if not request.handle_read():
+              continue
+            value = unpack_response(request.response)
+            if value is None:
+              errors[request.key] = "Incomplete response from Zabbix agent"
+            elif value.startswith(ZBX_NOTSUPPORTED):
+              values[request.key] = ZBX_NOTSUPPORTED
+              errors[request.key] = value[len(ZBX_NOTSUPPORTED):].strip(
+                  '\0') or ZBX_NOTSUPPORTED
+            else:
+              values[request.key] = value
+          except socket.error as e:
+            errors[request.key] = str(e)
+          finished.add(request)
+
+        now = nuoca_monotonic()
+        for request in running:
+          if request not in finished and request.deadline <= now:
+            errors[request.key] = "Timed out after %s seconds" % str(timeout)
+            finished.add(request)
+        for request in finished:
+          request.close()
+        running = [x for x in running if x not in finished]
+    finally:
+      for request in running:
+        request.close()
+    if errors:
+      nuoca_log(logging.DEBUG, "Zabbix agent %s:%d errors: %s",
+                self._host, self._port, errors)
+    return values, errors
+
+
+class ZabbixKeyCache(object):
+  """
+  State of each Zabbix item key, to avoid needless queries.
+
+  - A key that the agent does not support, or that fails, is suspended
+    for suspend_interval seconds.  It is then due to be probed again.  A
+    key that fails together with every other key of the same fetch is not
+    suspended: the agent, not the key, is the problem.
+  - The value of a static key, such as system.uname, is fetched once and
+    then refreshed every static_refresh_interval seconds.
+
+  Thread safe, so that keys can be probed in a background thread.
+  """
+  DEFAULT_STATIC_KEYS = ('system.uname', 'system.hostname', 'system.sw.os',
+                         'system.sw.arch', 'system.boottime',
+                         'kernel.maxproc', 'kernel.maxfiles',
+                         'vm.memory.size[total]', 'system.cpu.num')
+
+  def __init__(self, suspend_interval=600.0, static_keys=DEFAULT_STATIC_KEYS,
+               static_refresh_interval=3600.0, clock=nuoca_monotonic):
+    """
+    :param suspend_interval: Seconds to suspend an unsupported or failing
+      key.
+    :type suspend_interval: ``float``
+
+    :param static_keys: Keys whose values rarely change.
+    :type static_keys: ``list`` of ``str``
+
+    :param static_refresh_interval: Seconds to reuse a static key value.
+    :type static_refresh_interval: ``float``
+
+    :param clock: Returns the current time in seconds.
+    :type clock: ``callable``
+    """
+    self._suspend_interval = suspend_interval
+    self._static_keys = set(static_keys)
+    self._static_refresh_interval = static_refresh_interval
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._suspended = {}  # Probe time by key
+    self._probing = set()
+    self._static_values = {}  # (fetch time, value) by key
+
+  def is_suspended(self, key):
+    with self._lock:
+      return key in self._suspended
+
+  def get_suspended_keys(self):
+    with self._lock:
+      return sorted(self._suspended)
+
+  def keys_to_fetch(self, keys):
+    """
+    :return: The keys that have to be fetched now: not suspended, and not
+      static with a recent value.
+    :type: ``list`` of ``str``
+    """
+    now = self._clock()
+    with self._lock:
+      return [x for x in keys if x not in self._suspended and
+              (x not in self._static_values or
+               now - self._static_values[x][0] >=
+               self._static_refresh_interval)]
+
+  def get_static_values(self, keys):
+    """
+    :return: The cached values of the static keys in keys.
+    :type: ``dict``
+    """
+    with self._lock:
+      return dict([(x, self._static_values[x][1]) for x in keys
+                   if x in self._static_values])
+
+  def keys_to_probe(self, keys):
+    """
+    :return: The suspended keys that are due to be probed.  They are not
+      returned again until update() is called with their results.
+    :type: ``list`` of ``str``
+    """
+    now = self._clock()
+    with self._lock:
+      due = [x for x in keys if x in self._suspended and
+             x not in self._probing and self._suspended[x] <= now]
+      self._probing.update(due)
+      return due
+
+  def update(self, keys, values, errors, probe=False):
+    """
+    Record the results of a fetch.
+
+    :param keys: The keys that were fetched.
+    :param values: Values by key, see ZabbixAgentClient.get_values().
+    :param errors: Errors by key, see ZabbixAgentClient.get_values().
+    :param probe: The keys were suspended keys that were probed.
+    :type probe: ``bool``
+    """
+    now = self._clock()
+    failed = [x for x in keys if values.get(x, ZBX_NOTSUPPORTED) ==
+              ZBX_NOTSUPPORTED]
+    agent_failed = not probe and len(failed) == len(keys) and \
+        not [x for x in failed if x in values]
+    with self._lock:
+      self._probing.difference_update(keys)
+      for key in keys:
+        if key in failed:
+          if agent_failed:
+            continue
+          if key not in self._suspended:
+            nuoca_log(logging.WARNING,
+                      "Zabbix key '%s' suspended for %s seconds: %s"
+                      % (key, str(self._suspend_interval), errors.get(key)))
+          self._suspended[key] = now + self._suspend_interval
+          continue
+        if key in self._suspended:
+          nuoca_log(logging.INFO, "Zabbix key '%s' is available again" % key)
+          del self._suspended[key]
+        if key in self._static_keys:
+          self._static_values[key] = (now, values[key])
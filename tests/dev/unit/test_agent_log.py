@@ -0,0 +1,240 @@
+from __future__ import print_function
+
+import gzip
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import nuoca_grok
+import nuoca_util
+from nuoca_logtail import LogTailer, MultilineCodec
+from plugins.input.NuoAdminAgentLogPlugin import NuoAdminAgentLogPlugin
+
+
+class TestGrok(unittest.TestCase):
+  def setUp(self):
+    self.library = nuoca_grok.GrokLibrary({
+        'PEER': r'Peer %{IPORHOST:addr}:%{POSINT:port}',
+        'NODE': r'\[Node (%{IPORHOST:addr}|%{PEER:peer})\]'})
+
+  def test_match(self):
+    pattern = self.library.compile(
+        '%{TIMESTAMP_ISO8601:timestamp} %{LOGLEVEL:loglevel} '
+        '%{GREEDYDATA:message}')
+    self.assertEqual(
+        [('timestamp', '2016-04-21T12:42:06.466+0000'),
+         ('loglevel', 'INFO'), ('message', 'two\nlines')],
+        pattern.match('2016-04-21T12:42:06.466+0000 INFO two\nlines'))
+    self.assertIsNone(pattern.match('no timestamp'))
+    self.assertIs(pattern, self.library.compile(pattern.pattern))
+
+  def test_repeated_field(self):
+    pattern = self.library.compile('%{NODE:node}')
+    self.assertEqual(['node', 'addr', 'peer', 'addr', 'port'],
+                     [x[0] for x in pattern.match('[Node localhost]')])
+    self.assertEqual(
+        ['[Node Peer 10.0.0.1:48004]', None, 'Peer 10.0.0.1:48004',
+         '10.0.0.1', '48004'],
+        [x[1] for x in pattern.match('[Node Peer 10.0.0.1:48004]')])
+
+  def test_undefined_pattern(self):
+    self.assertRaises(AttributeError, self.library.compile, '%{NO_SUCH}')
+
+  def test_filter(self):
+    grok = nuoca_grok.GrokFilter(self.library, ['^x=%{INT:x}( y=%{INT:y})?',
+                                                '%{NODE}'],
+                                 keep_empty_captures=True)
+    event = {'message': 'x=1'}
+    self.assertTrue(grok.apply(event))
+    self.assertEqual({'message': 'x=1', 'x': '1', 'y': None}, event)
+    self.assertTrue(grok.apply(event))
+    self.assertEqual(['1', '1'], event['x'])
+    event = {'message': 'other'}
+    self.assertFalse(grok.apply(event))
+    self.assertEqual([nuoca_grok.GROK_PARSE_FAILURE], event['tags'])
+
+    # Captures that did not participate are skipped.
+    grok = nuoca_grok.GrokFilter(self.library,
+                                 '%{NODE}: %{GREEDYDATA:message}',
+                                 overwrite=['message'])
+    event = {'message': '[Node Peer 10.0.0.1:48004]: up'}
+    self.assertTrue(grok.apply(event))
+    self.assertEqual({'message': 'up', 'peer': 'Peer 10.0.0.1:48004',
+                      'addr': '10.0.0.1', 'port': '48004'}, event)
+
+
+class TestLogTailer(unittest.TestCase):
+  def setUp(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'agent.log')
+    self.sincedb_path = os.path.join(self.dir, 'sincedb')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def _append(self, data, path=None):
+    with open(path or self.path, 'a') as log_file:
+      log_file.write(data)
+
+  def test_tail(self):
+    tailer = LogTailer(self.path, self.sincedb_path)
+    self.assertEqual([], tailer.read_lines())
+    self._append('one\n\ntw')
+    self.assertEqual(['one'], tailer.read_lines())
+    self._append('o\nthree\n')
+    self.assertEqual(['two', 'three'], tailer.read_lines())
+    self.assertEqual([], tailer.read_lines())
+    tailer.close()
+
+    # Restart from the position in the sincedb.
+    self._append('four\n')
+    tailer = LogTailer(self.path, self.sincedb_path)
+    self.assertEqual(['four'], tailer.read_lines())
+    tailer.close()
+    tailer = LogTailer(self.path, self.sincedb_path, start_position='end')
+    self.assertEqual([], tailer.read_lines())
+
+    # Truncated
+    with open(self.path, 'w') as log_file:
+      log_file.write('five\n')
+    self.assertEqual(['five'], tailer.read_lines())
+
+    # Rotated: the rest of the old file comes first.
+    self._append('six\n')
+    os.rename(self.path, self.path + '.1')
+    self._append('seven\n')
+    self.assertEqual(['six', 'seven'], tailer.read_lines())
+    self._append('eight\n')
+    self.assertEqual(['eight'], tailer.read_lines())
+    tailer.close()
+
+  def test_start_position_end(self):
+    self._append('old\n')
+    tailer = LogTailer(self.path, None, start_position='end')
+    self.assertEqual([], tailer.read_lines())
+    self._append('new\n')
+    self.assertEqual(['new'], tailer.read_lines())
+    tailer.close()
+
+
+class TestMultilineCodec(unittest.TestCase):
+  def runTest(self):
+    library = nuoca_grok.GrokLibrary()
+    codec = MultilineCodec(library.compile('%{TIMESTAMP_ISO8601} ').regex,
+                           auto_flush_interval=5)
+    self.assertEqual([('-----\nStarting', ['multiline'])], codec.decode(
+        ['-----', 'Starting', '2016-04-21T12:42:06.466+0000 INFO a'], 10))
+    self.assertEqual([('2016-04-21T12:42:06.466+0000 INFO a', [])],
+                     codec.decode(['2016-04-21T12:42:07.000+0000 INFO b',
+                                   'continued'], 11))
+    self.assertEqual([], codec.decode([], 15))
+    self.assertEqual(
+        [('2016-04-21T12:42:07.000+0000 INFO b\ncontinued', ['multiline'])],
+        codec.decode([], 16))
+    self.assertEqual([], codec.flush())
+
+
+class TestNuoAdminAgentLogPlugin(unittest.TestCase):
+  """
+  The plugin gives the events of the Logstash config
+  etc/logstash/nuoadminagentlog.conf.
+  """
+  def _compare(self, test_node_id):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    plugin = NuoAdminAgentLogPlugin(None)
+    config = {'logstashInputFilePath':
+                "%s/../test_data/%s.agent.log" % (dir_path, test_node_id),
+              'logstashSincedbPath': "/dev/null",
+              'nuocaCollectionName': 'NuoAdminAgentLog',
+              'pollInterval': 0.1}
+    self.assertTrue(plugin.startup(config))
+    # The last record is complete when the file is closed.
+    plugin.shutdown()
+    resp_values = plugin.collect(3)
+
+    expected_json_file = "%s/../test_data/%s.expected.json.gz" % \
+                         (dir_path, test_node_id)
+    expected_line_values = json.loads(gzip.open(expected_json_file).read())
+    if isinstance(expected_line_values, dict):
+      expected_line_values = expected_line_values['collected_values']
+    self.assertEqual(len(expected_line_values), len(resp_values))
+
+    local_hostname = socket.gethostname()
+    for expected_line, collected_line in zip(expected_line_values,
+                                             resp_values):
+      del expected_line['collect_timestamp']
+      del expected_line['@timestamp']
+      expected_line.pop('tags', None)
+      collected_line.pop('tags', None)
+      self.assertEqual(config['logstashInputFilePath'],
+                       collected_line['path'])
+      expected_line['path'] = collected_line['path']
+      expected_line['Hostname'] = local_hostname
+      expected_line['host'] = local_hostname
+      expected_line['nuoca_plugin'] = 'NuoAdminAgentLog'
+      for field in ['comment', 'message']:
+        if isinstance(expected_line.get(field), basestring):
+          expected_line[field] = expected_line[field].rstrip()
+      self.assertDictContainsSubset(expected_line, collected_line)
+
+  def runTest(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    self._compare("00f4e05b-403c-4f63-887e-c8331ef4087a.r0db0")
+    self._compare("06a32504-c2c9-41bc-9b48-030982c5ea43.r0db0")
+    self._compare("fa2461c7-bca2-4df5-91e3-251084e1b8d1.r0db2")
+
+
+class TestPluginModuleLoading(unittest.TestCase):
+  """
+  The plugin modules load the way Yapsy loads them in production: by
+  path, with only src and lib on the module path.
+  """
+  LOAD_SCRIPT = '''
+import imp
+import sys
+from nuoca_plugin import NuocaMPInputPlugin
+path = sys.argv[1]
+name = sys.argv[2]
+with open(path) as plugin_file:
+  module = imp.load_module(name, plugin_file, path,
+                           ("py", "r", imp.PY_SOURCE))
+# Yapsy takes the first input plugin class, in dir() order.
+for element in (getattr(module, x) for x in dir(module)):
+  try:
+    if issubclass(element, NuocaMPInputPlugin) and \\
+        element is not NuocaMPInputPlugin:
+      print(element.__name__)
+      break
+  except TypeError:
+    pass
+'''
+
+  def _load(self, module_name):
+    topdir = nuoca_util.get_nuoca_topdir()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(topdir, 'src'),
+                                         os.path.join(topdir, 'lib')])
+    work_dir = tempfile.mkdtemp()
+    try:
+      process = subprocess.Popen(
+          [sys.executable, '-c', self.LOAD_SCRIPT,
+           os.path.join(topdir, 'plugins', 'input', module_name + '.py'),
+           module_name],
+          cwd=work_dir, env=env, stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+      stdout, stderr = process.communicate()
+    finally:
+      shutil.rmtree(work_dir)
+    self.assertEqual(0, process.returncode, stderr)
+    return stdout.strip()
+
+  def runTest(self):
+    self.assertEqual('NuoAdminAgentLogPlugin',
+                     self._load('NuoAdminAgentLogPlugin'))
+    self.assertEqual('LogstashPlugin', self._load('LogstashPlugin'))
@@ -0,0 +1,103 @@
+from __future__ import print_function
+
+import cPickle
+import unittest
+
+from nuoca_batch import CollectedBatch, BatchEncoder, BatchDecoder, \
+    PrefixingBatchDecoder
+
+
+def _wide_rows(count):
+  return [dict([('Hostname', 'host1'), ('ProcessId', i)] +
+               [('Metric%02d' % x, x * i) for x in range(40)])
+          for i in range(count)]
+
+
+class TestBatchEncoding(unittest.TestCase):
+  def test_round_trip(self):
+    encoder = BatchEncoder()
+    decoder = BatchDecoder()
+    rows = [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}, {'c': 'x'}]
+    batch = encoder.encode(rows)
+    self.assertEqual(2, len(batch.schemas))
+    self.assertEqual(3, len(batch))
+    batch = cPickle.loads(cPickle.dumps(batch, cPickle.HIGHEST_PROTOCOL))
+    self.assertEqual(rows, decoder.decode(batch))
+
+    # Schemas are only sent once.
+    batch = encoder.encode(rows)
+    self.assertEqual({}, batch.schemas)
+    self.assertEqual(rows, decoder.decode(batch))
+
+  def test_reset(self):
+    encoder = BatchEncoder()
+    rows = [{'a': 1}]
+    encoder.encode(rows)
+    encoder.reset()
+    batch = encoder.encode(rows)
+    self.assertEqual(1, len(batch.schemas))
+    self.assertEqual(rows, BatchDecoder().decode(batch))
+
+  def test_unknown_schema(self):
+    decoder = BatchDecoder()
+    decoder.decode(CollectedBatch({0: ('a',)}, []))
+    decoded = decoder.decode(CollectedBatch({}, [(0, (1,)), (1, (2,))]))
+    self.assertEqual([{'a': 1}], decoded)
+    self.assertTrue(decoder.pop_schemas_missing())
+    self.assertFalse(decoder.pop_schemas_missing())
+
+  def test_resend_after_reset(self):
+    encoder = BatchEncoder()
+    decoder = BatchDecoder()
+    rows = [{'a': 1}]
+    encoder.encode(rows)  # Lost batch
+    self.assertEqual([], decoder.decode(encoder.encode(rows)))
+    self.assertTrue(decoder.pop_schemas_missing())
+    encoder.reset()
+    self.assertEqual(rows, decoder.decode(encoder.encode(rows)))
+    self.assertFalse(decoder.pop_schemas_missing())
+
+  def test_pickle_size(self):
+    encoder = BatchEncoder()
+    rows = _wide_rows(100)
+    encoder.encode(rows)
+    batch_size = len(cPickle.dumps(encoder.encode(rows),
+                                   cPickle.HIGHEST_PROTOCOL))
+    dict_size = len(cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL))
+    self.assertTrue(batch_size * 2 < dict_size)
+
+
+class TestPrefixingBatchDecoder(unittest.TestCase):
+  def test_prefix(self):
+    rows = [{'counter': 1, 'TimeStamp': 1500000000000.0},
+            {'nuocaCollectionName': 'Other', 'counter': 2}]
+    decoder = PrefixingBatchDecoder('Counter')
+    decoded = decoder.decode(BatchEncoder().encode(rows))
+    self.assertEqual([{'Counter.counter': 1,
+                       'Counter.TimeStamp': 1500000000000.0,
+                       'timestamp': 1500000000000},
+                      {'Other.counter': 2}], decoded)
+
+  def test_collection_name_per_row(self):
+    rows = [{'nuocaCollectionName': 'A', 'x': 1},
+            {'nuocaCollectionName': 'B', 'x': 2}]
+    encoder = BatchEncoder()
+    decoder = PrefixingBatchDecoder('Plugin')
+    for _ in range(2):
+      decoded = decoder.decode(encoder.encode(rows))
+      self.assertEqual([{'A.x': 1}, {'B.x': 2}], decoded)
+
+  def test_unknown_schema(self):
+    decoder = PrefixingBatchDecoder('P')
+    decoded = decoder.decode(CollectedBatch({0: ('x',)},
+                                            [(1, (1,)), (0, (2,))]))
+    self.assertEqual([{'P.x': 2}], decoded)
+    self.assertTrue(decoder.pop_schemas_missing())
+
+  def test_schema_redefined(self):
+    encoder = BatchEncoder()
+    decoder = PrefixingBatchDecoder('P')
+    decoder.decode(encoder.encode([{'x': 1}]))
+    encoder.reset()
+    decoded = decoder.decode(encoder.encode([{'y': 2}]))
+    self.assertEqual([{'P.y': 2}], decoded)
@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import nuoca_util
+
+from nuoca_dispatcher import OutputDispatcher
+
+
+class SlowStore(object):
+  """
+  Store function that records batches and can be held closed, like an
+  output plugin whose sink is not keeping up.
+  """
+  def __init__(self):
+    self.batches = []
+    self.gate = threading.Event()
+
+  def __call__(self, batch):
+    self.gate.wait()
+    self.batches.append(batch)
+
+
+class TestOutputDispatcher(unittest.TestCase):
+  def setUp(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    self._spill_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._spill_dir, ignore_errors=True)
+
+  def test_bad_policy(self):
+    with self.assertRaises(AttributeError):
+      OutputDispatcher(SlowStore(), 2, 'no-such-policy')
+    with self.assertRaises(AttributeError):
+      OutputDispatcher(SlowStore(), 2, OutputDispatcher.SPILL)
+
+  def test_block(self):
+    store = SlowStore()
+    store.gate.set()
+    dispatcher = OutputDispatcher(store, 2, OutputDispatcher.BLOCK)
+    dispatcher.start()
+    for i in range(10):
+      dispatcher.put([{'n': i}])
+    dispatcher.stop(5)
+    self.assertEqual([[{'n': i}] for i in range(10)], store.batches)
+    self.assertEqual(0, dispatcher.get_stats()['dropped_rows'])
+
+  def test_stop_timeout(self):
+    """
+    After the timeout, the queued cycles are not delivered, but the one
+    that is being delivered is waited for.
+    """
+    store = SlowStore()
+    dispatcher = OutputDispatcher(store, 5, OutputDispatcher.BLOCK)
+    dispatcher.start()
+    for i in range(3):
+      dispatcher.put([{'n': i}])
+    threading.Timer(0.5, store.gate.set).start()
+    start_time = time.time()
+    dispatcher.stop(0.1)
+    self.assertGreaterEqual(time.time() - start_time, 0.4)
+    self.assertEqual([[{'n': 0}]], store.batches)
+    self.assertEqual(2, dispatcher.queue_depth)
+
+  def test_drop_oldest(self):
+    store = SlowStore()
+    dispatcher = OutputDispatcher(store, 2, OutputDispatcher.DROP_OLDEST)
+    dispatcher.start()
+    # The first batch is taken by the dispatcher thread, which then
+    # blocks in the store function.
+    dispatcher.put([{'n': 0}])
+    time.sleep(0.2)
+    start = time.time()
+    for i in range(1, 6):
+      dispatcher.put([{'n': i}, {'n': i}])
+    self.assertLess(time.time() - start, 0.5)
+    stats = dispatcher.get_stats()
+    self.assertEqual(2, stats['queue_depth'])
+    self.assertEqual(3, stats['dropped_batches'])
+    self.assertEqual(6, stats['dropped_rows'])
+    store.gate.set()
+    dispatcher.stop(5)
+    self.assertEqual([0, 4, 5], [x[0]['n'] for x in store.batches])
+
+  def test_spill(self):
+    store = SlowStore()
+    dispatcher = OutputDispatcher(store, 2, OutputDispatcher.SPILL,
+                                  self._spill_dir)
+    dispatcher.start()
+    dispatcher.put([{'n': 0}])
+    time.sleep(0.2)
+    for i in range(1, 8):
+      dispatcher.put([{'n': i}])
+    stats = dispatcher.get_stats()
+    self.assertEqual(2, stats['queue_depth'])
+    self.assertEqual(5, stats['spill_depth'])
+    self.assertEqual(0, stats['dropped_rows'])
+    store.gate.set()
+    dispatcher.stop(5)
+    self.assertEqual(range(8), [x[0]['n'] for x in store.batches])
+    self.assertEqual(0, dispatcher.queue_depth)
@@ -0,0 +1,148 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import nuoca_util
+from plugins.input.HostMetricsPlugin import HostMetricsPlugin, \
+    CounterSamples
+
+_STAT = """cpu  %d 0 %d %d 0 0 0 0 0 0
+cpu0 1 0 1 1 0 0 0 0 0 0
+intr %d 1 2 3
+ctxt %d
+btime 1500000000
+processes 100
+"""
+
+_MEMINFO = """MemTotal:        1000 kB
+MemFree:          200 kB
+MemAvailable:     600 kB
+Buffers:           50 kB
+Cached:           150 kB
+SwapTotal:        100 kB
+SwapFree:         100 kB
+"""
+
+_DISKSTATS = "   8       0 %s %d 0 %d 0 %d 0 %d 0 0 %d 0\n"
+
+_NET_DEV = """Inter-|   Receive                            |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+%s
+"""
+_NET_LINE = "  %s: %d %d 0 0 0 0 0 0 %d %d 0 0 0 0 0 0"
+
+
+class TestCounterSamples(unittest.TestCase):
+  def runTest(self):
+    samples = CounterSamples(2)
+    self.assertEqual((None, {}), samples.update({'a': [1, 10]}, 100.0))
+    elapsed, deltas = samples.update({'a': [3, 30], 'b': [5, 5]}, 102.0)
+    self.assertEqual(2.0, elapsed)
+    self.assertEqual({'a': [2, 20]}, deltas)
+    # 'a' went away, 'b' kept its previous sample.
+    elapsed, deltas = samples.update({'b': [6, 9]}, 103.0)
+    self.assertEqual({'b': [1, 4]}, deltas)
+    self.assertEqual(['b'], samples.names)
+    # A counter that went backwards has no delta.
+    elapsed, deltas = samples.update({'b': [0, 10]}, 104.0)
+    self.assertEqual({}, deltas)
+
+
+class TestHostMetricsPlugin(unittest.TestCase):
+  def setUp(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    self.proc_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.proc_dir, 'net'))
+    self.mount_dir = tempfile.mkdtemp()
+    self._write('meminfo', _MEMINFO)
+    self._write('uptime', '1234.56 2000.00\n')
+    self._write('mounts', '/dev/sda1 / ext4 rw 0 0\n'
+                          'proc /proc proc rw 0 0\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.proc_dir)
+    shutil.rmtree(self.mount_dir)
+
+  def _write(self, name, data):
+    with open(os.path.join(self.proc_dir, name), 'w') as f:
+      f.write(data)
+
+  def _write_sample(self, n, disks=('sda', 'loop0'), interfaces=('eth0',)):
+    self._write('stat', _STAT % (10 * n, 5 * n, 100 + 5 * n, 1000 * n,
+                                 200 * n))
+    self._write('diskstats', ''.join(
+        [_DISKSTATS % (x, 10 * n, 80 * n, 20 * n, 160 * n, 100 * n)
+         for x in disks]))
+    self._write('net/dev', _NET_DEV % '\n'.join(
+        [_NET_LINE % (x, 1000 * n, 10 * n, 2000 * n, 20 * n)
+         for x in interfaces]))
+
+  def _collect(self, plugin):
+    # Rates need a measurable time between samples.
+    time.sleep(0.2)
+    return plugin.collect(10)[0]
+
+  def test_collect(self):
+    self._write_sample(0)
+    plugin = HostMetricsPlugin(None)
+    self.assertTrue(plugin.startup({'procDir': self.proc_dir}))
+    self._write_sample(1)
+    values = self._collect(plugin)
+    plugin.shutdown()
+
+    self.assertEqual(50.0, values['cpu.user'])
+    self.assertEqual(25.0, values['cpu.system'])
+    self.assertEqual(25.0, values['cpu.idle'])
+    self.assertGreater(values['cpu.intr'], values['cpu.switches'])
+    self.assertEqual(1500000000, values['system.boottime'])
+    self.assertEqual(1234, values['system.uptime'])
+    self.assertEqual(1000 * 1024, values['memory.total'])
+    self.assertEqual(400 * 1024, values['memory.used'])
+    self.assertEqual(100 * 1024, values['swap.free'])
+    # 10 reads of 80 sectors in about 0.2 seconds.
+    self.assertAlmostEqual(values['disk.sda.read_bytes'] /
+                           values['disk.sda.read_ops'], 80 * 512 / 10,
+                           delta=5)
+    self.assertIn('disk.sda.util', values)
+    self.assertNotIn('disk.loop0.read_ops', values)
+    self.assertAlmostEqual(values['net.eth0.in_bytes'] /
+                           values['net.eth0.in_packets'], 100, delta=1)
+    self.assertIn('net.eth0.out_errors', values)
+    self.assertIn('fs./.total', values)
+    self.assertNotIn('fs./proc.total', values)
+
+  def test_discovery(self):
+    self._write_sample(0)
+    plugin = HostMetricsPlugin(None)
+    self.assertTrue(plugin.startup({'procDir': self.proc_dir,
+                                    'discoveryInterval': 0}))
+    self._write_sample(1, disks=('sda', 'sdb'), interfaces=('eth1',))
+    self._write('mounts', '/dev/sda1 / ext4 rw 0 0\n'
+                          '/dev/sdb1 %s ext4 rw 0 0\n' % self.mount_dir)
+    values = self._collect(plugin)
+    self.assertIn('disk.sda.read_ops', values)
+    # New devices and interfaces have rates from their second sample on.
+    self.assertNotIn('disk.sdb.read_ops', values)
+    self.assertNotIn('net.eth0.in_bytes', values)
+    self.assertNotIn('net.eth1.in_bytes', values)
+    self.assertIn('fs.%s.free' % self.mount_dir, values)
+    self._write_sample(2, disks=('sda', 'sdb'), interfaces=('eth1',))
+    values = self._collect(plugin)
+    self.assertIn('disk.sdb.read_ops', values)
+    self.assertIn('net.eth1.in_bytes', values)
+
+  def test_live_proc(self):
+    plugin = HostMetricsPlugin(None)
+    self.assertTrue(plugin.startup({}))
+    values = self._collect(plugin)
+    self.assertIn('memory.total', values)
+    self.assertIn('system.uptime', values)
+    self.assertIn('cpu.idle', values)
+
+  def test_startup_failure(self):
+    plugin = HostMetricsPlugin(None)
+    self.assertFalse(plugin.startup({'procDir': self.mount_dir}))
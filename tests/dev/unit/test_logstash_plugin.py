@@ -0,0 +1,74 @@
+from __future__ import print_function
+
+import os
+import unittest
+
+import nuoca_util
+from nuoca_logstash import JsonLinesReader
+from plugins.input.LogstashPlugin import LogstashPlugin
+
+
+class TestLogstashCollectQueue(unittest.TestCase):
+  def runTest(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    plugin = LogstashPlugin(None)
+    plugin._logstash_collect_queue = plugin.new_collect_queue(
+        {'collectQueueMaxDepth': 3})
+    self.assertEqual([], plugin.collect(10))
+    for i in range(5):
+      plugin.logstash_collect_queue.put(
+          {'message': 'line %d' % i,
+           'timestamp': '2017-06-01T12:00:0%d.250Z' % i})
+    resp_values = plugin.collect(10)
+    self.assertEqual(['line 2', 'line 3', 'line 4'],
+                     [x['message'] for x in resp_values])
+    self.assertEqual(1496318402250, resp_values[0]['TimeStamp'])
+    # The queue counters are plugin metrics, not collected values.
+    self.assertNotIn('collect_queue_dropped', resp_values[0])
+    self.assertEqual({'counters': {'collect_queue_dropped': 2},
+                      'gauges': {'collect_queue_high_water_mark': 3}},
+                     plugin._pop_metrics())
+    self.assertEqual([], plugin.collect(10))
+    self.assertEqual({'counters': {'collect_queue_dropped': 0},
+                      'gauges': {'collect_queue_high_water_mark': 0}},
+                     plugin._pop_metrics())
+    self.assertIsNone(plugin._pop_metrics())
+    plugin.logstash_collect_queue.put({'message': 'line 5'})
+    resp_values = plugin.collect(10)
+    self.assertEqual(['line 5'], [x['message'] for x in resp_values])
+    self.assertEqual({'counters': {'collect_queue_dropped': 0},
+                      'gauges': {'collect_queue_high_water_mark': 1}},
+                     plugin._pop_metrics())
+
+
+class TestJsonLinesReader(unittest.TestCase):
+  def runTest(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    self.now = 100.0
+    read_fd, write_fd = os.pipe()
+    try:
+      reader = JsonLinesReader(read_fd, block_size=16, max_logged_messages=1,
+                               clock=lambda: self.now)
+      os.write(write_fd, '{"a": 1}\n[INFO ] Pipeline started\n{"a": 2}\n'
+                         '{"a": \n\n{"a": 3}\nSuccessfully started\n{"a"')
+      os.close(write_fd)
+      write_fd = None
+      objects = []
+      while True:
+        block_objects = reader.read()
+        if block_objects is None:
+          break
+        objects.extend(block_objects)
+    finally:
+      os.close(read_fd)
+      if write_fd is not None:
+        os.close(write_fd)
+    self.assertEqual([{'a': 1}, {'a': 2}, {'a': 3}], objects)
+    self.assertEqual(8, reader.total_lines)
+    self.now += 2
+    self.assertEqual({'logstash_lines_per_second': 4.0,
+                      'logstash_parse_failures': 2,
+                      'logstash_messages': 2}, reader.get_stats())
+    self.assertEqual({'logstash_lines_per_second': 0.0,
+                      'logstash_parse_failures': 0,
+                      'logstash_messages': 0}, reader.get_stats())
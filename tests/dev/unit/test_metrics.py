@@ -0,0 +1,135 @@
+from __future__ import print_function
+
+import os
+import unittest
+import logging
+
+import nuoca
+import nuoca_util
+from nuoca_metrics import Histogram, LatencyTracker, NuocaMetrics
+
+
+class TestHistogram(unittest.TestCase):
+  def test_percentiles(self):
+    histogram = Histogram()
+    self.assertEqual(0.0, histogram.percentile(99))
+    for _ in range(98):
+      histogram.observe(0.002)
+    histogram.observe(0.2)
+    histogram.observe(7.0)
+    self.assertEqual(100, histogram.count)
+    self.assertEqual(0.005, histogram.percentile(50))
+    self.assertEqual(0.5, histogram.percentile(99))
+    self.assertEqual(7.0, histogram.percentile(100))
+    values = histogram.get_values('t')
+    self.assertEqual(98, values['t.le_5ms'])
+    self.assertEqual(1, values['t.le_500ms'])
+    self.assertEqual(1, values['t.le_infms'])
+    self.assertEqual(7000.0, values['t.max_ms'])
+
+
+class TestNuocaMetrics(unittest.TestCase):
+  def test_get_values(self):
+    metrics = NuocaMetrics()
+    metrics.increment('rows', 5)
+    metrics.increment('rows')
+    metrics.set_gauge('depth', 3)
+    metrics.observe('latency', 0.02)
+    values = metrics.get_values('NuoCA')
+    self.assertEqual(6, values['NuoCA.rows'])
+    self.assertEqual(3, values['NuoCA.depth'])
+    self.assertEqual(1, values['NuoCA.latency.count'])
+    # The estimate is capped by the largest value.
+    self.assertEqual(20.0, values['NuoCA.latency.p50_ms'])
+
+    # Counters and histograms are reset, gauges are kept.
+    values = metrics.get_values('NuoCA')
+    self.assertEqual({'NuoCA.depth': 3}, values)
+
+
+class TestMetricsInput(unittest.TestCase):
+  def test_metrics_rows(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_metrics.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    stored = []
+    nuoca_obj._store_outputs = stored.append
+    try:
+      nuoca_obj.start()
+    finally:
+      nuoca_obj.shutdown(timeout=1)
+    self.assertEqual(3, len(stored))
+    for cycle in stored:
+      metrics_rows = [x for x in cycle
+                      if x.get('NuoCA.nuoca_plugin') == 'NuoCA']
+      self.assertEqual(1, len(metrics_rows))
+      metrics_row = metrics_rows[0]
+      self.assertEqual(1, metrics_row['NuoCA.rows'])
+      self.assertEqual(1, metrics_row['NuoCA.plugin.Counter.rows'])
+      # The first cycle also has the startup response.
+      self.assertTrue(
+          metrics_row['NuoCA.plugin.Counter.response_time.count'] >= 1)
+      self.assertTrue(metrics_row['NuoCA.plugin.Counter.recv_bytes'] > 0)
+      self.assertTrue('timestamp' in metrics_row)
+    # The store time of the first cycle is reported in a later cycle.
+    self.assertTrue('NuoCA.store_time.count' in stored[2][-1])
+
+  def test_plugin_metrics(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_metrics.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    a_plugin = type('Plugin', (object,), {'name': 'Logstash'})()
+    resp_values = {'collected_batch': None,
+                   'plugin_metrics': {
+                       'counters': {'collect_queue_dropped': 2},
+                       'gauges': {'collect_queue_high_water_mark': 7}}}
+    nuoca_obj._record_plugin_metrics(a_plugin, resp_values)
+    nuoca_obj._record_plugin_metrics(a_plugin, resp_values)
+    nuoca_obj._record_plugin_metrics(a_plugin, {'collected_batch': None})
+    self.assertEqual(
+        {'NuoCA.plugin.Logstash.collect_queue_dropped': 4,
+         'NuoCA.plugin.Logstash.collect_queue_high_water_mark': 7},
+        nuoca_obj.metrics.get_values('NuoCA'))
+
+
+class TestLatencyTracker(unittest.TestCase):
+  def test_timeouts(self):
+    tracker = LatencyTracker(floor=0.5, ceiling=5.0)
+    # The ceiling is used until there are enough samples.
+    self.assertEqual(5.0, tracker.get_timeout('Counter', 'collect'))
+    for _ in range(LatencyTracker.MIN_SAMPLES):
+      tracker.observe('Counter', 'collect', 0.001)
+      tracker.observe('Printer', 'store', 0.5)
+    self.assertEqual(0.5, tracker.get_timeout('Counter', 'collect'))
+    store_timeout = tracker.get_timeout('Printer', 'store')
+    self.assertTrue(1.5 <= store_timeout < 5.0, store_timeout)
+    self.assertEqual(5.0, tracker.get_timeout('Printer', 'collect'))
+    self.assertEqual({('Counter', 'collect'): 0.5,
+                      ('Printer', 'store'): store_timeout},
+                     tracker.get_timeouts())
+
+    # A slow outlier raises the timeout through the 99th percentile.
+    tracker.observe('Counter', 'collect', 1.0)
+    self.assertAlmostEqual(3.0, tracker.get_timeout('Counter', 'collect'),
+                           delta=0.1)
+
+    tracker.reset('Counter', 'collect')
+    self.assertEqual(5.0, tracker.get_timeout('Counter', 'collect'))
+
+  def test_bad_bounds(self):
+    self.assertRaises(AttributeError, LatencyTracker, 0, 5)
+    self.assertRaises(AttributeError, LatencyTracker, 5, 1)
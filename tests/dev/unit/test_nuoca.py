@@ -1,10 +1,67 @@
 from __future__ import print_function
 
 import os
+import tempfile
+import threading
+import time
 import unittest
 import logging
+import multiprocessing
 import nuoca_util
 import nuoca
+from nuoca_batch import BatchEncoder
+from nuoca_dispatcher import OutputDispatcher
+from nuoca_supervisor import PluginSupervisor
+
+
+class FakePluginObject(object):
+  def __init__(self, child_pipe):
+    self.child_pipe = child_pipe
+
+
+class FakePlugin(object):
+  """
+  Stands in for a Yapsy PluginInfo whose plugin process is the other end
+  of a pipe that is driven by the test.
+  """
+  def __init__(self, name):
+    self.name = name
+    self.category = 'Input'
+    self.parent_end, child_end = multiprocessing.Pipe()
+    self.plugin_object = FakePluginObject(child_end)
+
+  def respond_after(self, delay, response):
+    def _respond():
+      time.sleep(delay)
+      self.parent_end.send(response)
+    thrd = threading.Thread(target=_respond)
+    thrd.daemon = True
+    thrd.start()
+    return thrd
+
+
+class FakeManager(object):
+  def __init__(self, plugins=None):
+    self.plugins = plugins or []
+    self.deactivated = []
+
+  def deactivatePluginByName(self, name, category):
+    self.deactivated.append(name)
+
+  def getAllPlugins(self):
+    return self.plugins
+
+  def getPluginsOfCategory(self, category):
+    return [x for x in self.plugins if x.category == category]
+
+
+class FakeProcPlugin(object):
+  def __init__(self, name, run_time):
+    self.name = name
+    self.plugin_object = FakePluginObject(None)
+    self.plugin_object.proc = multiprocessing.Process(target=time.sleep,
+                                                      args=(run_time,))
+    self.plugin_object.proc.start()
 
 
 class TestNuoCA(unittest.TestCase):
@@ -35,6 +92,242 @@ class TestNuoCA(unittest.TestCase):
     nuoca_obj.start()
     nuoca_obj.shutdown(timeout=0)
 
+  def test_concurrent_plugin_responses(self):
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "empty.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.config.PLUGIN_PIPE_TIMEOUT = 1.0
+    slow = FakePlugin('Slow')
+    fast = FakePlugin('Fast')
+    hung = FakePlugin('Hung')
+    slow.respond_after(0.6, {'status_code': 0, 'resp_values': {'n': 1}})
+    fast.respond_after(0.1, {'status_code': 0, 'resp_values': {'n': 2}})
+    start = time.time()
+    responses = nuoca_obj._get_plugin_responses([slow, hung, fast])
+    elapsed = time.time() - start
+    # Responses arrive in arrival order and the hung plugin only costs
+    # its own budget, not an extra budget on top of the others.
+    self.assertEqual(['Fast', 'Slow'], [x[0].name for x in responses])
+    self.assertLess(elapsed, 1.5)
+
+    # A cycle-wide deadline cuts every plugin budget short.
+    slow.respond_after(0.6, {'status_code': 0, 'resp_values': {'n': 3}})
+    deadline = nuoca_util.nuoca_monotonic() + 0.3
+    responses = nuoca_obj._get_plugin_responses([slow], deadline)
+    self.assertEqual([], responses)
+    time.sleep(0.5)
+    nuoca_obj._discard_stale_responses(slow)
+    self.assertFalse(slow.plugin_object.child_pipe.poll(0))
+    nuoca_obj.shutdown(timeout=0)
+
+  def test_adaptive_timeout_config(self):
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "empty.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    slow = FakePlugin('Slow')
+    # Off by default.
+    self.assertEqual(5, nuoca_obj._plugin_timeout(slow, 'collect'))
+    nuoca_obj.shutdown(timeout=0)
+
+    config_file = tempfile.NamedTemporaryFile(suffix='.yml')
+    config_file.write("PLUGIN_ADAPTIVE_TIMEOUT: true\n"
+                      "PLUGIN_MAX_TIMEOUT: 30\n")
+    config_file.flush()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=config_file.name,
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    # A plugin may be given more than PLUGIN_PIPE_TIMEOUT.
+    self.assertEqual(30, nuoca_obj._plugin_timeout(slow, 'collect'))
+    self.assertEqual(5, nuoca_obj._plugin_timeout(slow))
+    nuoca_obj.shutdown(timeout=0)
+    config_file.close()
+
+  def test_late_response_schemas(self):
+    """
+    A collect response that arrives after its timeout is discarded, but
+    the schemas in it are still needed to decode later batches.
+    """
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "empty.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.config.COLLECTION_CYCLE_TIMEOUT = 0.3
+    late = FakePlugin('Late')
+    nuoca_obj._get_activated_input_plugins = lambda: [late]
+    encoder = BatchEncoder()
+    late.respond_after(0.6, {'status_code': 0, 'resp_values': {
+        'collected_batch': encoder.encode([{'counter': 1}])}})
+    self.assertEqual([], nuoca_obj._collect_inputs())
+    time.sleep(0.5)
+    late.respond_after(0.1, {'status_code': 0, 'resp_values': {
+        'collected_batch': encoder.encode([{'counter': 2}])}})
+    rows = nuoca_obj._collect_inputs()
+    self.assertEqual([2], [x['Late.counter'] for x in rows])
+    nuoca_obj.shutdown(timeout=0)
+
+  def test_output_plugin_restart_schemas(self):
+    """
+    A restarted output plugin is sent all of the schemas again.
+    """
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "empty.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.manager = FakeManager()
+    output = FakePlugin('Output')
+    output.category = 'Output'
+    nuoca_obj._get_activated_output_plugins = lambda: [output]
+    schemas = []
+    for restart in (False, False, True):
+      if restart:
+        output.respond_after(0, {'status_code': 0})
+        nuoca_obj._startup_plugins([(output, {})])
+        self.assertEqual('startup', output.parent_end.recv()['action'])
+      output.respond_after(0, {'status_code': 0})
+      nuoca_obj._store_outputs([{'counter': 1}])
+      schemas.append(output.parent_end.recv()['ts_batch'].schemas)
+    self.assertEqual([{0: ('counter',)}, {}, {0: ('counter',)}], schemas)
+    nuoca_obj.manager = None
+    nuoca_obj.shutdown(timeout=0)
+
+  def test_missing_schemas(self):
+    """
+    A plugin, or NuoCA, that is missing some schemas asks the other end to
+    send them all again.
+    """
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "empty.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.manager = FakeManager()
+    source = FakePlugin('Source')
+    nuoca_obj._get_activated_input_plugins = lambda: [source]
+    encoder = BatchEncoder()
+    encoder.encode([{'counter': 1}])  # Lost batch
+    requests = []
+    for _ in range(2):
+      source.respond_after(0.1, {'status_code': 0, 'resp_values': {
+          'collected_batch': encoder.encode([{'counter': 2}])}})
+      nuoca_obj._collect_inputs()
+      requests.append(source.parent_end.recv())
+    self.assertEqual([None, True],
+                     [x.get('reset_schemas') for x in requests])
+
+    output = FakePlugin('Output')
+    output.category = 'Output'
+    nuoca_obj._get_activated_output_plugins = lambda: [output]
+    schemas = []
+    for resp_values in ({'reset_schemas': True}, None, None):
+      output.respond_after(0, {'status_code': 0, 'resp_values': resp_values})
+      nuoca_obj._store_outputs([{'counter': 1}])
+      schemas.append(output.parent_end.recv()['ts_batch'].schemas)
+    self.assertEqual([{0: ('counter',)}, {0: ('counter',)}, {}], schemas)
+    nuoca_obj.manager = None
+    nuoca_obj.shutdown(timeout=0)
+
+  def test_output_plugin_restart_on_dispatcher(self):
+    """
+    Output plugins are restarted on the dispatcher thread, which waits on
+    their pipes, not on the collection thread.
+    """
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "empty.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.manager = FakeManager()
+    nuoca_obj._supervisor = PluginSupervisor(initial_backoff=0)
+    output = FakePlugin('Output')
+    output.category = 'Output'
+    output.is_activated = True
+    nuoca_obj._output_plugins['Output'] = (output, {})
+    restarted = []
+    nuoca_obj._restart_plugin = lambda a_plugin, config: restarted.append(
+        (a_plugin.name, threading.current_thread().name))
+    nuoca_obj._supervisor.quarantine('Output', 'test')
+    nuoca_obj._supervise_plugins()
+    self.assertEqual([], restarted)
+    nuoca_obj.dispatcher.start()
+    try:
+      nuoca_obj.dispatcher.put([{'counter': 1}])
+      for _ in range(100):
+        if restarted:
+          break
+        time.sleep(0.01)
+    finally:
+      nuoca_obj._output_plugins.clear()
+      nuoca_obj.manager = None
+      nuoca_obj.shutdown(timeout=1)
+    self.assertEqual([('Output', 'nuoca-output-dispatcher')], restarted)
+
+  def test_concurrent_startup(self):
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "empty.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.manager = FakeManager()
+    plugins = [FakePlugin('One'), FakePlugin('Two'), FakePlugin('Bad')]
+    for a_plugin in plugins:
+      status_code = int(a_plugin.name == 'Bad')
+      a_plugin.respond_after(0.5, {'status_code': status_code})
+    start = time.time()
+    started = nuoca_obj._startup_plugins([(x, {}) for x in plugins])
+    elapsed = time.time() - start
+    self.assertEqual(set(['One', 'Two']), started)
+    self.assertEqual(['Bad'], nuoca_obj.manager.deactivated)
+    self.assertLess(elapsed, 1.2)
+    self.assertEqual('startup', plugins[2].parent_end.recv()['action'])
+    self.assertEqual('shutdown', plugins[2].parent_end.recv()['action'])
+    nuoca_obj.manager = None
+    nuoca_obj.shutdown(timeout=0)
+
+  def test_kill_all_plugin_processes(self):
+    manager = FakeManager([FakeProcPlugin('Quick%d' % x, 0.3)
+                           for x in range(4)])
+    manager.plugins.append(FakeProcPlugin('Hung', 60))
+    start = time.time()
+    nuoca.NuoCA.kill_all_plugin_processes(manager, timeout=1)
+    elapsed = time.time() - start
+    self.assertLess(elapsed, 2.5)
+    for a_plugin in manager.plugins:
+      self.assertFalse(a_plugin.plugin_object.proc.is_alive())
+    self.assertEqual(0, manager.plugins[0].plugin_object.proc.exitcode)
+    self.assertNotEqual(0, manager.plugins[-1].plugin_object.proc.exitcode)
+
   def test_counter_printer(self):
     """
     Test using the mpCounterPlugin and mpPrinterPlugin
@@ -51,3 +344,81 @@ class TestNuoCA(unittest.TestCase):
     nuoca_obj.config.SELFTEST_LOOP_COUNT = 2
     nuoca_obj.start()
     nuoca_obj.shutdown(timeout=1)
+
+  def test_plugin_collection_interval(self):
+    """
+    Collect Counter every second and NuoCA's own metrics every 2 seconds.
+    """
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "counter_intervals.yml"),
+        collection_interval=2,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    stored = []
+    nuoca_obj._store_outputs = stored.extend
+    try:
+      nuoca_obj.start()
+    finally:
+      nuoca_obj.shutdown(timeout=1)
+    counter_rows = [x for x in stored if 'Counter.counter' in x]
+    metrics_rows = [x for x in stored if 'NuoCA.nuoca_plugin' in x]
+    self.assertEqual(2, len(metrics_rows))
+    self.assertTrue(len(counter_rows) >= 3)
+    self.assertEqual(range(1, len(counter_rows) + 1),
+                     [x['Counter.counter'] for x in counter_rows])
+    self.assertEqual(1, counter_rows[0]['collection_interval'])
+    self.assertEqual(2, metrics_rows[0]['collection_interval'])
+    for metrics_row in metrics_rows:
+      self.assertEqual(0, metrics_row['timestamp'] % 2000)
+
+  def test_max_speed(self):
+    """
+    Run the self test with 30 second intervals on a virtual clock.
+    """
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "counter.yml"),
+        collection_interval=30,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None,
+        max_speed=True
+    )
+    # No collection cycle is dropped.
+    self.assertEqual(OutputDispatcher.BLOCK,
+                     nuoca_obj.dispatcher._overflow_policy)
+    stored = []
+    nuoca_obj._store_outputs = stored.extend
+    start_time = time.time()
+    try:
+      nuoca_obj.start()
+    finally:
+      nuoca_obj.shutdown(timeout=1)
+    self.assertLess(time.time() - start_time, 10)
+    self.assertFalse(isinstance(nuoca_util.get_nuoca_clock(),
+                                nuoca_util.VirtualClock))
+    self.assertEqual(nuoca_obj.config.SELFTEST_LOOP_COUNT, len(stored))
+    self.assertEqual(range(1, len(stored) + 1),
+                     [x['Counter.counter'] for x in stored])
+    timestamps = [x['timestamp'] for x in stored]
+    self.assertEqual(range(timestamps[0], timestamps[-1] + 1, 30000),
+                     timestamps)
+    # The plugin process follows the virtual clock.
+    self.assertEqual(timestamps, [x['Counter.collect_timestamp']
+                                  for x in stored])
+
+  def test_bad_plugin_collection_interval(self):
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(self._config_dir, "counter.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=self._plugin_dir,
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.config.INPUT_PLUGINS[0].values()[0][
+        'nuocaCollectionInterval'] = 'often'
+    self.assertRaises(AttributeError, nuoca_obj._get_input_intervals)
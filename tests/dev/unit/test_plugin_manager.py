@@ -0,0 +1,140 @@
+from __future__ import print_function
+
+import os
+import threading
+import unittest
+import logging
+
+import nuoca
+import nuoca_util
+from nuoca_plugin_manager import InProcessPipe, ThreadPluginProxy
+
+
+class TestInProcessPipe(unittest.TestCase):
+  def test_send_recv(self):
+    parent_end, child_end = InProcessPipe.pair()
+    try:
+      self.assertFalse(parent_end.poll())
+      message = {'action': 'collect', 'values': [1, 2, 3]}
+      parent_end.send(message)
+      self.assertTrue(child_end.poll(1))
+      received = child_end.recv()
+      # Messages are passed by reference, not copied.
+      self.assertTrue(received is message)
+      self.assertFalse(child_end.poll())
+
+      child_end.send('one')
+      child_end.send('two')
+      ready = nuoca_util.wait_for_pipes([parent_end], 1)
+      self.assertEqual([parent_end], ready)
+      self.assertEqual('one', parent_end.recv())
+      self.assertEqual('two', parent_end.recv())
+    finally:
+      parent_end.close()
+      child_end.close()
+
+  def test_closed(self):
+    parent_end, child_end = InProcessPipe.pair()
+    parent_end.close()
+    parent_end.close()
+    self.assertRaises(IOError, parent_end.send, 'hello')
+    self.assertRaises(EOFError, parent_end.recv)
+    # The other end sees the end of the channel.
+    self.assertRaises(EOFError, child_end.recv)
+    child_end.close()
+
+  def test_recv_from_thread(self):
+    parent_end, child_end = InProcessPipe.pair()
+    try:
+      def echo():
+        child_end.send(child_end.recv())
+      echo_thread = threading.Thread(target=echo)
+      echo_thread.start()
+      parent_end.send('hello')
+      self.assertTrue(parent_end.poll(5))
+      self.assertEqual('hello', parent_end.recv())
+      echo_thread.join(5)
+    finally:
+      parent_end.close()
+      child_end.close()
+
+
+class TestThreadHostedPlugins(unittest.TestCase):
+  def test_counter_printer_threads(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_thread.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    stored = []
+    store_outputs = nuoca_obj._store_outputs
+    def store_and_save(collected_inputs):
+      stored.append(collected_inputs)
+      return store_outputs(collected_inputs)
+    nuoca_obj._store_outputs = store_and_save
+    try:
+      nuoca_obj.start()
+      for plugin_name, category in (('Counter', 'Input'),
+                                    ('Printer', 'Output')):
+        plugin_info = nuoca_obj.manager.getPluginByName(plugin_name,
+                                                        category)
+        self.assertTrue(isinstance(plugin_info.plugin_object,
+                                   ThreadPluginProxy))
+        self.assertTrue(plugin_info.plugin_object.proc.is_alive())
+    finally:
+      nuoca_obj.shutdown(timeout=1)
+    rows = [x[0] for x in stored]
+    self.assertEqual(3, len(rows))
+    self.assertEqual([2, 4, 6], [x['Counter.counter'] for x in rows])
+    for plugin_info in nuoca_obj.manager.getAllPlugins():
+      self.assertFalse(plugin_info.plugin_object.proc.is_alive())
+
+  def test_respawn_closes_pipes(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_thread.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.config.SELFTEST_LOOP_COUNT = 1
+    nuoca_obj._store_outputs = lambda collected_inputs: None
+    try:
+      nuoca_obj.start()
+      plugin_info = nuoca_obj.manager.getPluginByName('Counter', 'Input')
+      old_proxy = plugin_info.plugin_object
+      old_plugin_pipe = old_proxy.proc.plugin.parent_pipe
+      nuoca_obj.manager.respawn_plugin(plugin_info)
+      self.assertTrue(old_proxy.child_pipe._closed)
+      self.assertTrue(old_plugin_pipe._closed)
+      # The old thread sees the end of its pipe and exits.
+      old_proxy.proc.join(5)
+      self.assertFalse(old_proxy.proc.is_alive())
+      self.assertTrue(nuoca_obj._startup_plugin(
+          plugin_info, nuoca_obj._input_plugins['Counter'][1]))
+      rows = nuoca_obj._collect_inputs()
+      self.assertEqual(1, len(rows))
+    finally:
+      nuoca_obj.shutdown(timeout=1)
+
+  def test_bad_plugin_host(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_thread.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.config.INPUT_PLUGINS[0]['Counter']['nuocaPluginHost'] = 'fiber'
+    self.assertRaises(AttributeError, nuoca_obj._create_plugin_manager)
@@ -4,6 +4,7 @@ import os
 import unittest
 import nuoca_util
 from nuoca import NuoCA
+from nuoca_batch import BatchEncoder
 from yapsy.MultiprocessPluginManager import MultiprocessPluginManager
 from nuoca_plugin import NuocaMPInputPlugin, NuocaMPOutputPlugin, \
     NuocaMPTransformPlugin
@@ -19,6 +20,7 @@ class TestOutputPlugins(unittest.TestCase):
     startup_rval = printer_plugin.startup(None)
     self.assertTrue(startup_rval)
     printer_plugin.store({'message': 'hello'})
+    printer_plugin.store_batch([{'message': 'hello'}, {'message': 'world'}])
 
   def _MultiprocessPluginManagerTest(self):
     child_pipe_timeout = 600
@@ -57,6 +59,24 @@ class TestOutputPlugins(unittest.TestCase):
     self.assertTrue('status_code' in plugin_resp_msg)
     self.assertEqual(0, plugin_resp_msg['status_code'])
 
+    store_data = [{'foo': 1, 'bar': 2}, {'foo': 3, 'bar': 4}]
+    plugin_msg = {'action': "store_batch", 'ts_values': store_data}
+    plugin_resp_msg = None
+    printer_plugin.plugin_object.child_pipe.send(plugin_msg)
+    if printer_plugin.plugin_object.child_pipe.poll(child_pipe_timeout):
+      plugin_resp_msg = printer_plugin.plugin_object.child_pipe.recv()
+    self.assertIsNotNone(plugin_resp_msg)
+    self.assertEqual(0, plugin_resp_msg['status_code'])
+
+    plugin_msg = {'action': "store_batch",
+                  'ts_batch': BatchEncoder().encode(store_data)}
+    plugin_resp_msg = None
+    printer_plugin.plugin_object.child_pipe.send(plugin_msg)
+    if printer_plugin.plugin_object.child_pipe.poll(child_pipe_timeout):
+      plugin_resp_msg = printer_plugin.plugin_object.child_pipe.recv()
+    self.assertIsNotNone(plugin_resp_msg)
+    self.assertEqual(0, plugin_resp_msg['status_code'])
+
     plugin_msg = {'action': "exit"}
     plugin_resp_msg = None
     printer_plugin.plugin_object.child_pipe.send(plugin_msg)
@@ -0,0 +1,128 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+import unittest
+import logging
+
+import nuoca
+import nuoca_util
+from nuoca_shm import ShmRing, ShmPipe
+
+
+def _echo_child(child_pipe):
+  while True:
+    message = child_pipe.recv()
+    if message == 'exit':
+      break
+    child_pipe.send(message)
+
+
+class TestShmRing(unittest.TestCase):
+  def test_wrap_around(self):
+    ring = ShmRing(100)
+    try:
+      for i in range(20):
+        data = chr(ord('a') + i) * 30
+        position = ring.write(data)
+        self.assertTrue(position is not None)
+        self.assertEqual(data, ring.read(position, len(data)))
+    finally:
+      ring.close()
+
+  def test_full(self):
+    ring = ShmRing(100)
+    try:
+      first = ring.write('x' * 60)
+      self.assertEqual(0, first)
+      self.assertEqual(None, ring.write('y' * 60))
+      self.assertEqual(None, ring.write('z' * 101))
+      ring.read(first, 60)
+      self.assertEqual(100, ring.write('y' * 60))
+    finally:
+      ring.close()
+
+
+class TestShmPipe(unittest.TestCase):
+  def test_child_process(self):
+    parent_pipe, child_pipe = ShmPipe.pair(1024 * 1024, min_shm_bytes=1024)
+    child = multiprocessing.Process(target=_echo_child, args=(child_pipe,))
+    child.start()
+    try:
+      small = {'action': 'collect', 'collection_interval': 5}
+      large = {'ts_values': [{'key%d' % i: i} for i in range(1000)]}
+      for message in (small, large, large, small):
+        parent_pipe.send(message)
+        self.assertTrue(parent_pipe.poll(5))
+        self.assertEqual(message, parent_pipe.recv())
+      self.assertEqual(2, parent_pipe.shm_messages)
+      self.assertEqual(2, parent_pipe.pipe_messages)
+      parent_pipe.send('exit')
+    finally:
+      child.join(5)
+      if child.is_alive():
+        child.terminate()
+
+  def test_pipe_fallback(self):
+    parent_pipe, child_pipe = ShmPipe.pair(1024, min_shm_bytes=16)
+    large = [str(i) * 100 for i in range(100)]
+    parent_pipe.send(large)
+    self.assertEqual(large, child_pipe.recv())
+    self.assertEqual(0, parent_pipe.shm_messages)
+    self.assertEqual(1, parent_pipe.pipe_messages)
+
+
+class TestShmTransport(unittest.TestCase):
+  def test_counter_printer_shm(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_shm.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    stored = []
+    nuoca_obj._store_outputs = stored.append
+    try:
+      nuoca_obj.start()
+      plugin_info = nuoca_obj.manager.getPluginByName('Counter', 'Input')
+      self.assertTrue(isinstance(plugin_info.plugin_object.child_pipe,
+                                 ShmPipe))
+    finally:
+      nuoca_obj.shutdown(timeout=1)
+    rows = [x[0] for x in stored]
+    self.assertEqual([3, 6, 9], [x['Counter.counter'] for x in rows])
+
+  def test_respawn_closes_rings(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_shm.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj.config.SELFTEST_LOOP_COUNT = 1
+    nuoca_obj._store_outputs = lambda collected_inputs: None
+    try:
+      nuoca_obj.start()
+      plugin_info = nuoca_obj.manager.getPluginByName('Counter', 'Input')
+      old_pipe = plugin_info.plugin_object.child_pipe
+      old_plugin_pipe = plugin_info.plugin_object.proc.parent_pipe
+      new_proxy = nuoca_obj.manager.respawn_plugin(plugin_info)
+      self.assertTrue(old_pipe._send_ring.closed)
+      self.assertTrue(old_pipe._recv_ring.closed)
+      self.assertTrue(old_pipe._connection.closed)
+      self.assertTrue(old_plugin_pipe._connection.closed)
+      self.assertFalse(new_proxy.child_pipe._send_ring.closed)
+      self.assertTrue(nuoca_obj._startup_plugin(
+          plugin_info, nuoca_obj._input_plugins['Counter'][1]))
+      rows = nuoca_obj._collect_inputs()
+      self.assertEqual([3], [x['Counter.counter'] for x in rows])
+    finally:
+      nuoca_obj.shutdown(timeout=1)
@@ -0,0 +1,288 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from nuoca_plugin import NuocaMPOutputPlugin
+from nuoca_spool import PartialStoreError, Spool, SpoolDrainer
+import plugins.output.ElasticSearchPlugin as elasticsearch_plugin
+
+
+class FlakyOutputPlugin(NuocaMPOutputPlugin):
+  """
+  Output plugin whose sink can be taken down.
+  """
+  def __init__(self):
+    super(FlakyOutputPlugin, self).__init__(None, 'Flaky')
+    self.sink_up = True
+    self.stored = []
+    self.stored_event = threading.Event()
+    self.storing_event = threading.Event()
+    self.release_event = None
+
+  def store_batch(self, ts_values):
+    if not self.sink_up:
+      raise IOError("Connection refused")
+    self.storing_event.set()
+    if self.release_event:
+      self.release_event.wait()
+    self.stored.append(ts_values)
+    self.stored_event.set()
+
+
+class RowOutputPlugin(NuocaMPOutputPlugin):
+  """
+  Output plugin that stores one row at a time, and fails on some rows.
+  """
+  def __init__(self):
+    super(RowOutputPlugin, self).__init__(None, 'Row')
+    self.failing = set()
+    self.stored = []
+
+  def store(self, ts_values):
+    if ts_values['counter'] in self.failing:
+      raise IOError("Connection refused")
+    self.stored.append(ts_values['counter'])
+
+
+class TestSpool(unittest.TestCase):
+  def setUp(self):
+    self.spool_dir = tempfile.mkdtemp(prefix='nuoca_spool_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.spool_dir)
+
+  def test_append_peek_ack(self):
+    spool = Spool(self.spool_dir, max_bytes=4096, segment_bytes=1024)
+    self.assertEqual(None, spool.peek())
+    for index in range(20):
+      spool.append([{'counter': index, 'text': 'x' * 100}])
+    self.assertEqual(20, len(spool))
+    self.assertTrue(len(os.listdir(self.spool_dir)) > 2)
+    for index in range(20):
+      self.assertEqual(index, spool.peek()[0]['counter'])
+      # peek() without ack() returns the same record.
+      self.assertEqual(index, spool.peek()[0]['counter'])
+      spool.ack()
+    self.assertEqual(0, len(spool))
+    self.assertEqual(None, spool.peek())
+    spool.close()
+
+  def test_recover(self):
+    spool = Spool(self.spool_dir, max_bytes=4096, segment_bytes=1024)
+    for index in range(10):
+      spool.append(index)
+    for _ in range(3):
+      spool.peek()
+      spool.ack()
+    spool.close()
+
+    spool = Spool(self.spool_dir, max_bytes=4096, segment_bytes=1024)
+    self.assertEqual(7, len(spool))
+    spool.append(10)
+    values = []
+    while spool.peek() is not None:
+      values.append(spool.peek())
+      spool.ack()
+    self.assertEqual(range(3, 11), values)
+    spool.close()
+
+  def test_corrupt_record(self):
+    spool = Spool(self.spool_dir, max_bytes=4096, segment_bytes=1024)
+    for index in range(3):
+      spool.append('value%d' % index)
+    spool.close()
+    segment_path = os.path.join(self.spool_dir, sorted(
+        os.listdir(self.spool_dir))[0])
+    with open(segment_path, 'r+b') as segment_file:
+      data = segment_file.read()
+      segment_file.seek(data.index('value1'))
+      segment_file.write('VALUE1')
+
+    spool = Spool(self.spool_dir, max_bytes=4096, segment_bytes=1024)
+    self.assertEqual(2, len(spool))
+    values = []
+    while spool.peek() is not None:
+      values.append(spool.peek())
+      spool.ack()
+    self.assertEqual(['value0', 'value2'], values)
+    spool.close()
+
+  def test_eviction(self):
+    spool = Spool(self.spool_dir, max_bytes=2048, segment_bytes=1024)
+    for index in range(30):
+      spool.append('x' * 200 + str(index))
+    self.assertTrue(spool.evicted_records > 0)
+    self.assertEqual(30, len(spool) + spool.evicted_records)
+    self.assertTrue(spool.peek().endswith(str(spool.evicted_records)))
+    # A record larger than a segment gets a segment of its own.
+    spool.append('y' * 1500)
+    self.assertEqual(31, len(spool) + spool.evicted_records)
+    spool.close()
+
+  def test_bad_sizes(self):
+    self.assertRaises(AttributeError, Spool, self.spool_dir, 1024, 4096)
+
+
+class TestSpooledOutputPlugin(unittest.TestCase):
+  def setUp(self):
+    self.spool_dir = tempfile.mkdtemp(prefix='nuoca_spool_test')
+
+  def tearDown(self):
+    shutil.rmtree(self.spool_dir)
+
+  def test_spool_during_outage(self):
+    plugin = FlakyOutputPlugin()
+    self.assertTrue(plugin._open_spool(
+        {'nuocaSpool': {'drainRate': 100},
+         'nuoca_spool_dir': self.spool_dir}))
+    try:
+      plugin._store_batch_or_spool([{'counter': 1}])
+      plugin.sink_up = False
+      plugin._store_batch_or_spool([{'counter': 2}])
+      plugin.sink_up = True
+      # Stored after the spooled values, to keep them in order.
+      plugin._store_batch_or_spool([{'counter': 3}])
+      for _ in range(50):
+        if len(plugin.stored) == 3:
+          break
+        plugin.stored_event.wait(0.1)
+        plugin.stored_event.clear()
+      self.assertEqual([[{'counter': 1}], [{'counter': 2}], [{'counter': 3}]],
+                       plugin.stored)
+    finally:
+      plugin._close_spool()
+
+  def test_slow_replay(self):
+    """
+    Values can be spooled while a replay is still being stored.
+    """
+    plugin = FlakyOutputPlugin()
+    self.assertTrue(plugin._open_spool(
+        {'nuocaSpool': {'drainRate': 100},
+         'nuoca_spool_dir': self.spool_dir}))
+    try:
+      plugin.sink_up = False
+      plugin._store_batch_or_spool([{'counter': 1}])
+      plugin.release_event = threading.Event()
+      plugin.sink_up = True
+      self.assertTrue(plugin.storing_event.wait(5))
+      start = time.time()
+      plugin._store_batch_or_spool([{'counter': 2}])
+      self.assertLess(time.time() - start, 0.5)
+      plugin.release_event.set()
+      for _ in range(50):
+        if len(plugin.stored) == 2:
+          break
+        plugin.stored_event.wait(0.1)
+        plugin.stored_event.clear()
+      self.assertEqual([[{'counter': 1}], [{'counter': 2}]], plugin.stored)
+    finally:
+      plugin._close_spool()
+
+  def test_drainer_retry(self):
+    spool = Spool(self.spool_dir, max_bytes=4096, segment_bytes=1024)
+    stored = []
+    failures = []
+    def store_func(value):
+      if len(failures) < 2:
+        failures.append(value)
+        raise IOError("Connection refused")
+      stored.append(value)
+    drainer = SpoolDrainer(spool, store_func, threading.Lock(),
+                           drain_rate=100, retry_interval=0.01)
+    spool.append('one')
+    spool.append('two')
+    drainer.start()
+    try:
+      for _ in range(100):
+        if len(stored) == 2:
+          break
+        threading.Event().wait(0.05)
+      self.assertEqual(['one', 'one'], failures)
+      self.assertEqual(['one', 'two'], stored)
+      self.assertEqual(0, len(spool))
+    finally:
+      drainer.stop()
+      spool.close()
+
+  def test_partial_store(self):
+    """
+    Only the rows that were not stored are spooled and replayed.
+    """
+    plugin = RowOutputPlugin()
+    self.assertTrue(plugin._open_spool(
+        {'nuocaSpool': {'drainRate': 100},
+         'nuoca_spool_dir': self.spool_dir}))
+    plugin.failing = set([2, 4])
+    try:
+      plugin._store_batch_or_spool([{'counter': x} for x in (1, 2, 3, 4)])
+    finally:
+      plugin._close_spool()
+    # The rows after a failed row are still stored.
+    self.assertEqual([1, 3], plugin.stored)
+
+    spool = Spool(self.spool_dir)
+    self.assertEqual([{'counter': 2}, {'counter': 4}], spool.peek())
+    plugin.failing = set([4])
+    plugin._spool = spool
+    drainer = SpoolDrainer(spool, plugin.store_batch, threading.Lock(),
+                           drain_rate=100, retry_interval=0.01)
+    drainer.start()
+    try:
+      for _ in range(100):
+        if plugin.stored == [1, 3, 2]:
+          plugin.failing = set()
+        if not len(spool):
+          break
+        threading.Event().wait(0.05)
+      self.assertEqual([1, 3, 2, 4], plugin.stored)
+    finally:
+      drainer.stop()
+      spool.close()
+      plugin._spool = None
+
+  def test_store_without_spool(self):
+    """
+    Without a spool, the rows that cannot be stored are logged and the
+    rest are stored.
+    """
+    plugin = RowOutputPlugin()
+    plugin.failing = set([2])
+    self.assertFalse(plugin.spooling)
+    plugin._store_batch_or_spool([{'counter': x} for x in (1, 2, 3)])
+    self.assertEqual([1, 3], plugin.stored)
+
+  def test_elasticsearch_partial_store(self):
+    """
+    Documents that ElasticSearch rejected for now, or that were not sent,
+    are not stored.  Documents that it cannot index are dropped.
+    """
+    def streaming_bulk(client, actions, raise_on_error):
+      self.assertFalse(raise_on_error)
+      yield True, {'index': {'status': 201}}
+      yield False, {'index': {'status': 429, 'error': 'rejected'}}
+      yield False, {'index': {'status': 400, 'error': 'mapper_parsing'}}
+      raise IOError("Connection refused")
+
+    plugin = elasticsearch_plugin.ElasticSearchPlugin(None)
+    plugin._config = {'INDEX': 'nuoca'}
+    ts_values = [{'counter': x} for x in range(5)]
+    real_streaming_bulk = elasticsearch_plugin.helpers.streaming_bulk
+    elasticsearch_plugin.helpers.streaming_bulk = streaming_bulk
+    try:
+      # Without a spool the errors are only logged.
+      plugin.store_batch(ts_values)
+      self.assertTrue(plugin._open_spool(
+          {'nuocaSpool': True, 'nuoca_spool_dir': self.spool_dir}))
+      plugin.store_batch(ts_values)
+      self.fail("PartialStoreError was not raised")
+    except PartialStoreError as e:
+      self.assertEqual([ts_values[x] for x in (1, 3, 4)], e.unstored)
+    finally:
+      plugin._close_spool()
+      elasticsearch_plugin.helpers.streaming_bulk = real_streaming_bulk
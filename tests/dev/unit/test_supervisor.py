@@ -0,0 +1,103 @@
+from __future__ import print_function
+
+import os
+import unittest
+import logging
+
+import nuoca
+import nuoca_util
+from nuoca_supervisor import PluginSupervisor
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestPluginSupervisor(unittest.TestCase):
+  def test_quarantine_after_max_failures(self):
+    clock = FakeClock()
+    supervisor = PluginSupervisor(max_failures=3, initial_backoff=1.0,
+                                  max_backoff=4.0, clock=clock)
+    self.assertFalse(supervisor.record_failure('Counter', 'timeout'))
+    self.assertFalse(supervisor.record_failure('Counter', 'timeout'))
+    # A response resets the count of consecutive failures.
+    supervisor.record_success('Counter')
+    self.assertFalse(supervisor.record_failure('Counter', 'timeout'))
+    self.assertFalse(supervisor.record_failure('Counter', 'timeout'))
+    self.assertFalse(supervisor.is_quarantined('Counter'))
+    self.assertTrue(supervisor.record_failure('Counter', 'timeout'))
+    self.assertTrue(supervisor.is_quarantined('Counter'))
+    # Already quarantined.
+    self.assertFalse(supervisor.record_failure('Counter', 'timeout'))
+    self.assertFalse(supervisor.is_quarantined('Printer'))
+
+    self.assertEqual([], supervisor.get_plugins_to_restart())
+    clock.now += 1.0
+    self.assertEqual(['Counter'], supervisor.get_plugins_to_restart())
+    supervisor.restart_succeeded('Counter')
+    self.assertFalse(supervisor.is_quarantined('Counter'))
+    self.assertEqual({'Counter': {'quarantined': 0, 'quarantines': 1,
+                                  'restarts': 1}},
+                     supervisor.get_stats())
+
+  def test_backoff(self):
+    clock = FakeClock()
+    supervisor = PluginSupervisor(max_failures=1, initial_backoff=1.0,
+                                  max_backoff=4.0, clock=clock)
+    for expected_backoff in [1.0, 2.0, 4.0, 4.0]:
+      supervisor.quarantine('Counter', 'exited')
+      clock.now += expected_backoff - 0.5
+      self.assertEqual([], supervisor.get_plugins_to_restart())
+      clock.now += 0.5
+      self.assertEqual(['Counter'], supervisor.get_plugins_to_restart())
+      supervisor.restart_succeeded('Counter')
+
+    # Enough responses in a row reset the backoff.
+    for _ in range(PluginSupervisor.HEALTHY_RESPONSES):
+      supervisor.record_success('Counter')
+    supervisor.quarantine('Counter', 'exited')
+    clock.now += 1.0
+    self.assertEqual(['Counter'], supervisor.get_plugins_to_restart())
+
+  def test_bad_max_failures(self):
+    self.assertRaises(AttributeError, PluginSupervisor, 0)
+
+
+class TestPluginRestart(unittest.TestCase):
+  def test_restart_exited_plugin(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    nuoca_obj._supervisor = PluginSupervisor(initial_backoff=0)
+    try:
+      nuoca_obj._create_plugin_manager()
+      nuoca_obj._activate_configured_plugins()
+      self.assertEqual(1, len(nuoca_obj._collect_inputs()))
+      counter = nuoca_obj.manager.getPluginByName('Counter', 'Input')
+      old_proc = counter.plugin_object.proc
+      old_proc.terminate()
+      old_proc.join(5)
+
+      nuoca_obj._supervise_plugins()
+      self.assertFalse(nuoca_obj.supervisor.is_quarantined('Counter'))
+      self.assertFalse(counter.plugin_object.proc is old_proc)
+      self.assertTrue(counter.plugin_object.proc.is_alive())
+      stats = nuoca_obj.supervisor.get_stats()['Counter']
+      self.assertEqual(1, stats['quarantines'])
+      self.assertEqual(1, stats['restarts'])
+      # The new process starts counting from the beginning.
+      collected_inputs = nuoca_obj._collect_inputs()
+      self.assertEqual(1, collected_inputs[0]['Counter.counter'])
+    finally:
+      nuoca_obj.shutdown(timeout=1)
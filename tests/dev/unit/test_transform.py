@@ -0,0 +1,92 @@
+from __future__ import print_function
+
+import os
+import unittest
+import logging
+import nuoca_util
+import nuoca
+
+from nuoca_transform import RateTransform, DeltaTransform, ScaleTransform, \
+    RenameTransform
+
+
+class TestTransforms(unittest.TestCase):
+  def setUp(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+
+  def test_rate(self):
+    rate = RateTransform()
+    self.assertFalse(rate.startup({}))
+    self.assertTrue(rate.startup({'keys': ['commits'],
+                                  'seriesKeys': ['host']}))
+    rows = rate.transform([{'timestamp': 1000, 'host': 'a', 'commits': 10},
+                           {'timestamp': 1000, 'host': 'b', 'commits': 0}])
+    self.assertFalse('commits_rate' in rows[0])
+    rows = rate.transform([{'timestamp': 3000, 'host': 'a', 'commits': 30},
+                           {'timestamp': 3000, 'host': 'b', 'commits': 5}])
+    self.assertEqual(10.0, rows[0]['commits_rate'])
+    self.assertEqual(2.5, rows[1]['commits_rate'])
+    # A counter that goes backwards was reset.
+    rows = rate.transform([{'timestamp': 5000, 'host': 'a', 'commits': 2}])
+    self.assertFalse('commits_rate' in rows[0])
+    rows = rate.transform([{'timestamp': 6000, 'host': 'a', 'commits': 4}])
+    self.assertEqual(2.0, rows[0]['commits_rate'])
+
+  def test_ambiguous_series(self):
+    # Without seriesKeys, the rows of two hosts are the same series.
+    rate = RateTransform()
+    self.assertTrue(rate.startup({'keys': ['commits']}))
+    for ts in (1000, 2000, 3000):
+      rows = rate.transform([{'timestamp': ts, 'host': 'a', 'commits': ts},
+                             {'timestamp': ts, 'host': 'b', 'commits': 5},
+                             {'timestamp': ts, 'other': 1}])
+      self.assertEqual([False, False],
+                       ['commits_rate' in x for x in rows[:2]])
+    # One row per cycle is a series again.
+    rate.transform([{'timestamp': 4000, 'commits': 10}])
+    rows = rate.transform([{'timestamp': 5000, 'commits': 12}])
+    self.assertEqual(2.0, rows[0]['commits_rate'])
+
+  def test_delta(self):
+    delta = DeltaTransform()
+    self.assertTrue(delta.startup({'keyPattern': '^mem', 'suffix': '.d'}))
+    delta.transform([{'timestamp': 1000, 'mem.used': 100, 'other': 1}])
+    rows = delta.transform([{'timestamp': 2000, 'mem.used': 60, 'other': 9}])
+    self.assertEqual(-40, rows[0]['mem.used.d'])
+    self.assertFalse('other.d' in rows[0])
+
+  def test_scale_and_rename(self):
+    scale = ScaleTransform()
+    self.assertFalse(scale.startup({'keys': ['bytes']}))
+    self.assertTrue(scale.startup({'keys': ['bytes'], 'factor': 0.001}))
+    rows = scale.transform([{'bytes': 2000, 'name': 'x'}])
+    self.assertEqual(2.0, rows[0]['bytes'])
+    rename = RenameTransform()
+    self.assertTrue(rename.startup({'fields': {'bytes': 'kbytes'}}))
+    rows = rename.transform(rows)
+    self.assertEqual({'kbytes': 2.0, 'name': 'x'}, rows[0])
+
+
+class TestTransformChain(unittest.TestCase):
+  def test_counter_rate(self):
+    topdir = nuoca_util.get_nuoca_topdir()
+    nuoca_obj = nuoca.NuoCA(
+        config_file=os.path.join(topdir, "tests", "dev", "configs",
+                                 "counter_rate.yml"),
+        collection_interval=1,
+        log_level=logging.ERROR,
+        plugin_dir=os.path.join(topdir, "plugins"),
+        self_test=True,
+        starttime=None
+    )
+    stored = []
+    nuoca_obj._store_outputs = stored.append
+    try:
+      nuoca_obj.start()
+    finally:
+      nuoca_obj.shutdown(timeout=1)
+    rows = [x[0] for x in stored]
+    self.assertEqual(3, len(rows))
+    self.assertFalse('Counter.counter_rate' in rows[0])
+    self.assertEqual(5.0, rows[1]['Counter.counter_rate'])
+    self.assertEqual(5, rows[2]['Counter.counter_delta'])
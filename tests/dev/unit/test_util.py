@@ -1,10 +1,16 @@
 from __future__ import print_function
 
+import calendar
 import datetime
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import unittest
+import nuoca_command
 import nuoca_util
 import logging
 import socket
@@ -40,6 +46,50 @@ class TestUtilLogging(unittest.TestCase):
     nuoca_util.nuoca_logging_shutdown()
 
 
+class CountingArg(object):
+  def __init__(self):
+    self.count = 0
+
+  def __str__(self):
+    self.count += 1
+    return 'counted'
+
+
+def log_from_child(message):
+  nuoca_util.nuoca_log(logging.INFO, "child: %s", message)
+
+
+class TestUtilAsyncLogging(unittest.TestCase):
+  def test_log_writer(self):
+    logfile_name = "/tmp/nuoca.async_test.log"
+    if os.path.exists(logfile_name):
+      os.remove(logfile_name)
+    nuoca_util.initialize_logger(logfile_name, flush_interval=60,
+                                 flush_records=1000)
+    nuoca_util.nuoca_set_log_level(logging.INFO)
+    try:
+      debug_arg = CountingArg()
+      nuoca_util.nuoca_log(logging.DEBUG, "debug: %s", debug_arg)
+      self.assertEqual(0, debug_arg.count)
+      nuoca_util.nuoca_log(logging.INFO, "parent: %s", 'hello')
+      self.assertEqual("parent: hello",
+                       nuoca_util.nuoca_get_last_log_message())
+      child = multiprocessing.Process(target=log_from_child,
+                                      args=('world',))
+      child.start()
+      child.join(5)
+      # Nothing is written until the flush interval or the shutdown.
+      with open(logfile_name) as logfile:
+        self.assertEqual('', logfile.read())
+    finally:
+      nuoca_util.nuoca_logging_shutdown()
+    with open(logfile_name) as logfile:
+      lines = logfile.read().splitlines()
+    self.assertEqual(2, len(lines))
+    self.assertTrue(lines[0].endswith("NuoCA INFO parent: hello"), lines)
+    self.assertTrue(lines[1].endswith("NuoCA INFO child: world"), lines)
+
+
 class TestUtilParseOptions(unittest.TestCase):
   def test_none_returns_empty_dict(self):
     # suppress PEP-8 warning in pycharm - deliberate wrong type for test
@@ -122,6 +172,70 @@ class TestProcessRunning(unittest.TestCase):
     self.assertFalse(p2_status)
 
 
+class TestProcessIndex(unittest.TestCase):
+  def setUp(self):
+    self.proc_dir = tempfile.mkdtemp()
+    self._add_process(1, 'init', ['/sbin/init', 'splash'])
+    self._add_process(42, 'nuodb', ['/opt/nuodb/bin/nuodb', '--database',
+                                    'db1'])
+    self._add_process(43, 'nuodb', ['/opt/nuodb/bin/nuodb', '--database',
+                                    'db2'])
+    os.mkdir(os.path.join(self.proc_dir, 'self'))
+
+  def tearDown(self):
+    shutil.rmtree(self.proc_dir)
+
+  def _add_process(self, pid, comm, args):
+    pid_dir = os.path.join(self.proc_dir, str(pid))
+    os.mkdir(pid_dir)
+    with open(os.path.join(pid_dir, 'comm'), 'w') as f:
+      f.write(comm + '\n')
+    with open(os.path.join(pid_dir, 'cmdline'), 'w') as f:
+      f.write('\0'.join(args) + '\0')
+    with open(os.path.join(pid_dir, 'stat'), 'w') as f:
+      f.write('%d (%s) S 1 %d %d 0 -1 4194560 100 0 2 0 250 50 0 0 20 0 '
+              '7 0 1000 123456789 2048 18446744073709551615 1 1 0 0 0 0 '
+              '0 0 0 0 0 0 17 3 0 0 0 0 0\n' % (pid, comm, pid, pid))
+
+  def test_find_pids(self):
+    index = nuoca_util.ProcessIndex(proc_dir=self.proc_dir)
+    self.assertEqual([42, 43], index.find_pids('nuo'))
+    self.assertEqual([], index.find_pids('nuo', match='exact'))
+    self.assertEqual([42, 43], index.find_pids('nuodb', match='exact'))
+    self.assertEqual([1], index.find_pids('^i.*t$', match='regex'))
+    self.assertEqual([43], index.find_pids('--database db2',
+                                           field='cmdline'))
+    self.assertEqual('/sbin/init splash', index.get_processes()[1].cmdline)
+    with self.assertRaises(AttributeError):
+      index.find_pids('nuodb', match='glob')
+
+  def test_ttl(self):
+    index = nuoca_util.ProcessIndex(ttl=60, proc_dir=self.proc_dir)
+    self.assertEqual([], index.find_pids('zabbix_agentd'))
+    self._add_process(50, 'zabbix_agentd', ['zabbix_agentd'])
+    self.assertEqual([], index.find_pids('zabbix_agentd'))
+    index.refresh()
+    self.assertEqual([50], index.find_pids('zabbix_agentd'))
+
+  def test_read_stat(self):
+    index = nuoca_util.ProcessIndex(proc_dir=self.proc_dir)
+    stat = index.read_stat(42)
+    self.assertEqual('S', stat['state'])
+    self.assertEqual(1, stat['ppid'])
+    self.assertEqual(250, stat['utime'])
+    self.assertEqual(50, stat['stime'])
+    self.assertEqual(7, stat['num_threads'])
+    self.assertEqual(123456789, stat['vsize'])
+    self.assertEqual(2048, stat['rss'])
+    self.assertEqual(3, stat['processor'])
+    self.assertIsNone(index.read_stat(99))
+
+  def test_live_proc(self):
+    index = nuoca_util.ProcessIndex()
+    self.assertIn(os.getpid(), index.find_pids('python'))
+    self.assertEqual(os.getppid(), index.read_stat(os.getpid())['ppid'])
+
+
 class TestExecuteCommand(unittest.TestCase):
   def runTest(self):
     (ec, stdout, stderr) = nuoca_util.execute_command('hostname')
@@ -135,6 +249,132 @@ class TestExecuteCommand(unittest.TestCase):
     self.assertTrue('no-such-command: not found' in stderr)
 
 
+class TestGetCommandExecutor(unittest.TestCase):
+  def runTest(self):
+    # Threads that run their first command together share one executor.
+    created = []
+
+    class SlowExecutor(object):
+      def __init__(self, max_workers, default_timeout):
+        time.sleep(0.1)
+        created.append(self)
+
+    executors = []
+
+    def get_executor():
+      executors.append(nuoca_util.get_command_executor())
+
+    real_executor_class = nuoca_command.CommandExecutor
+    saved_executor = (nuoca_util._command_executor,
+                      nuoca_util._command_executor_pid)
+    nuoca_command.CommandExecutor = SlowExecutor
+    nuoca_util._command_executor_pid = None
+    try:
+      threads = [threading.Thread(target=get_executor) for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join(5)
+    finally:
+      nuoca_command.CommandExecutor = real_executor_class
+      nuoca_util._command_executor, nuoca_util._command_executor_pid = \
+          saved_executor
+    self.assertEqual(1, len(created))
+    self.assertEqual(created * 4, executors)
+
+
+class TestCommandExecutor(unittest.TestCase):
+  def setUp(self):
+    self.executor = nuoca_command.CommandExecutor(max_workers=4)
+
+  def tearDown(self):
+    self.executor.close()
+
+  def test_worker_reuse(self):
+    # $$ in the command's subshell is the pid of the shell worker.
+    (ec1, pid1, _) = self.executor.execute('echo $$')
+    (ec2, pid2, _) = self.executor.execute('echo $$')
+    self.assertEqual(0, ec1)
+    self.assertEqual(pid1, pid2)
+
+  def test_shell_state_isolation(self):
+    self.executor.execute('cd /tmp; NUOCA_TEST_VAR=1; export NUOCA_TEST_VAR')
+    (ec, stdout, _) = self.executor.execute('echo "$NUOCA_TEST_VAR"; pwd')
+    self.assertEqual(0, ec)
+    self.assertEqual('\n%s\n' % os.getcwd(), stdout)
+
+  def test_exit_code_and_stderr(self):
+    (ec, stdout, stderr) = self.executor.execute(
+        'echo out; echo err >&2; exit 3')
+    self.assertEqual((3, 'out\n', 'err\n'), (ec, stdout, stderr))
+
+  def test_concurrent(self):
+    start = time.time()
+    results = self.executor.execute_all(
+        ['sleep 1; echo %d' % x for x in range(4)])
+    self.assertLess(time.time() - start, 1.9)
+    self.assertEqual([(0, '%d\n' % x, '') for x in range(4)], results)
+
+  def test_timeout(self):
+    start = time.time()
+    results = self.executor.execute_all(['echo partial; sleep 10',
+                                         'echo done'], timeout=0.5)
+    self.assertLess(time.time() - start, 5)
+    self.assertEqual(nuoca_command.TIMEOUT_EXIT_CODE, results[0][0])
+    self.assertEqual('partial\n', results[0][1])
+    self.assertEqual((0, 'done\n', ''), results[1])
+    # The worker that timed out is replaced.
+    self.assertEqual((0, 'again\n', ''),
+                     self.executor.execute('echo again'))
+
+  def test_concurrent_callers(self):
+    # A slow command from one thread does not delay the other threads.
+    slow_thread = threading.Thread(target=self.executor.execute,
+                                   args=('sleep 2',))
+    slow_thread.start()
+    time.sleep(0.2)
+    start = time.time()
+    self.assertEqual((0, 'fast\n', ''), self.executor.execute('echo fast'))
+    self.assertLess(time.time() - start, 1)
+    slow_thread.join()
+
+  def test_max_workers(self):
+    executor = nuoca_command.CommandExecutor(max_workers=1)
+    try:
+      slow_thread = threading.Thread(target=executor.execute,
+                                     args=('sleep 1',))
+      slow_thread.start()
+      time.sleep(0.2)
+      start = time.time()
+      self.assertEqual((0, 'next\n', ''), executor.execute('echo next'))
+      self.assertGreater(time.time() - start, 0.5)
+      slow_thread.join()
+    finally:
+      executor.close()
+
+  def test_default_timeout(self):
+    executor = nuoca_command.CommandExecutor(max_workers=1,
+                                             default_timeout=0.5)
+    try:
+      # The shell waits for the end of the quoted string.
+      (ec, _, _) = executor.execute('echo "unbalanced')
+      self.assertEqual(nuoca_command.TIMEOUT_EXIT_CODE, ec)
+      self.assertEqual((0, 'ok\n', ''), executor.execute('echo ok'))
+    finally:
+      executor.close()
+
+  def test_cache(self):
+    (_, first, _) = self.executor.execute('date +%N', cache_ttl=60)
+    (_, second, _) = self.executor.execute('date +%N', cache_ttl=60)
+    (_, uncached, _) = self.executor.execute('date +%N')
+    self.assertEqual(first, second)
+    self.assertNotEqual(first, uncached)
+
+  def test_execute_commands(self):
+    results = nuoca_util.execute_commands(['echo a', 'echo b'])
+    self.assertEqual([(0, 'a\n', ''), (0, 'b\n', '')], results)
+
+
 class TestCoerceNumeric(unittest.TestCase):
   def runTest(self):
     val1 = nuoca_util.coerce_numeric('23')
@@ -148,6 +388,115 @@ class TestCoerceNumeric(unittest.TestCase):
     self.assertEqual('foo', val3)
 
 
+class TestTimestampParser(unittest.TestCase):
+  def test_fast_path(self):
+    parser = nuoca_util.TimestampParser()
+    self.assertEqual(1496318401250,
+                     parser.to_epoch_millis('2017-06-01T12:00:01.250Z'))
+    self.assertEqual(1496318401000,
+                     parser.to_epoch_millis('2017-06-01T12:00:01Z'))
+    self.assertEqual(1496318401000,
+                     parser.to_epoch_millis('2017-06-01 12:00:01'))
+    self.assertEqual(1496318401123,
+                     parser.to_epoch_millis('2017-06-01T12:00:01.123456'))
+    self.assertEqual(1496318401500,
+                     parser.to_epoch_millis('2017-06-01T12:00:01,5Z'))
+    self.assertEqual(1496318401250 - 2 * 3600 * 1000,
+                     parser.to_epoch_millis('2017-06-01T12:00:01.250+02:00'))
+    self.assertEqual(1496318401000 + 5 * 3600 * 1000 + 30 * 60 * 1000,
+                     parser.to_epoch_millis('2017-06-01T12:00:01-0530'))
+    self.assertEqual(0, parser.fallbacks)
+
+  def test_fallback(self):
+    parser = nuoca_util.TimestampParser()
+    self.assertEqual(1496318401000,
+                     parser.to_epoch_millis('Jun 1 2017 12:00:01 UTC'))
+    self.assertEqual(1, parser.fallbacks)
+    # Not a valid date: left to dateutil, which rejects it.
+    with self.assertRaises(ValueError):
+      parser.to_epoch_millis('2017-13-01T12:00:01Z')
+    self.assertEqual(2, parser.fallbacks)
+
+  def test_same_as_dateutil(self):
+    from dateutil.parser import parse as date_parse
+    parser = nuoca_util.TimestampParser(cache_size=2)
+    for timestamp in ['2016-02-29T23:59:59.999Z', '1999-12-31T00:00:00Z',
+                      '2017-06-01T12:00:01.001Z', '2017-06-01T12:00:01.9Z',
+                      '2038-01-19T03:14:08.000Z']:
+      dt = date_parse(timestamp)
+      expected = calendar.timegm(dt.utctimetuple()) * 1000 + \
+          dt.microsecond // 1000
+      self.assertEqual(expected, parser.to_epoch_millis(timestamp))
+
+  def test_batch(self):
+    parser = nuoca_util.TimestampParser()
+    self.assertEqual(
+        [1496318401250, 1496318401750, None],
+        parser.to_epoch_millis_batch(['2017-06-01T12:00:01.250Z',
+                                      '2017-06-01T12:00:01.750Z',
+                                      'not a timestamp']))
+    self.assertEqual(1496318401250, nuoca_util.timestamp_to_epoch_millis(
+        '2017-06-01T12:00:01.250Z'))
+
+
+class TestBoundedQueue(unittest.TestCase):
+  def test_fifo(self):
+    queue = nuoca_util.BoundedQueue(3)
+    for i in range(3):
+      self.assertIsNone(queue.put(i))
+    self.assertTrue(queue.full())
+    self.assertEqual([0, 1, 2], [queue.get(0) for _ in range(3)])
+    self.assertIsNone(queue.get(0.01))
+
+  def test_drop_oldest(self):
+    queue = nuoca_util.BoundedQueue(2, nuoca_util.BoundedQueue.DROP_OLDEST)
+    queue.put(1)
+    queue.put(2)
+    self.assertEqual(1, queue.put(3))
+    self.assertEqual(1, queue.dropped_count)
+    self.assertEqual([2, 3], [queue.get(0) for _ in range(2)])
+
+  def test_drop_newest(self):
+    queue = nuoca_util.BoundedQueue(2, nuoca_util.BoundedQueue.DROP_NEWEST)
+    queue.put(1)
+    queue.put(2)
+    self.assertEqual(3, queue.put(3))
+    self.assertEqual([1, 2], [queue.get(0) for _ in range(2)])
+
+  def test_block_timeout(self):
+    queue = nuoca_util.BoundedQueue(1)
+    queue.put(1)
+    self.assertEqual(2, queue.put(2, timeout=0.05))
+    self.assertEqual(1, queue.dropped_count)
+
+  def test_bad_policy(self):
+    with self.assertRaises(AttributeError):
+      nuoca_util.BoundedQueue(1, 'no-such-policy')
+
+  def test_drain_and_stats(self):
+    queue = nuoca_util.BoundedQueue(3, nuoca_util.BoundedQueue.DROP_OLDEST)
+    for i in range(5):
+      queue.put(i)
+    self.assertEqual([2, 3, 4], list(queue.drain()))
+    self.assertEqual(0, len(queue))
+    self.assertEqual([], list(queue.drain()))
+    queue.put(5)
+    self.assertEqual({'depth': 1, 'high_water_mark': 3, 'dropped': 2},
+                     queue.get_stats())
+    self.assertEqual({'depth': 1, 'high_water_mark': 1, 'dropped': 0},
+                     queue.get_stats())
+
+  def test_drain_unblocks_producer(self):
+    queue = nuoca_util.BoundedQueue(1)
+    queue.put(1)
+    producer = threading.Thread(target=queue.put, args=(2,))
+    producer.start()
+    time.sleep(0.05)
+    self.assertEqual([1], list(queue.drain()))
+    producer.join(5)
+    self.assertEqual([2], list(queue.drain()))
+
+
 class TestIntervalSync1(unittest.TestCase):
   def runTest(self):
     utc_tzinfo = nuoca_util.UTC()
@@ -195,5 +544,89 @@ class TestIntervalSync3(unittest.TestCase):
        datetime.datetime(1970, 1, 1, tzinfo=utc_tzinfo)).total_seconds()
     self.assertEqual(ts1_epoch_seconds, seed_ts1)
 
+
+class TestIntervalScheduler(unittest.TestCase):
+  def runTest(self):
+    scheduler = nuoca_util.IntervalScheduler()
+    scheduler.add('fast', 1)
+    scheduler.add('slow', 2)
+    self.assertRaises(AttributeError, scheduler.add, 'slow', 2)
+    self.assertEqual(2, scheduler.get_interval('slow'))
+    timestamps = []
+    for _ in range(4):
+      interval_ts, due = scheduler.wait_for_next_interval()
+      self.assertLessEqual(interval_ts, time.time())
+      self.assertTrue('fast' in due)
+      self.assertEqual(interval_ts % 2 == 0, 'slow' in due)
+      timestamps.append(interval_ts)
+    self.assertEqual(range(timestamps[0], timestamps[0] + 4), timestamps)
+
+
+class TestIntervalSchedulerOverrun(unittest.TestCase):
+  def _run_overrun(self, overrun_policy):
+    clock = nuoca_util.VirtualClock(1000000.5)
+    scheduler = nuoca_util.IntervalScheduler(seed_ts=1000000,
+                                             overrun_policy=overrun_policy,
+                                             clock=clock)
+    scheduler.add('main', 1)
+    self.assertEqual((1000001, ['main']), scheduler.wait_for_next_interval())
+    self.assertEqual(1000001, clock.time())
+    self.assertEqual(0.0, scheduler.last_lateness)
+    # The collection cycle overruns the next two intervals.
+    clock.advance(2.5)
+    timestamps = [scheduler.wait_for_next_interval()[0] for _ in range(3)]
+    return timestamps, scheduler.get_stats()
+
+  def test_skip(self):
+    timestamps, stats = self._run_overrun('skip')
+    self.assertEqual([1000004, 1000005, 1000006], timestamps)
+    self.assertEqual(2, stats['skipped_intervals'])
+
+  def test_catch_up(self):
+    timestamps, stats = self._run_overrun('catch_up')
+    self.assertEqual([1000002, 1000003, 1000004], timestamps)
+    self.assertEqual(2, stats['caught_up_intervals'])
+
+  def test_coalesce(self):
+    timestamps, stats = self._run_overrun('coalesce')
+    self.assertEqual([1000003, 1000004, 1000005], timestamps)
+    self.assertEqual(1, stats['coalesced_intervals'])
+    self.assertEqual(0, stats['skipped_intervals'])
+
+  def test_bad_policy(self):
+    self.assertRaises(AttributeError, nuoca_util.IntervalScheduler,
+                      None, 'no-such-policy')
+
+
+class TestVirtualClock(unittest.TestCase):
+  def test_interval_sync(self):
+    clock = nuoca_util.VirtualClock(1000000.5)
+    interval_sync = nuoca_util.IntervalSync(interval=30, seed_ts=1000000,
+                                            clock=clock)
+    self.assertEqual(1000030, interval_sync.wait_for_next_interval())
+    self.assertEqual(1000060, interval_sync.wait_for_next_interval())
+    self.assertEqual(1000060, clock.time())
+
+  def test_nuoca_clock(self):
+    clock = nuoca_util.VirtualClock(2000000000)
+    nuoca_util.set_nuoca_clock(clock)
+    try:
+      self.assertEqual(2000000000, nuoca_util.nuoca_gettimestamp())
+      start_time = time.time()
+      scheduler = nuoca_util.IntervalScheduler()
+      scheduler.add('main', 3600)
+      for _ in range(24):
+        scheduler.wait_for_next_interval()
+      self.assertTrue(nuoca_util.nuoca_gettimestamp() >=
+                      2000000000 + 23 * 3600)
+      self.assertLess(time.time() - start_time, 1.0)
+      nuoca_util.sync_virtual_clock(3000000000)
+      self.assertEqual(3000000000, nuoca_util.nuoca_gettimestamp())
+      # The clock never moves back.
+      nuoca_util.sync_virtual_clock(1000000000)
+      self.assertEqual(3000000000, nuoca_util.nuoca_gettimestamp())
+    finally:
+      nuoca_util.set_nuoca_clock(nuoca_util.SystemClock())
+
 if __name__ == '__main__':
   sys.exit(unittest.main())
@@ -0,0 +1,215 @@
+from __future__ import print_function
+
+import socket
+import SocketServer
+import struct
+import threading
+import time
+import unittest
+
+import nuoca_util
+import nuoca_zabbix
+from plugins.input.ZabbixPlugin import ZabbixPlugin
+
+
+class FakeZabbixAgent(SocketServer.ThreadingTCPServer):
+  """
+  Answers Zabbix passive checks from a dict of values.  A key whose value
+  is a float is answered after that many seconds.
+  """
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, items):
+    SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                             FakeZabbixAgentHandler)
+    self.items = items
+    self.requests = []
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.shutdown()
+    self.server_close()
+
+
+class FakeZabbixAgentHandler(SocketServer.BaseRequestHandler):
+  def handle(self):
+    data = ''
+    while len(data) < 13:
+      data += self.request.recv(1024)
+    length = struct.unpack('<Q', data[5:13])[0]
+    while len(data) < 13 + length:
+      data += self.request.recv(1024)
+    key = data[13:13 + length]
+    self.server.requests.append(key)
+    value = self.server.items.get(key)
+    if value is None:
+      value = 'ZBX_NOTSUPPORTED\0Unsupported item key.'
+    elif isinstance(value, float):
+      time.sleep(value)
+      value = 'late'
+    self.request.sendall(nuoca_zabbix.pack_request(value))
+
+
+class TestZabbixProtocol(unittest.TestCase):
+  def runTest(self):
+    packed = nuoca_zabbix.pack_request('agent.ping')
+    self.assertEqual('ZBXD\x01\x0a\0\0\0\0\0\0\0agent.ping', packed)
+    self.assertEqual('agent.ping', nuoca_zabbix.unpack_response(packed))
+    self.assertIsNone(nuoca_zabbix.unpack_response(packed[:-1]))
+    self.assertEqual('1', nuoca_zabbix.unpack_response('1\n'))
+
+
+class TestZabbixAgentClient(unittest.TestCase):
+  def setUp(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+
+  def test_get_values(self):
+    items = dict([('key.%d' % x, str(x)) for x in range(50)])
+    with FakeZabbixAgent(items) as agent:
+      client = nuoca_zabbix.ZabbixAgentClient('127.0.0.1', agent.port,
+                                              max_connections=8)
+      values, errors = client.get_values(sorted(items) + ['no.such.key'])
+    self.assertEqual(items, dict([(k, v) for k, v in values.items()
+                                  if k != 'no.such.key']))
+    self.assertEqual(nuoca_zabbix.ZBX_NOTSUPPORTED, values['no.such.key'])
+    self.assertEqual({'no.such.key': 'Unsupported item key.'}, errors)
+
+  def test_concurrent_with_timeout(self):
+    items = {'fast': '1', 'slow.1': 0.5, 'slow.2': 0.5, 'hung': 10.0}
+    with FakeZabbixAgent(items) as agent:
+      client = nuoca_zabbix.ZabbixAgentClient('127.0.0.1', agent.port)
+      start = time.time()
+      values, errors = client.get_values(['hung', 'slow.1', 'slow.2',
+                                          'fast'], timeout=2)
+      elapsed = time.time() - start
+    self.assertLess(elapsed, 5)
+    self.assertEqual({'fast': '1', 'slow.1': 'late', 'slow.2': 'late'},
+                     values)
+    self.assertEqual(['hung'], errors.keys())
+    self.assertTrue(errors['hung'].startswith('Timed out'))
+
+  def test_connection_refused(self):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    client = nuoca_zabbix.ZabbixAgentClient('127.0.0.1', port)
+    value, error = client.get_value('agent.ping')
+    self.assertIsNone(value)
+    self.assertTrue(error)
+
+
+class TestZabbixKeyCache(unittest.TestCase):
+  def setUp(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    self.now = 1000.0
+    self.cache = nuoca_zabbix.ZabbixKeyCache(
+        suspend_interval=60, static_keys=['system.uname'],
+        static_refresh_interval=3600, clock=lambda: self.now)
+
+  def test_suspend_and_probe(self):
+    keys = ['a', 'b', 'c']
+    self.assertEqual(keys, self.cache.keys_to_fetch(keys))
+    self.cache.update(keys, {'a': '1', 'b': nuoca_zabbix.ZBX_NOTSUPPORTED},
+                      {'b': 'Unsupported item key.', 'c': 'Timed out'})
+    self.assertEqual(['b', 'c'], self.cache.get_suspended_keys())
+    self.assertEqual(['a'], self.cache.keys_to_fetch(keys))
+    self.assertEqual([], self.cache.keys_to_probe(keys))
+    self.now += 60
+    self.assertEqual(['b', 'c'], self.cache.keys_to_probe(keys))
+    # Already being probed.
+    self.assertEqual([], self.cache.keys_to_probe(keys))
+    self.cache.update(['b', 'c'], {'b': '2'}, {'c': 'Timed out'},
+                      probe=True)
+    self.assertEqual(['a', 'b'], self.cache.keys_to_fetch(keys))
+    self.assertEqual([], self.cache.keys_to_probe(keys))
+    self.now += 60
+    self.assertEqual(['c'], self.cache.keys_to_probe(keys))
+
+  def test_agent_failure_does_not_suspend(self):
+    keys = ['a', 'b']
+    self.cache.update(keys, {}, {'a': 'Timed out', 'b': 'Timed out'})
+    self.assertEqual([], self.cache.get_suspended_keys())
+    self.assertEqual(keys, self.cache.keys_to_fetch(keys))
+
+  def test_static_keys(self):
+    keys = ['system.uname', 'a']
+    self.cache.update(keys, {'system.uname': 'Linux', 'a': '1'}, {})
+    self.assertEqual(['a'], self.cache.keys_to_fetch(keys))
+    self.assertEqual({'system.uname': 'Linux'},
+                     self.cache.get_static_values(keys))
+    self.now += 3600
+    self.assertEqual(keys, self.cache.keys_to_fetch(keys))
+
+
+class TestZabbixPlugin(unittest.TestCase):
+  def runTest(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    items = {'agent.ping': '1', 'system.uptime': '12345',
+             'system.cpu.load[,avg1]': '0.25'}
+    with FakeZabbixAgent(items) as agent:
+      plugin = ZabbixPlugin(None)
+      config = {'server': '127.0.0.1', 'port': agent.port,
+                'autoDiscoverMonitors': False,
+                'keys': ['system.uptime', 'system.cpu.load[,avg1]']}
+      self.assertTrue(plugin.startup(config))
+      resp_values = plugin.collect(10)
+      plugin.shutdown()
+    self.assertEqual(12345, resp_values[0]['system.uptime'])
+    self.assertEqual(0.25, resp_values[0]['system.cpu.load[,avg1]'])
+
+    plugin = ZabbixPlugin(None)
+    config['port'] = agent.port
+    self.assertFalse(plugin.startup(config))
+
+
+class TestZabbixPluginKeyCache(unittest.TestCase):
+  def runTest(self):
+    nuoca_util.initialize_logger("/tmp/nuoca.test.log")
+    items = {'agent.ping': '1', 'system.uptime': '12345',
+             'system.hostname': 'nuoca-test'}
+    with FakeZabbixAgent(items) as agent:
+      plugin = ZabbixPlugin(None)
+      config = {'server': '127.0.0.1', 'port': agent.port,
+                'autoDiscoverMonitors': False, 'suspendInterval': 0.5,
+                'keys': ['system.uptime', 'system.hostname', 'no.such.key']}
+      self.assertTrue(plugin.startup(config))
+      for _ in range(3):
+        resp_values = plugin.collect(10)
+      self.assertEqual(12345, resp_values[0]['system.uptime'])
+      self.assertEqual('nuoca-test', resp_values[0]['system.hostname'])
+      self.assertNotIn('no.such.key', resp_values[0])
+      self.assertEqual(3, agent.requests.count('system.uptime'))
+      # Static and unsupported keys are fetched once.
+      self.assertEqual(1, agent.requests.count('system.hostname'))
+      self.assertEqual(1, agent.requests.count('no.such.key'))
+
+      # The unsupported key is probed in the background, and collected
+      # once it is supported.
+      items['no.such.key'] = '7'
+      time.sleep(0.6)
+      plugin.collect(10)
+      plugin.shutdown()
+      self.assertEqual(2, agent.requests.count('no.such.key'))
+      resp_values = plugin.collect(10)
+      self.assertEqual(7, resp_values[0]['no.such.key'])
+
+      # Rediscovery logs and applies the changes.
+      plugin._auto_discover_monitors = lambda: ['net.if.in[eth0]']
+      plugin._rediscover_monitors()
+      self.assertIn('net.if.in[eth0]', plugin._get_keys())
+      plugin._auto_discover_monitors = lambda: ['net.if.in[eth1]']
+      plugin._rediscover_monitors()
+      self.assertNotIn('net.if.in[eth0]', plugin._get_keys())
+      self.assertIn('net.if.in[eth1]', plugin._get_keys())
+      plugin.shutdown()